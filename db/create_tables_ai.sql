@@ -1,19 +1,57 @@
+-- 最新のスキーマを作成するため、実行後は hub-app で `alembic stamp head` を実行する
 -- ai_schema.ai_call_logs テーブルの作成
+-- created_at の月単位のレンジパーティション。月ごとのパーティションは hub-app の起動時に作成し、
+-- 保持期間を過ぎたものは切り離す(LOG_PARTITION_RETENTION_MODE=drop で削除。shared_libs/log_partitions.py)。
+-- 範囲外の行は既定パーティションに入り、次の保守でその月のパーティションに移す
 CREATE TABLE IF NOT EXISTS ai_schema.ai_call_logs (
-    call_id SERIAL PRIMARY KEY,
+    call_id SERIAL,
     app_name VARCHAR(100) NOT NULL,
     user_id INTEGER,
     prompt TEXT NOT NULL,
     response TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (call_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS ai_schema.ai_call_logs_default PARTITION OF ai_schema.ai_call_logs DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_ai_call_logs_created_at ON ai_schema.ai_call_logs (created_at);
 
 -- ai_schema.doc_embeddings テーブルの作成
 CREATE TABLE IF NOT EXISTS ai_schema.doc_embeddings (
     embedding_id SERIAL PRIMARY KEY,
     doc_ref VARCHAR(100) NOT NULL,
     embedding_vector TEXT,
+    embedding_blob BYTEA,
+    embedding_dim INT,
+    embedding_model VARCHAR(100),
+    chunk_start INT,
+    chunk_end INT,
+    content_hash BYTEA,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX IF NOT EXISTS idx_doc_embeddings_doc_ref ON ai_schema.doc_embeddings (doc_ref);
+CREATE INDEX IF NOT EXISTS idx_doc_embeddings_model_hash ON ai_schema.doc_embeddings (embedding_model, content_hash);
+
+-- チャンク本文のハッシュ値ごとのベクトル(同じ本文のチャンクで共有する)
+CREATE TABLE IF NOT EXISTS ai_schema.chunk_vectors (
+    content_hash BYTEA NOT NULL,
+    embedding_model VARCHAR(100) NOT NULL,
+    embedding_blob BYTEA NOT NULL,
+    embedding_dim INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (embedding_model, content_hash)
+);
+
+-- /ai/generate の応答キャッシュ(キーは (モデル, プロンプト, 生成パラメータ) のSHA-256)
+CREATE TABLE IF NOT EXISTS ai_schema.llm_response_cache (
+    cache_key BYTEA PRIMARY KEY,
+    model VARCHAR(100) NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_response_cache_expires_at ON ai_schema.llm_response_cache (expires_at);
+
 -- その他のテーブル作成SQL
@@ -1,5 +1,6 @@
 -- ._bk\db\create_tables_hub.sql
 -- Hub-app 用のスキーマとテーブル定義(認証, AI関連, 共通文書など)
+-- 最新のスキーマを作成するため、実行後は hub-app で `alembic stamp head` を実行する(init_db.bat で実行済み)
 select current_setting('client_encoding'); -- 現在のクライアントエンコーディングを確認
 set client_encoding to 'utf8'; -- 変更
 
@@ -69,21 +70,82 @@ COMMENT ON TABLE hub_docs.documents IS 'HubApp全社文書の格納テーブル'
 -- 3) ai_schema: AI/RAG関連
 CREATE SCHEMA IF NOT EXISTS ai_schema;
 
+-- created_at の月単位のレンジパーティション。月ごとのパーティションは hub-app の起動時に作成し、
+-- 保持期間を過ぎたものは切り離す(LOG_PARTITION_RETENTION_MODE=drop で削除。shared_libs/log_partitions.py)。
+-- 範囲外の行は既定パーティションに入り、次の保守でその月のパーティションに移す
 CREATE TABLE IF NOT EXISTS ai_schema.ai_call_logs (
-    call_id SERIAL PRIMARY KEY,
+    call_id SERIAL,
     app_name VARCHAR(100) NOT NULL,
     user_id INT,
     prompt TEXT NOT NULL,
     response TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (call_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS ai_schema.ai_call_logs_default PARTITION OF ai_schema.ai_call_logs DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_ai_call_logs_created_at ON ai_schema.ai_call_logs (created_at);
 
 CREATE TABLE IF NOT EXISTS ai_schema.doc_embeddings (
     embedding_id SERIAL PRIMARY KEY,
     doc_ref VARCHAR(100) NOT NULL,
     embedding_vector TEXT,
+    embedding_blob BYTEA,
+    embedding_dim INT,
+    embedding_model VARCHAR(100),
+    chunk_start INT,
+    chunk_end INT,
+    content_hash BYTEA,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX IF NOT EXISTS idx_doc_embeddings_doc_ref ON ai_schema.doc_embeddings (doc_ref);
+CREATE INDEX IF NOT EXISTS idx_doc_embeddings_model_hash ON ai_schema.doc_embeddings (embedding_model, content_hash);
+
+-- チャンク本文のハッシュ値ごとのベクトル(同じ本文のチャンクで共有する)
+CREATE TABLE IF NOT EXISTS ai_schema.chunk_vectors (
+    content_hash BYTEA NOT NULL,
+    embedding_model VARCHAR(100) NOT NULL,
+    embedding_blob BYTEA NOT NULL,
+    embedding_dim INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (embedding_model, content_hash)
+);
+
+-- /ai/generate の応答キャッシュ(キーは (モデル, プロンプト, 生成パラメータ) のSHA-256)
+CREATE TABLE IF NOT EXISTS ai_schema.llm_response_cache (
+    cache_key BYTEA PRIMARY KEY,
+    model VARCHAR(100) NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_response_cache_expires_at ON ai_schema.llm_response_cache (expires_at);
+
 COMMENT ON TABLE ai_schema.ai_call_logs IS 'AI呼び出し履歴を保存(全アプリ共通)';
 COMMENT ON TABLE ai_schema.doc_embeddings IS 'RAG用途の文書Embeddingを保管';
+COMMENT ON TABLE ai_schema.chunk_vectors IS 'チャンク本文のハッシュ値ごとに共有するEmbedding';
+COMMENT ON TABLE ai_schema.llm_response_cache IS 'LLM応答のキャッシュ(有効期限付き)';
+
+-- 4) logs_schema: APIリクエストのログ
+CREATE SCHEMA IF NOT EXISTS logs_schema;
+
+-- timestamp の月単位のレンジパーティション(ai_schema.ai_call_logs と同様に管理する)
+CREATE TABLE IF NOT EXISTS logs_schema.api_logs (
+    id SERIAL,
+    endpoint VARCHAR(100) NOT NULL,
+    method VARCHAR(10) NOT NULL,
+    request_body TEXT,
+    response_status INT NOT NULL,
+    latency_ms DOUBLE PRECISION,
+    request_size INT,
+    app_name VARCHAR(50),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS logs_schema.api_logs_default PARTITION OF logs_schema.api_logs DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_api_logs_timestamp ON logs_schema.api_logs (timestamp);
+
+COMMENT ON TABLE logs_schema.api_logs IS 'APIリクエストのログ(エンドポイント・ステータス・応答時間・サイズ)';
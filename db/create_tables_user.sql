@@ -16,6 +16,9 @@ CREATE TABLE IF NOT EXISTS doc_app.local_docs (
 
 COMMENT ON TABLE doc_app.local_docs IS 'ユーザーアプリ(文書管理)のローカル文書';
 
+-- 所有者(ORM の LocalDoc.owner_id に対応。RAG検索の所有者絞り込みにも使う)
+ALTER TABLE doc_app.local_docs ADD COLUMN IF NOT EXISTS owner_id INT;
+
 -- タグ管理 (多対多)
 CREATE TABLE IF NOT EXISTS doc_app.doc_tags (
     tag_id SERIAL PRIMARY KEY,
@@ -28,6 +28,12 @@ REM echo === Creating Tables for Hub Docs Schema ===
 REM スキーマを設定してからHub Docs関連のテーブル作成スクリプトを実行
 REM psql -U mydbuser -d my_ai_docs_db -c "SET search_path TO hub_docs, public;" -f .\db\create_tables_hub_docs.sql
 
+echo === Marking Alembic Migrations as Applied ===
+REM create_tables_*.sql は最新のスキーマを作成するため、マイグレーションは適用済みとして記録する
+pushd .\hub-app
+alembic stamp head
+popd
+
 echo === Inserting Sample Data ===
 REM 必要なスキーマを設定してからサンプルデータ挿入スクリプトを実行
 psql -U mydbuser -d my_ai_docs_db -c "SET search_path TO auth_schema, doc_app, ai_schema, logs_schema, hub_docs, public;" -f .\db\insert_sample_data.sql
@@ -0,0 +1,108 @@
+"""doc_embeddings にバイナリ(float32)形式のベクトル列を追加し、既存のテキスト行を移行する
+
+Revision ID: 3f1c2a9b7d01
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+import json
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from shared_libs.vector_codec import VECTOR_DTYPE, text_to_blob, unpack_vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9b7d01'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# 1文(1トランザクション)で変換する行数。変換は autocommit_block の中で行うため、
+# ロックの保持やWALの量はこのバッチ単位に収まる(途中で失敗しても変換済みの行は残り、再実行で続きから変換する)
+BATCH_SIZE = 5000
+# 既存のテキスト行に付与するモデル名
+LEGACY_MODEL = "legacy-text"
+NEW_COLUMNS = (
+    ("embedding_blob", sa.LargeBinary()),
+    ("embedding_dim", sa.Integer()),
+    ("embedding_model", sa.String(100)),
+)
+
+
+def _existing_columns(conn) -> set:
+    return {column["name"] for column in sa.inspect(conn).get_columns("doc_embeddings", schema="ai_schema")}
+
+
+def _update_from_values(conn, set_clause: str, names: Sequence[str], rows: list) -> None:
+    """rows(names の順の値の組)を VALUES 句にまとめ、1文の UPDATE ... FROM で書き込む。"""
+    placeholders = []
+    params = {}
+    for i, row in enumerate(rows):
+        placeholders.append("(" + ", ".join(f":{name}_{i}" for name in names) + ")")
+        params.update({f"{name}_{i}": value for name, value in zip(names, row)})
+    conn.execute(sa.text(
+        f"UPDATE ai_schema.doc_embeddings AS e SET {set_clause} "
+        f"FROM (VALUES {', '.join(placeholders)}) AS v({', '.join(names)}) "
+        f"WHERE e.embedding_id = v.embedding_id"
+    ), params)
+
+
+def upgrade() -> None:
+    # db/create_tables_ai.sql で作成したDBには列が既にあるため、ない列だけを追加する
+    existing = _existing_columns(op.get_bind())
+    for name, column_type in NEW_COLUMNS:
+        if name not in existing:
+            op.add_column("doc_embeddings", sa.Column(name, column_type, nullable=True), schema="ai_schema")
+
+    select_batch = sa.text(
+        "SELECT embedding_id, embedding_vector FROM ai_schema.doc_embeddings "
+        "WHERE embedding_blob IS NULL AND embedding_vector IS NOT NULL AND embedding_id > :last_id "
+        "ORDER BY embedding_id LIMIT :limit"
+    )
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        last_id = 0
+        while True:
+            rows = conn.execute(select_batch, {"last_id": last_id, "limit": BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+            values = []
+            for embedding_id, embedding_vector in rows:
+                blob = text_to_blob(embedding_vector)
+                values.append((embedding_id, blob, len(blob) // VECTOR_DTYPE.itemsize))
+            _update_from_values(
+                conn,
+                f"embedding_blob = v.blob, embedding_dim = v.dim, embedding_model = '{LEGACY_MODEL}', "
+                "embedding_vector = NULL",
+                ("embedding_id", "blob", "dim"),
+                values,
+            )
+            last_id = rows[-1][0]
+
+
+def downgrade() -> None:
+    select_batch = sa.text(
+        "SELECT embedding_id, embedding_blob FROM ai_schema.doc_embeddings "
+        "WHERE embedding_blob IS NOT NULL AND embedding_vector IS NULL AND embedding_id > :last_id "
+        "ORDER BY embedding_id LIMIT :limit"
+    )
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        last_id = 0
+        while True:
+            rows = conn.execute(select_batch, {"last_id": last_id, "limit": BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+            _update_from_values(
+                conn,
+                "embedding_vector = v.vec",
+                ("embedding_id", "vec"),
+                [(embedding_id, json.dumps(unpack_vector(blob).tolist())) for embedding_id, blob in rows],
+            )
+            last_id = rows[-1][0]
+    op.drop_column("doc_embeddings", "embedding_model", schema="ai_schema")
+    op.drop_column("doc_embeddings", "embedding_dim", schema="ai_schema")
+    op.drop_column("doc_embeddings", "embedding_blob", schema="ai_schema")
@@ -0,0 +1,33 @@
+"""doc_embeddings にチャンクの文字範囲(chunk_start / chunk_end)と doc_ref の索引を追加する
+
+Revision ID: 8b4e6d2f9a13
+Revises: 3f1c2a9b7d01
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b4e6d2f9a13'
+down_revision: Union[str, None] = '3f1c2a9b7d01'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("doc_embeddings", sa.Column("chunk_start", sa.Integer(), nullable=True), schema="ai_schema")
+    op.add_column("doc_embeddings", sa.Column("chunk_end", sa.Integer(), nullable=True), schema="ai_schema")
+    op.create_index(
+        "idx_doc_embeddings_doc_ref", "doc_embeddings", ["doc_ref"],
+        schema="ai_schema", if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_doc_embeddings_doc_ref", table_name="doc_embeddings", schema="ai_schema")
+    op.drop_column("doc_embeddings", "chunk_end", schema="ai_schema")
+    op.drop_column("doc_embeddings", "chunk_start", schema="ai_schema")
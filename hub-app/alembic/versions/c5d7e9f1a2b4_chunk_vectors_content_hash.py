@@ -0,0 +1,50 @@
+"""チャンク本文のハッシュ値で共有するベクトル表(chunk_vectors)と doc_embeddings.content_hash を追加する
+
+Revision ID: c5d7e9f1a2b4
+Revises: 8b4e6d2f9a13
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5d7e9f1a2b4'
+down_revision: Union[str, None] = '8b4e6d2f9a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "chunk_vectors",
+        sa.Column("content_hash", sa.LargeBinary(), nullable=False),
+        sa.Column("embedding_model", sa.String(100), nullable=False),
+        sa.Column("embedding_blob", sa.LargeBinary(), nullable=False),
+        sa.Column("embedding_dim", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint("embedding_model", "content_hash"),
+        schema="ai_schema",
+    )
+    # 既存の行はベクトルを行に持ったまま(content_hash は NULL)で、次の再索引時に共有形式へ置き換わる
+    op.add_column("doc_embeddings", sa.Column("content_hash", sa.LargeBinary(), nullable=True), schema="ai_schema")
+    op.create_index(
+        "idx_doc_embeddings_model_hash", "doc_embeddings", ["embedding_model", "content_hash"],
+        schema="ai_schema", if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    # 共有形式の行にはベクトルを書き戻してから列と表を削除する
+    op.execute(
+        "UPDATE ai_schema.doc_embeddings e SET embedding_blob = v.embedding_blob "
+        "FROM ai_schema.chunk_vectors v "
+        "WHERE e.embedding_blob IS NULL AND v.content_hash = e.content_hash "
+        "AND v.embedding_model = e.embedding_model"
+    )
+    op.drop_index("idx_doc_embeddings_model_hash", table_name="doc_embeddings", schema="ai_schema")
+    op.drop_column("doc_embeddings", "content_hash", schema="ai_schema")
+    op.drop_table("chunk_vectors", schema="ai_schema")
@@ -0,0 +1,39 @@
+"""LLM応答のキャッシュ表(llm_response_cache)を追加する
+
+Revision ID: d8e2f4a6b1c3
+Revises: c5d7e9f1a2b4
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8e2f4a6b1c3'
+down_revision: Union[str, None] = 'c5d7e9f1a2b4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm_response_cache",
+        sa.Column("cache_key", sa.LargeBinary(), primary_key=True),
+        sa.Column("model", sa.String(100), nullable=False),
+        sa.Column("response", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        schema="ai_schema",
+    )
+    op.create_index(
+        "idx_llm_response_cache_expires_at", "llm_response_cache", ["expires_at"],
+        schema="ai_schema", if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_llm_response_cache_expires_at", table_name="llm_response_cache", schema="ai_schema")
+    op.drop_table("llm_response_cache", schema="ai_schema")
@@ -0,0 +1,44 @@
+"""APIリクエストのログ表(logs_schema.api_logs)を追加する
+
+Revision ID: e4b6d8f0a2c5
+Revises: d8e2f4a6b1c3
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b6d8f0a2c5'
+down_revision: Union[str, None] = 'd8e2f4a6b1c3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE SCHEMA IF NOT EXISTS logs_schema")
+    op.create_table(
+        "api_logs",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("endpoint", sa.String(100), nullable=False),
+        sa.Column("method", sa.String(10), nullable=False),
+        sa.Column("request_body", sa.Text(), nullable=True),
+        sa.Column("response_status", sa.Integer(), nullable=False),
+        sa.Column("latency_ms", sa.Float(), nullable=True),
+        sa.Column("request_size", sa.Integer(), nullable=True),
+        sa.Column("app_name", sa.String(50), nullable=True),
+        sa.Column("timestamp", sa.DateTime(), server_default=sa.func.now()),
+        schema="logs_schema",
+    )
+    op.create_index(
+        "idx_api_logs_timestamp", "api_logs", ["timestamp"],
+        schema="logs_schema", if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_api_logs_timestamp", table_name="api_logs", schema="logs_schema")
+    op.drop_table("api_logs", schema="logs_schema")
@@ -0,0 +1,114 @@
+"""ログ表(ai_call_logs・api_logs)を月単位のレンジパーティション表に移行する
+
+Revision ID: f6c8e0a2b4d7
+Revises: e4b6d8f0a2c5
+Create Date: 2026-10-18 22:00:00.000000
+
+既存の表を *_legacy に名前を変え、同じ列のパーティション表を作成して行を複製する。
+既存の行がある月から3か月先までの月のパーティションと、範囲外の行の受け皿となる既定パーティションを作成する。
+以降のパーティションの作成と保持期間の適用は shared_libs.log_partitions(hub-app の起動時・定期実行)で行う。
+
+*_legacy の表は移行結果を確認できるよう残す。確認後に削除する場合は
+`alembic -x drop_legacy_logs=true upgrade head` で実行するか、手動で DROP TABLE する。
+downgrade は同じ指定があれば残っている *_legacy も削除する(残したまま再度 upgrade すると名前が衝突する)。
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6c8e0a2b4d7'
+down_revision: Union[str, None] = 'e4b6d8f0a2c5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (スキーマ, 表, ID列, パーティションキー, パーティションキー以外の列の定義)
+LOG_TABLES = [
+    ("ai_schema", "ai_call_logs", "call_id", "created_at",
+     "app_name VARCHAR(100) NOT NULL, user_id INT, prompt TEXT NOT NULL, response TEXT"),
+    ("logs_schema", "api_logs", "id", "timestamp",
+     "endpoint VARCHAR(100) NOT NULL, method VARCHAR(10) NOT NULL, request_body TEXT, "
+     "response_status INT NOT NULL, latency_ms DOUBLE PRECISION, request_size INT, app_name VARCHAR(50)"),
+]
+MONTHS_AHEAD = 3
+
+
+def _drop_legacy() -> bool:
+    """-x drop_legacy_logs=true が指定された場合だけ *_legacy の表を削除する。"""
+    value = context.get_x_argument(as_dictionary=True).get("drop_legacy_logs", "")
+    return value.lower() in ("1", "true", "yes")
+
+
+def _columns(id_column: str, key: str, columns: str) -> str:
+    names = [definition.split()[0] for definition in columns.split(", ")]
+    return ", ".join([id_column, *names, key])
+
+
+def upgrade() -> None:
+    for schema, name, id_column, key, columns in LOG_TABLES:
+        sequence = f"{schema}.{name}_{id_column}_seq"
+        op.execute(f"ALTER TABLE {schema}.{name} RENAME TO {name}_legacy")
+        op.execute(f"ALTER TABLE {schema}.{name}_legacy RENAME CONSTRAINT {name}_pkey TO {name}_legacy_pkey")
+        op.execute(f"ALTER INDEX IF EXISTS {schema}.idx_{name}_{key} RENAME TO idx_{name}_legacy_{key}")
+        op.execute(
+            f"CREATE TABLE {schema}.{name} ("
+            f"{id_column} INT NOT NULL DEFAULT nextval('{sequence}'), {columns}, "
+            f"{key} TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+            f"PRIMARY KEY ({id_column}, {key})"
+            f") PARTITION BY RANGE ({key})"
+        )
+        # 旧表を削除しても連番が残るよう、所有者を新しい表の列に移す
+        op.execute(f"ALTER SEQUENCE {sequence} OWNED BY {schema}.{name}.{id_column}")
+        op.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{key} ON {schema}.{name} ({key})")
+        # 既存の行がある最初の月から、今月の MONTHS_AHEAD か月先までのパーティションを作る
+        op.execute(f"""
+            DO $$
+            DECLARE
+                part_month DATE;
+            BEGIN
+                FOR part_month IN
+                    SELECT generate_series(
+                        date_trunc('month', LEAST(COALESCE((SELECT MIN("{key}") FROM {schema}.{name}_legacy), now()), now())),
+                        date_trunc('month', now()) + interval '{MONTHS_AHEAD} months',
+                        interval '1 month'
+                    )::date
+                LOOP
+                    EXECUTE format(
+                        'CREATE TABLE IF NOT EXISTS {schema}.%I PARTITION OF {schema}.{name} FOR VALUES FROM (%L) TO (%L)',
+                        '{name}_p' || to_char(part_month, 'YYYYMM'), part_month, part_month + interval '1 month'
+                    );
+                END LOOP;
+            END $$
+        """)
+        op.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{name}_default PARTITION OF {schema}.{name} DEFAULT")
+        op.execute(
+            f"INSERT INTO {schema}.{name} ({_columns(id_column, key, columns)}) "
+            f"SELECT {_columns(id_column, f'COALESCE({key}, now())', columns)} FROM {schema}.{name}_legacy"
+        )
+        if _drop_legacy():
+            op.execute(f"DROP TABLE {schema}.{name}_legacy")
+
+
+def downgrade() -> None:
+    for schema, name, id_column, key, columns in LOG_TABLES:
+        sequence = f"{schema}.{name}_{id_column}_seq"
+        op.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        op.execute(f"ALTER TABLE {schema}.{name} RENAME TO {name}_partitioned")
+        op.execute(f"ALTER INDEX IF EXISTS {schema}.idx_{name}_{key} RENAME TO idx_{name}_partitioned_{key}")
+        op.execute(f"ALTER TABLE {schema}.{name}_partitioned RENAME CONSTRAINT {name}_pkey TO {name}_partitioned_pkey")
+        op.execute(
+            f"CREATE TABLE {schema}.{name} ("
+            f"{id_column} INT PRIMARY KEY DEFAULT nextval('{sequence}'), {columns}, "
+            f"{key} TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        )
+        op.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{key} ON {schema}.{name} ({key})")
+        op.execute(
+            f"INSERT INTO {schema}.{name} ({_columns(id_column, key, columns)}) "
+            f"SELECT {_columns(id_column, key, columns)} FROM {schema}.{name}_partitioned"
+        )
+        # パーティション(子の表)も含めて削除する
+        op.execute(f"DROP TABLE {schema}.{name}_partitioned CASCADE")
+        op.execute(f"ALTER SEQUENCE {sequence} OWNED BY {schema}.{name}.{id_column}")
+        if _drop_legacy():
+            op.execute(f"DROP TABLE IF EXISTS {schema}.{name}_legacy")
@@ -1,6 +1,7 @@
 # .\hub-app\config.py
 import os
 from pydantic import BaseSettings, Field
+from typing import Optional
 
 class Settings(BaseSettings):
     DATABASE_URL: str = os.getenv("DATABASE_URL")
@@ -13,6 +14,97 @@ class Settings(BaseSettings):
     HUBAPP_URL: str = Field(..., env="HUBAPP_URL")
     CLIENT_ID: str = Field(default="", env="CLIENT_ID")
     CLIENT_SECRET: str = Field(default="", env="CLIENT_SECRET")
+    # RAG索引の設定(RAG_INDEX_PATH を指定するとIVF近似索引をそのパスに永続化する)
+    RAG_INDEX_PATH: str = Field(default="", env="RAG_INDEX_PATH")
+    RAG_IVF_LISTS: int = Field(default=256, env="RAG_IVF_LISTS")
+    RAG_IVF_PROBE: int = Field(default=8, env="RAG_IVF_PROBE")
+    # 総当たり索引のベクトルの圧縮方式(none / int8 / pq)、直積量子化の部分ベクトル数(未指定時は次元数/4)、
+    # float32で再計算する候補数の倍率(top_k × この値)
+    RAG_QUANTIZATION: str = Field(default="none", env="RAG_QUANTIZATION")
+    RAG_PQ_SUBVECTORS: Optional[int] = Field(default=None, env="RAG_PQ_SUBVECTORS")
+    RAG_RERANK_FACTOR: int = Field(default=4, env="RAG_RERANK_FACTOR")
+    # 1以上の場合、総当たり索引を共有メモリに置き、このプロセス数で分割して並列に検索する(0は無効)
+    # 各シャードの計算は別のコアで同時に動く場合にだけ速くなり、空きコアがなければクエリと結果の受け渡しの分だけ
+    # 逐次検索より遅くなるため既定では無効にする。有効にする前に実機のコア数と検索時間で確認すること
+    RAG_SHARDS: int = Field(default=0, env="RAG_SHARDS")
+    # 文書の更新・削除で無効になった索引の行がこの割合以上になったら、生きている行だけに詰め直す
+    RAG_COMPACT_RATIO: float = Field(default=0.25, env="RAG_COMPACT_RATIO")
+    # ベクトル検索とBM25検索の統合方法(vector / bm25 / rrf / linear)と linear 時のベクトル側の重み
+    RAG_FUSION: str = Field(default="rrf", env="RAG_FUSION")
+    RAG_FUSION_ALPHA: float = Field(default=0.5, env="RAG_FUSION_ALPHA")
+    # Embeddingの実装(local: ネットワーク不要のローカル実装 / openai)と次元数(未指定時は実装ごとの既定値)
+    EMBEDDING_BACKEND: str = Field(default="local", env="EMBEDDING_BACKEND")
+    EMBEDDING_DIM: Optional[int] = Field(default=None, env="EMBEDDING_DIM")
+    # LLMの呼び出し先(openai / stub: ローカルのスタブサーバー)と、モデル名・接続先URLの上書き(空は既定値)
+    LLM_PROVIDER: str = Field(default="openai", env="LLM_PROVIDER")
+    LLM_MODEL: str = Field(default="", env="LLM_MODEL")
+    LLM_BASE_URL: str = Field(default="", env="LLM_BASE_URL")
+    # LLM呼び出しの接続タイムアウト・読み取りタイムアウト(秒)、接続プールの上限、再試行回数
+    LLM_CONNECT_TIMEOUT: float = Field(default=5.0, env="LLM_CONNECT_TIMEOUT")
+    LLM_READ_TIMEOUT: float = Field(default=60.0, env="LLM_READ_TIMEOUT")
+    LLM_MAX_CONNECTIONS: int = Field(default=100, env="LLM_MAX_CONNECTIONS")
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = Field(default=20, env="LLM_MAX_KEEPALIVE_CONNECTIONS")
+    LLM_MAX_RETRIES: int = Field(default=3, env="LLM_MAX_RETRIES")
+    # LLM呼び出しの流量制御: 毎秒の呼び出し数の上限(0は無制限)とバースト数、同時実行数の範囲と
+    # 目標応答時間(秒、超えると同時実行数を減らす)、サーキットブレーカーを開く連続失敗数と開いておく秒数
+    LLM_RATE_LIMIT: float = Field(default=0.0, env="LLM_RATE_LIMIT")
+    LLM_RATE_BURST: Optional[float] = Field(default=None, env="LLM_RATE_BURST")
+    LLM_MIN_CONCURRENCY: int = Field(default=1, env="LLM_MIN_CONCURRENCY")
+    LLM_MAX_CONCURRENCY: int = Field(default=50, env="LLM_MAX_CONCURRENCY")
+    LLM_TARGET_LATENCY: float = Field(default=20.0, env="LLM_TARGET_LATENCY")
+    LLM_BREAKER_FAILURES: int = Field(default=5, env="LLM_BREAKER_FAILURES")
+    LLM_BREAKER_RESET_SECONDS: float = Field(default=30.0, env="LLM_BREAKER_RESET_SECONDS")
+    # 応答が遅いLLM呼び出しに同じ要求をもう1件送るか(ヘッジ要求)、送るまでの待ち時間とする
+    # 応答時間のパーセンタイル、追加の要求の上限(呼び出し件数に対する割合)、最短の待ち時間(秒)
+    LLM_HEDGE: bool = Field(default=False, env="LLM_HEDGE")
+    LLM_HEDGE_PERCENTILE: float = Field(default=95.0, env="LLM_HEDGE_PERCENTILE")
+    LLM_HEDGE_BUDGET: float = Field(default=0.05, env="LLM_HEDGE_BUDGET")
+    LLM_HEDGE_MIN_DELAY: float = Field(default=0.05, env="LLM_HEDGE_MIN_DELAY")
+    # /ai/generate の応答キャッシュ(メモリ上の最大件数と有効期限(秒)、DBにも保存するか、DB上の有効期限(秒))
+    LLM_CACHE_MAX_ENTRIES: int = Field(default=1024, env="LLM_CACHE_MAX_ENTRIES")
+    LLM_CACHE_TTL_SECONDS: float = Field(default=3600.0, env="LLM_CACHE_TTL_SECONDS")
+    LLM_CACHE_DB: bool = Field(default=True, env="LLM_CACHE_DB")
+    LLM_CACHE_DB_TTL_SECONDS: Optional[float] = Field(default=86400.0, env="LLM_CACHE_DB_TTL_SECONDS")
+    # RAGのプロンプトに入れる文書部分の推定トークン数の上限と、その候補として検索するチャンク数
+    RAG_CONTEXT_TOKENS: int = Field(default=1500, env="RAG_CONTEXT_TOKENS")
+    RAG_CONTEXT_CANDIDATES: int = Field(default=10, env="RAG_CONTEXT_CANDIDATES")
+    # 言い回しの違う同じ質問にRAGの回答を再利用する意味的キャッシュ
+    # (保持する質問数(0で無効)、再利用する質問のEmbeddingのコサイン類似度の下限、有効期限(秒))
+    # 類似度の下限を指定しない場合、意味の近さを表すEmbedding(openai)では0.92とし、文字n-gramのハッシュ(local)では
+    # 無効にする(ハッシュの類似度は共通する文字の量で決まり、言い換えた質問は低く、語の一部だけ違う別の質問は
+    # 高くなるため、どの下限でも同じ意味の質問だけを選べない)
+    RAG_SEMANTIC_CACHE_SIZE: int = Field(default=1000, env="RAG_SEMANTIC_CACHE_SIZE")
+    RAG_SEMANTIC_CACHE_THRESHOLD: Optional[float] = Field(default=None, env="RAG_SEMANTIC_CACHE_THRESHOLD")
+    RAG_SEMANTIC_CACHE_TTL_SECONDS: float = Field(default=3600.0, env="RAG_SEMANTIC_CACHE_TTL_SECONDS")
+    # /ai/generate_batch の同時実行数の上限と、1回に受け付けるプロンプト数の上限
+    LLM_BATCH_CONCURRENCY: int = Field(default=8, env="LLM_BATCH_CONCURRENCY")
+    LLM_BATCH_MAX_PROMPTS: int = Field(default=10000, env="LLM_BATCH_MAX_PROMPTS")
+    # AI呼び出しログのバックグラウンド一括保存(1回に保存する件数、最初の行から保存するまでの秒数、
+    # バッファの件数、バッファが満杯のときに空きを待つ秒数(過ぎると破棄して件数を数える))
+    CALL_LOG_BATCH_SIZE: int = Field(default=500, env="CALL_LOG_BATCH_SIZE")
+    CALL_LOG_FLUSH_INTERVAL: float = Field(default=1.0, env="CALL_LOG_FLUSH_INTERVAL")
+    CALL_LOG_BUFFER_SIZE: int = Field(default=10000, env="CALL_LOG_BUFFER_SIZE")
+    CALL_LOG_BLOCK_TIMEOUT: float = Field(default=0.05, env="CALL_LOG_BLOCK_TIMEOUT")
+    # リクエストログ(logs_schema.api_logs)の設定(記録するか、本文を記録するリクエストの割合と最大バイト数、
+    # 1回に保存する件数、最初の行から保存するまでの秒数、バッファの件数)
+    REQUEST_LOG_ENABLED: bool = Field(default=True, env="REQUEST_LOG_ENABLED")
+    REQUEST_LOG_BODY_SAMPLE_RATE: float = Field(default=0.0, env="REQUEST_LOG_BODY_SAMPLE_RATE")
+    REQUEST_LOG_BODY_MAX_BYTES: int = Field(default=1024, env="REQUEST_LOG_BODY_MAX_BYTES")
+    REQUEST_LOG_BATCH_SIZE: int = Field(default=500, env="REQUEST_LOG_BATCH_SIZE")
+    REQUEST_LOG_FLUSH_INTERVAL: float = Field(default=1.0, env="REQUEST_LOG_FLUSH_INTERVAL")
+    REQUEST_LOG_BUFFER_SIZE: int = Field(default=10000, env="REQUEST_LOG_BUFFER_SIZE")
+    # ログ表(ai_call_logs・api_logs)の月単位のパーティション(何か月先まで作成しておくか、保持する月数(今月を含む。
+    # 0は対象にしない)、保持期間を過ぎたパーティションを detach(切り離して通常の表として残す)/ drop(削除)のどちらにするか、
+    # 確認する間隔(時間))。drop は既存のログを起動時に完全に削除するため、退避を確認してから明示的に指定すること
+    LOG_PARTITION_MONTHS_AHEAD: int = Field(default=3, env="LOG_PARTITION_MONTHS_AHEAD")
+    AI_CALL_LOG_RETENTION_MONTHS: int = Field(default=12, env="AI_CALL_LOG_RETENTION_MONTHS")
+    API_LOG_RETENTION_MONTHS: int = Field(default=3, env="API_LOG_RETENTION_MONTHS")
+    LOG_PARTITION_RETENTION_MODE: str = Field(default="detach", env="LOG_PARTITION_RETENTION_MODE")
+    LOG_PARTITION_CHECK_HOURS: float = Field(default=24.0, env="LOG_PARTITION_CHECK_HOURS")
+    # 文書作成・更新時のバックグラウンド索引登録の設定
+    INDEX_WORKERS: int = Field(default=2, env="INDEX_WORKERS")
+    INDEX_QUEUE_SIZE: int = Field(default=1000, env="INDEX_QUEUE_SIZE")
+    INDEX_MAX_RETRIES: int = Field(default=3, env="INDEX_MAX_RETRIES")
 
     class Config:
         env_file = ".env"
@@ -1,22 +1,24 @@
 # .\hub-app\dbschemas\ai_schema.py
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, LargeBinary
 from sqlalchemy.schema import SchemaItem
 from datetime import datetime
 
 AISchemaBase = declarative_base()
 
+# created_at の月単位のレンジパーティション(パーティションは shared_libs.log_partitions で作成・削除する)。
+# 主キーにはパーティションキーを含める必要があるため (call_id, created_at) とする
 class AICallLogs(AISchemaBase):
     __tablename__ = "ai_call_logs"
-    __table_args__ = {"schema": "ai_schema"}
+    __table_args__ = {"schema": "ai_schema", "postgresql_partition_by": "RANGE (created_at)"}
 
     call_id = Column(Integer, primary_key=True, autoincrement=True)
     app_name = Column(String(100), nullable=False)
     user_id = Column(Integer, nullable=True)
     prompt = Column(Text, nullable=False)
     response = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
 
 class DocEmbedding(AISchemaBase):
     __tablename__ = "doc_embeddings"
@@ -24,5 +26,31 @@ class DocEmbedding(AISchemaBase):
 
     embedding_id = Column(Integer, primary_key=True, autoincrement=True)
     doc_ref = Column(String(100), nullable=False)
-    embedding_vector = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    embedding_vector = Column(Text, nullable=True)  # 旧形式(テキスト)。移行後は NULL
+    embedding_blob = Column(LargeBinary, nullable=True)  # リトルエンディアン float32 の連続バイト列
+    embedding_dim = Column(Integer, nullable=True)
+    embedding_model = Column(String(100), nullable=True)
+    chunk_start = Column(Integer, nullable=True)  # doc_ref の文書内でのチャンク開始位置(文字)
+    chunk_end = Column(Integer, nullable=True)  # チャンク終了位置(文字, 含まない)
+    content_hash = Column(LargeBinary, nullable=True)  # チャンク本文のSHA-256。ベクトルは chunk_vectors で共有
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChunkVector(AISchemaBase):
+    __tablename__ = "chunk_vectors"
+    __table_args__ = {"schema": "ai_schema"}
+
+    content_hash = Column(LargeBinary, primary_key=True)
+    embedding_model = Column(String(100), primary_key=True)
+    embedding_blob = Column(LargeBinary, nullable=False)
+    embedding_dim = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class LLMResponseCache(AISchemaBase):
+    __tablename__ = "llm_response_cache"
+    __table_args__ = {"schema": "ai_schema"}
+
+    cache_key = Column(LargeBinary, primary_key=True)  # (モデル, プロンプト, 生成パラメータ) のSHA-256
+    model = Column(String(100), nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
\ No newline at end of file
@@ -1,19 +1,23 @@
 # .\hub-app\dbschemas\logs_schema.py
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float
 from datetime import datetime
 
 LogsBase = declarative_base()
 
-# ログテーブルの例
+# APIリクエストのログ(shared_libs.request_logging のミドルウェアがまとめて書き込む)。
+# timestamp の月単位のレンジパーティションで、主キーは (id, timestamp)
 class APILog(LogsBase):
     __tablename__ = "api_logs"
-    __table_args__ = {"schema": "logs_schema"}
+    __table_args__ = {"schema": "logs_schema", "postgresql_partition_by": "RANGE (timestamp)"}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     endpoint = Column(String(100), nullable=False)
     method = Column(String(10), nullable=False)
-    request_body = Column(Text, nullable=True)
+    request_body = Column(Text, nullable=True)  # 抽出したリクエストだけ、先頭の一部を記録する
     response_status = Column(Integer, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    latency_ms = Column(Float, nullable=True)
+    request_size = Column(Integer, nullable=True)  # リクエスト本文のバイト数
+    app_name = Column(String(50), nullable=True)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
\ No newline at end of file
@@ -19,6 +19,14 @@ from routers.auth_router import router as auth_router
 from routers.authorize import router as authorize_router
 from routers.ai_router import router as ai_router
 from routers.doc_router import router as doc_router
+from shared_libs.ai_client import AIClient
+from shared_libs.rag_utils import RAGSearcher
+from shared_libs.embedding import get_embedder
+from shared_libs.llm_provider import get_provider
+from shared_libs.request_logging import RequestLoggingMiddleware, api_log_writer
+from shared_libs.log_partitions import PartitionedTable, PartitionMaintainer
+from services.doc_service import index_pipeline
+from services.ai_service import call_log_writer
 import logging
 
 # ロギングの設定
@@ -28,6 +36,9 @@ logger = logging.getLogger(__name__)
 # 環境変数の読み込み
 load_dotenv()
 
+# 設定(このモジュールのミドルウェア・起動時処理・OAuthはすべてこのインスタンスを使う)
+settings = Settings()
+
 # データベースのマイグレーション（必要に応じてコメントアウト）
 # Base.metadata.create_all(bind=engine)  # 既に database.py で実行済み
 
@@ -62,12 +73,110 @@ app.add_middleware(
 )
 logger.info("SessionMiddleware added successfully.")
 
+# リクエストログ(logs_schema.api_logs にバックグラウンドでまとめて保存する。応答は保存を待たない)
+api_logs = api_log_writer(
+    SessionLocal,
+    batch_size=settings.REQUEST_LOG_BATCH_SIZE,
+    flush_interval=settings.REQUEST_LOG_FLUSH_INTERVAL,
+    capacity=settings.REQUEST_LOG_BUFFER_SIZE,
+)
+if settings.REQUEST_LOG_ENABLED:
+    app.add_middleware(
+        RequestLoggingMiddleware,
+        writer=api_logs,
+        app_name="hub-app",
+        body_sample_rate=settings.REQUEST_LOG_BODY_SAMPLE_RATE,
+        max_body_bytes=settings.REQUEST_LOG_BODY_MAX_BYTES,
+    )
+
+# ログ表の月単位のパーティションを先に作成し、保持期間を過ぎたものを削除する(起動時と定期的に実行)
+log_partitions = PartitionMaintainer(
+    SessionLocal,
+    [
+        PartitionedTable("ai_schema", "ai_call_logs", settings.AI_CALL_LOG_RETENTION_MONTHS),
+        PartitionedTable("logs_schema", "api_logs", settings.API_LOG_RETENTION_MONTHS, key="timestamp"),
+    ],
+    months_ahead=settings.LOG_PARTITION_MONTHS_AHEAD,
+    mode=settings.LOG_PARTITION_RETENTION_MODE,
+    interval_seconds=settings.LOG_PARTITION_CHECK_HOURS * 3600,
+)
+
+# 起動時にRAG索引をDBから読み込む
+@app.on_event("startup")
+def load_rag_index():
+    AIClient.configure(
+        provider=get_provider(settings.LLM_PROVIDER, settings.LLM_MODEL or None, settings.LLM_BASE_URL or None),
+        connect_timeout=settings.LLM_CONNECT_TIMEOUT,
+        read_timeout=settings.LLM_READ_TIMEOUT,
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+        max_retries=settings.LLM_MAX_RETRIES,
+        rate_limit=settings.LLM_RATE_LIMIT,
+        rate_burst=settings.LLM_RATE_BURST,
+        min_concurrency=settings.LLM_MIN_CONCURRENCY,
+        max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        target_latency=settings.LLM_TARGET_LATENCY,
+        breaker_failures=settings.LLM_BREAKER_FAILURES,
+        breaker_reset_seconds=settings.LLM_BREAKER_RESET_SECONDS,
+        hedge=settings.LLM_HEDGE,
+        hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+        hedge_budget=settings.LLM_HEDGE_BUDGET,
+        hedge_min_delay=settings.LLM_HEDGE_MIN_DELAY,
+    )
+    db = SessionLocal()
+    try:
+        embedder = get_embedder(settings.EMBEDDING_BACKEND, settings.EMBEDDING_DIM)
+        RAGSearcher.configure(
+            embedder=embedder,
+            fusion=settings.RAG_FUSION,
+            fusion_alpha=settings.RAG_FUSION_ALPHA,
+            quantization=settings.RAG_QUANTIZATION,
+            pq_subvectors=settings.RAG_PQ_SUBVECTORS,
+            rerank_factor=settings.RAG_RERANK_FACTOR,
+            shards=settings.RAG_SHARDS,
+            compact_ratio=settings.RAG_COMPACT_RATIO,
+        )
+        RAGSearcher.load_metadata(db)
+        RAGSearcher.load_index(
+            db,
+            model=embedder.model_name,
+            ann_path=settings.RAG_INDEX_PATH or None,
+            n_lists=settings.RAG_IVF_LISTS,
+            n_probe=settings.RAG_IVF_PROBE,
+            lexical=settings.RAG_FUSION != "vector",
+        )
+    except Exception as e:
+        logger.error(f"RAG索引の読み込みに失敗しました: {e}")
+    finally:
+        db.close()
+    index_pipeline.start()
+    call_log_writer.start()
+    api_logs.start()
+    log_partitions.start()
+
+# 停止時は受付済みの索引登録を処理してからワーカーを止める
+@app.on_event("shutdown")
+def stop_index_pipeline():
+    index_pipeline.stop(timeout=30)
+    RAGSearcher.close()
+
+# 停止時にLLM呼び出し用の接続プールを閉じる
+@app.on_event("shutdown")
+async def close_ai_client():
+    await AIClient.aclose()
+
+# 停止時はバッファに残った呼び出しログ・リクエストログを保存してから書き込みスレッドを止める
+@app.on_event("shutdown")
+def stop_log_writers():
+    call_log_writer.stop(timeout=30)
+    api_logs.stop(timeout=30)
+    log_partitions.stop(timeout=5)
+
 # OAuth2PasswordBearer を使用してトークンの取得を管理
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
 # Authlib OAuth クライアントの設定
 oauth = AuthlibOAuth()
-settings = auth.Settings()  # Settingsクラスのインスタンス化を確認
 oauth.register(
     name='hubapp',
     client_id=settings.CLIENT_ID,
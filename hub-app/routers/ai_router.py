@@ -1,37 +1,141 @@
 # .\hub-app\routers\ai_router.py
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from services.ai_service import AIService
+from typing import AsyncIterator, List, Optional, Tuple
+from shared_libs.ai_client import AIClient
+from services.ai_service import (
+    AIService, call_log_writer, context_packer, in_flight, response_cache, semantic_cache, settings,
+)
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
+import json
 import logging
 
 router = APIRouter(prefix="/ai", tags=["AI"])
 
+# プロキシ(nginx など)でバッファリングされないようにする
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event: str, data) -> str:
+    """Server-Sent Events の1イベント分の文字列を作る。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def sse_stream(events: AsyncIterator[Tuple[str, object]]) -> AsyncIterator[str]:
+    """
+    (イベント名, データ) をSSEとして送り、最後に done を送る。
+    送信開始後はステータスコードを変えられないため、失敗は error イベントで伝える。
+    """
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+        yield sse_event("done", {})
+    except Exception as e:
+        logging.error(f"Error in sse_stream: {e}")
+        yield sse_event("error", {"detail": "Streaming failed."})
+
 class GenerateReq(BaseModel):
     prompt: str
+    # False の場合は応答キャッシュを使わずにLLMを呼び出す(得られた応答でキャッシュは更新する)
+    use_cache: bool = True
+
+class BatchGenerateReq(BaseModel):
+    prompts: List[str]
+    use_cache: bool = True
+    # 同時実行数(未指定時・上限超過時は設定の LLM_BATCH_CONCURRENCY)
+    concurrency: Optional[int] = None
 
 @router.post("/generate", response_model=dict)
-def generate_text(req: GenerateReq, db: Session = Depends(SessionLocal)):
+async def generate_text(req: GenerateReq, db: Session = Depends(SessionLocal)):
     """
     テキストを生成するエンドポイント
     """
     try:
-        generated_text = AIService.generate_text(req.prompt, db)
+        generated_text = await AIService.generate_text(req.prompt, db, use_cache=req.use_cache)
         return {"generated_text": generated_text}
     except Exception as e:
         logging.error(f"Error in generate_text: {e}")
         raise HTTPException(status_code=500, detail="Text generation failed.")
 
+@router.post("/generate_batch")
+async def generate_batch(req: BatchGenerateReq, db: Session = Depends(SessionLocal)):
+    """
+    複数のプロンプトを並行に生成し、完了した順に1行1件のNDJSON
+    ({"index": 入力での位置, "generated_text": 応答, "cached": 真偽値})で返すエンドポイント
+    """
+    if not req.prompts:
+        raise HTTPException(status_code=400, detail="prompts is empty.")
+    if len(req.prompts) > settings.LLM_BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"Too many prompts (max {settings.LLM_BATCH_MAX_PROMPTS}).")
+    concurrency = min(max(req.concurrency or settings.LLM_BATCH_CONCURRENCY, 1), settings.LLM_BATCH_CONCURRENCY)
+
+    async def lines() -> AsyncIterator[str]:
+        try:
+            async for result in AIService.generate_batch(req.prompts, db, concurrency, use_cache=req.use_cache):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception as e:
+            logging.error(f"Error in generate_batch: {e}")
+            yield json.dumps({"error": "Batch generation failed."}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @router.get("/rag_search", response_model=dict)
-def rag_search(query: str, db: Session = Depends(SessionLocal)):
+async def rag_search(
+    query: str,
+    tag: Optional[List[str]] = Query(None),
+    owner_id: Optional[int] = None,
+    app: Optional[str] = None,
+    db: Session = Depends(SessionLocal),
+):
     """
     RAG検索を行い、回答を返すエンドポイント
+    tag(複数指定可、すべてのタグを持つ文書)・owner_id・app(hub-app / user-app-docs)で検索対象を絞り込める。
     """
     try:
-        answer = AIService.rag_search_and_answer(query, db)
-        return {"answer": answer}
+        return await AIService.rag_search_and_answer(query, db, tags=tag, owner_id=owner_id, app=app)
     except Exception as e:
         logging.error(f"Error in rag_search: {e}")
-        raise HTTPException(status_code=500, detail="RAG search failed.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="RAG search failed.")
+
+@router.post("/generate/stream")
+async def generate_text_stream(req: GenerateReq, db: Session = Depends(SessionLocal)):
+    """
+    テキストを生成し、生成された断片を順に token イベント({"text": 断片})として送るSSEエンドポイント
+    """
+    tokens = AIService.stream_text(req.prompt, db, use_cache=req.use_cache)
+    events = (("token", {"text": token}) async for token in tokens)
+    return StreamingResponse(sse_stream(events), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.get("/rag_search/stream")
+async def rag_search_stream(
+    query: str,
+    tag: Optional[List[str]] = Query(None),
+    owner_id: Optional[int] = None,
+    app: Optional[str] = None,
+    db: Session = Depends(SessionLocal),
+):
+    """
+    RAG検索を行い、引用元を sources イベントで送ってから、回答の断片を token イベントで順に送るSSEエンドポイント
+    """
+    answer = AIService.stream_rag_answer(query, db, tags=tag, owner_id=owner_id, app=app)
+    events = ((event, {"text": data} if event == "token" else data) async for event, data in answer)
+    return StreamingResponse(sse_stream(events), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.get("/cache_stats", response_model=dict)
+def cache_stats():
+    """
+    /ai/generate の応答キャッシュのヒット・ミス件数などと、同時要求をまとめた件数、
+    RAGのコンテキストで削減したトークン数、RAG回答の意味的キャッシュのヒット件数などを返すエンドポイント
+    """
+    return {**response_cache.stats(), "single_flight": in_flight.stats(), "rag_context": context_packer.stats(),
+            "semantic_cache": semantic_cache.stats()}
+
+@router.get("/llm_stats", response_model=dict)
+def llm_stats():
+    """
+    LLM呼び出しの流量制御(トークンバケット・同時実行数の上限・サーキットブレーカー)の状態と件数、
+    ヘッジ要求を送った件数と、そのうちヘッジ側が先に応答した件数、
+    呼び出しログの保存待ち・保存済み・破棄した件数を返すエンドポイント
+    """
+    return {**AIClient.stats(), "call_log": call_log_writer.stats()}
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
+from typing import Optional
 from services.doc_service import DocService
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
@@ -16,6 +17,10 @@ class DocCreate(BaseModel):
     title: str
     content: str
 
+class DocUpdate(BaseModel):
+    title: Optional[str] = None
+    content: Optional[str] = None
+
 @router.post("/create", response_model=dict)
 def create_document(doc: DocCreate, db: Session = Depends(SessionLocal)):
     try:
@@ -25,6 +30,40 @@ def create_document(doc: DocCreate, db: Session = Depends(SessionLocal)):
         logging.error(f"Error creating document: {e}")
         raise HTTPException(status_code=500, detail="Document creation failed.")
 
+@router.put("/update/{doc_id}", response_model=dict)
+def update_document(doc_id: int, doc: DocUpdate, db: Session = Depends(SessionLocal)):
+    try:
+        updated = DocService.update_document(db, doc_id, doc.title, doc.content)
+    except Exception as e:
+        logging.error(f"Error updating document: {e}")
+        raise HTTPException(status_code=500, detail="Document update failed.")
+    if not updated:
+        raise HTTPException(status_code=404, detail="Document not found.")
+    return {"doc_id": doc_id}
+
+@router.post("/local/{doc_id}/index", response_model=dict)
+def index_local_document(doc_id: int):
+    # user-app-docs のローカル文書の本文が変わったときに、索引への再登録を要求する
+    queued = DocService.request_local_index(doc_id)
+    if not queued:
+        raise HTTPException(status_code=503, detail="Index queue is full.")
+    return {"doc_id": doc_id, "queued": queued}
+
+@router.post("/local/{doc_id}/metadata", response_model=dict)
+def refresh_local_metadata(doc_id: int, db: Session = Depends(SessionLocal)):
+    # user-app-docs でタグ・所有者が変わったときに、RAG検索の絞り込み条件へ反映する
+    try:
+        found = DocService.refresh_local_metadata(db, doc_id)
+    except Exception as e:
+        logging.error(f"Error refreshing local document metadata: {e}")
+        raise HTTPException(status_code=500, detail="Metadata refresh failed.")
+    return {"doc_id": doc_id, "found": found}
+
+@router.get("/index_status", response_model=dict)
+def index_status():
+    # バックグラウンド索引登録の滞留件数と遅延
+    return DocService.index_status()
+
 @router.get("/list", response_model=list)
 def list_documents(db: Session = Depends(SessionLocal)):
     try:
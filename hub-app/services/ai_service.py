@@ -1,53 +1,350 @@
 # .\hub-app\services\ai_service.py
 
 from shared_libs.ai_client import AIClient
+from shared_libs.batch_writer import BatchWriter
+from shared_libs.context_packer import ContextPacker, PackedContext
+from shared_libs.embedding import get_embedder
+from shared_libs.llm_cache import LLMResponseCache, cache_key
 from shared_libs.rag_utils import RAGSearcher
-from sqlalchemy.orm import Session
+from shared_libs.semantic_cache import DEFAULT_THRESHOLD, SemanticCache
+from shared_libs.single_flight import SingleFlight, normalize_query
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session, sessionmaker
 from dbschemas.ai_schema import AICallLogs
 from dbschemas.docs_schema import Document
+from config import Settings
 from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import logging
 
+settings = Settings()
+
+engine = create_engine(settings.DATABASE_URL, future=True, pool_pre_ping=True)
+SessionLocal = sessionmaker(bind=engine, future=True)
+
+# /ai/generate の応答キャッシュ(メモリ上のLRU + ai_schema.llm_response_cache)
+response_cache = LLMResponseCache(
+    max_entries=settings.LLM_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS,
+    use_db=settings.LLM_CACHE_DB,
+    db_ttl_seconds=settings.LLM_CACHE_DB_TTL_SECONDS,
+)
+
+# 同じ内容で同時に来たLLM呼び出し・RAG検索を1回の実行にまとめる
+in_flight = SingleFlight()
+
+# RAGのプロンプトに入れるチャンクを推定トークン数の予算内で選ぶ
+context_packer = ContextPacker(budget_tokens=settings.RAG_CONTEXT_TOKENS)
+
+# 質問のEmbeddingが近い過去の質問のRAG回答を再利用する。引用した文書が変わった回答は捨てる
+# 類似度の下限を指定しない場合、意味の近さを表さないEmbedding(local)では言い換えに当たらないため無効にする
+semantic_cache_size = settings.RAG_SEMANTIC_CACHE_SIZE
+if settings.RAG_SEMANTIC_CACHE_THRESHOLD is None and semantic_cache_size > 0 \
+        and not get_embedder(settings.EMBEDDING_BACKEND, settings.EMBEDDING_DIM).semantic:
+    logging.info(f"Embedding({settings.EMBEDDING_BACKEND})が意味の近さを表さないため、意味的キャッシュを無効にします。")
+    semantic_cache_size = 0
+semantic_cache = SemanticCache(
+    max_entries=semantic_cache_size,
+    threshold=DEFAULT_THRESHOLD if settings.RAG_SEMANTIC_CACHE_THRESHOLD is None
+    else settings.RAG_SEMANTIC_CACHE_THRESHOLD,
+    ttl_seconds=settings.RAG_SEMANTIC_CACHE_TTL_SECONDS,
+)
+RAGSearcher.add_change_listener(lambda doc_ref: semantic_cache.invalidate_docs([doc_ref]))
+
+# 一括生成で呼び出しログをまとめて保存する件数
+BATCH_LOG_SIZE = 100
+
+def write_call_logs(rows: List[dict]) -> None:
+    """呼び出しログを1回の複数行INSERTで ai_schema.ai_call_logs に保存する(書き込みスレッドから呼ばれる)。"""
+    db = SessionLocal()
+    try:
+        db.execute(insert(AICallLogs.__table__).values(rows))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
+# 呼び出しログはバッファにため、バックグラウンドでまとめて保存する(起動・停止は main.py のイベントで行う)
+call_log_writer = BatchWriter(
+    write_call_logs,
+    batch_size=settings.CALL_LOG_BATCH_SIZE,
+    flush_interval=settings.CALL_LOG_FLUSH_INTERVAL,
+    capacity=settings.CALL_LOG_BUFFER_SIZE,
+    block_timeout=settings.CALL_LOG_BLOCK_TIMEOUT,
+    name="ai-call-log",
+)
+
 class AIService:
     @staticmethod
-    def generate_text(prompt: str, db: Session) -> str:
+    def to_sources(hits) -> list:
+        """検索結果を回答に添える引用元の形式に変換する。番号はプロンプト内の[番号]と対応する。"""
+        return [
+            {
+                "ref": i,
+                "chunk_id": hit.chunk_id,
+                "doc_ref": hit.doc_ref,
+                "start": hit.start,
+                "end": hit.end,
+                "score": hit.score,
+            }
+            for i, hit in enumerate(hits, start=1)
+        ]
+
+    @staticmethod
+    def retrieve_context(query: str, tags: Optional[List[str]] = None, owner_id: Optional[int] = None,
+                         app: Optional[str] = None, query_vector: Optional[np.ndarray] = None) -> PackedContext:
+        """
+        RAG_CONTEXT_CANDIDATES 件を検索し、重複を除いてトークン予算に収まるチャンクを選ぶ。
+        索引の検索を含む同期処理のため、非同期処理からはスレッドプールで呼び出す。
+        """
+        hits = RAGSearcher.search_docs(query, top_k=settings.RAG_CONTEXT_CANDIDATES,
+                                       tags=tags, owner_id=owner_id, app=app, query_vector=query_vector)
+        packed = context_packer.pack(hits)
+        logging.info(f"RAGコンテキスト: {len(packed.hits)}/{len(hits)} チャンク, "
+                     f"{packed.tokens} トークン(削減 {packed.saved_tokens} トークン)")
+        return packed
+
+    @staticmethod
+    def build_rag_prompt(query: str, hits) -> str:
+        combined = "\n".join(f"[{i}] {hit.text}" for i, hit in enumerate(hits, start=1))
+        return f"以下の文書を参考に質問に回答(根拠は[番号]で示す):\n{combined}\n質問:{query}"
+
+    @staticmethod
+    async def save_call_log(db: Session, prompt: str, response: str, key: Optional[bytes] = None) -> None:
+        """呼び出しログを保存する。key を指定した場合は応答キャッシュにも保存する。"""
+        await AIService.save_call_logs(db, [(prompt, response, key)])
+
+    @staticmethod
+    async def save_call_logs(db: Session, entries: List[Tuple[str, str, Optional[bytes]]]) -> None:
+        """
+        (プロンプト, 応答, キャッシュのキー) の一覧を保存する。呼び出しログは call_log_writer のバッファに
+        入れるだけで、DBへの書き込みを待たない。キャッシュのキーがある成功応答だけを、
+        スレッドプールで応答キャッシュに一括で保存する。
+        """
+        now = datetime.utcnow()
+        for prompt, response, _ in entries:
+            await call_log_writer.asubmit({
+                "app_name": "AIService",
+                "user_id": None,  # 必要に応じてユーザーIDを設定
+                "prompt": prompt,
+                "response": response,
+                "created_at": now,
+            })
+        cacheable = [(key, response) for _, response, key in entries
+                     if key is not None and not AIClient.is_error(response)]
+        if cacheable:
+            await run_in_threadpool(AIService.cache_responses, db, cacheable)
+
+    @staticmethod
+    def cache_responses(db: Session, entries: List[Tuple[bytes, str]]) -> None:
+        """(キャッシュのキー, 応答) の一覧を応答キャッシュに一括で保存し、1回だけコミットする。"""
         try:
-            generated_text = AIClient.call_llm(prompt)
-            # ログを保存
-            log = AICallLogs(
-                app_name="AIService",
-                user_id=None,  # 必要に応じてユーザーIDを設定
-                prompt=prompt,
-                response=generated_text,
-                created_at=datetime.utcnow()
-            )
-            db.add(log)
+            response_cache.put_many(db, AIClient.model_name(), entries)
             db.commit()
-            return generated_text
+        except Exception as e:
+            db.rollback()
+            raise e
+
+    @staticmethod
+    async def cached_response(db: Session, key: bytes) -> Optional[str]:
+        """応答キャッシュを調べる。メモリになければDBをスレッドプールで調べる。"""
+        cached = response_cache.get_memory(key)
+        if cached is None:
+            cached = await run_in_threadpool(response_cache.get_db, db, key)
+        return cached
+
+    @staticmethod
+    async def generate_text(prompt: str, db: Session, use_cache: bool = True) -> str:
+        """
+        LLMの応答を待つ間はイベントループに制御を返し、スレッドプールを占有しない。
+        応答キャッシュのDB書き込みだけをスレッドプールで実行し、呼び出しログの保存は待たない。
+        同じ(モデル, プロンプト, 生成パラメータ)の応答がキャッシュにあればLLMを呼ばずに返す。
+        use_cache=False の場合はキャッシュを読まずにLLMを呼び、その応答でキャッシュを更新する。
+        同じキーのLLM呼び出しが実行中であれば、新たに呼ばずにその結果を待つ。
+        """
+        try:
+            key = cache_key(AIClient.model_name(), prompt, AIClient.params())
+            if response_cache.enabled and use_cache:
+                cached = await AIService.cached_response(db, key)
+                if cached is not None:
+                    return cached
+
+            async def call() -> str:
+                # 先頭の要求が切断されても後続の要求のために実行を続けるため、要求ごとのセッションは使わない
+                shared_db = SessionLocal()
+                try:
+                    generated_text = await AIClient.acall_llm(prompt)
+                    if AIClient.is_error(generated_text) and response_cache.enabled and not use_cache:
+                        # キャッシュを使わない指定でも、LLMを呼べない間は古い応答があればそれを返す
+                        cached = await AIService.cached_response(shared_db, key)
+                        if cached is not None:
+                            return cached
+                    # ログを保存
+                    await AIService.save_call_log(shared_db, prompt, generated_text,
+                                                  key if response_cache.enabled else None)
+                    return generated_text
+                finally:
+                    await run_in_threadpool(shared_db.close)
+
+            return await in_flight.do(("generate", key), call)
         except Exception as e:
             logging.error(f"Error in generate_text: {e}")
             raise e
 
     @staticmethod
-    def rag_search_and_answer(query: str, db: Session) -> str:
+    async def generate_batch(prompts: List[str], db: Session, concurrency: int,
+                             use_cache: bool = True) -> AsyncIterator[dict]:
+        """
+        複数のプロンプトを同時実行数 concurrency までで並行に生成し、完了した順に
+        {"index": 入力での位置, "generated_text": 応答, "cached": キャッシュの応答か} を返す。
+        同じプロンプトはLLMを1回だけ呼ぶ。キャッシュはまとめて1回で調べ、
+        呼び出しログは BATCH_LOG_SIZE 件ごと(と最後)に一括で保存する。
+        """
+        indexes: Dict[str, List[int]] = {}
+        for index, prompt in enumerate(prompts):
+            indexes.setdefault(prompt, []).append(index)
+        keys = {prompt: cache_key(AIClient.model_name(), prompt, AIClient.params()) for prompt in indexes}
+        cached: Dict[bytes, str] = {}
+        if response_cache.enabled and use_cache:
+            cached = await run_in_threadpool(response_cache.get_many, db, keys.values())
+        for prompt, key in keys.items():
+            if key in cached:
+                for index in indexes[prompt]:
+                    yield {"index": index, "generated_text": cached[key], "cached": True}
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def generate(prompt: str) -> Tuple[str, str]:
+            async with semaphore:
+                return prompt, await AIClient.acall_llm(prompt)
+
+        tasks = [asyncio.ensure_future(generate(prompt)) for prompt, key in keys.items() if key not in cached]
+        pending_logs: List[Tuple[str, str, Optional[bytes]]] = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                prompt, generated_text = await next_done
+                pending_logs.append((prompt, generated_text, keys[prompt] if response_cache.enabled else None))
+                if len(pending_logs) >= BATCH_LOG_SIZE:
+                    # ログを保存
+                    await AIService.save_call_logs(db, pending_logs)
+                    pending_logs = []
+                for index in indexes[prompt]:
+                    yield {"index": index, "generated_text": generated_text, "cached": False}
+        finally:
+            # 途中で切断された場合も、完了済みの呼び出しのログは保存する
+            for task in tasks:
+                task.cancel()
+            if pending_logs:
+                try:
+                    await AIService.save_call_logs(db, pending_logs)
+                except Exception as e:
+                    logging.error(f"Error in generate_batch: {e}")
+
+    @staticmethod
+    async def rag_search_and_answer(query: str, db: Session, tags: Optional[List[str]] = None,
+                                    owner_id: Optional[int] = None, app: Optional[str] = None) -> dict:
+        """
+        RAG検索の結果を根拠として回答を生成し、回答と引用元(文書参照と文字範囲)を返す。
+        tags / owner_id / app を指定した場合は、条件に合う文書だけを検索対象にする。
+        索引の検索(CPU処理)はスレッドプールで、LLM呼び出しは非同期に実行する。
+        呼び出しログはバックグラウンドでまとめて保存するため、DBへの書き込みを待たない。
+        正規化した質問と絞り込み条件が同じ要求が実行中であれば、検索もLLM呼び出しもせずにその結果を待つ。
+        絞り込み条件が同じで質問のEmbeddingが十分近い過去の回答があれば、それを返す
+        (回答に "semantic_cache": {"query": 元の質問, "similarity": 類似度} を添える)。
+        """
+        scope = (tuple(sorted(set(tags or []))), owner_id, app)
+        query_vector = None
+        generation = semantic_cache.generation()
+        if semantic_cache.enabled:
+            query_vector = await run_in_threadpool(RAGSearcher.embed_query, query)
+            if query_vector is not None:
+                hit = semantic_cache.lookup(query_vector, scope)
+                if hit is not None:
+                    return {**hit.answer,
+                            "semantic_cache": {"query": hit.query, "similarity": round(hit.similarity, 4)}}
+
+        async def answer() -> dict:
+            # generate_text と同じく、後続の要求と共有する処理は専用のセッションで行う
+            shared_db = SessionLocal()
+            try:
+                result = await AIService.answer_from_docs(query, shared_db, tags=tags, owner_id=owner_id,
+                                                          app=app, query_vector=query_vector)
+            finally:
+                await run_in_threadpool(shared_db.close)
+            if query_vector is not None and result["sources"] and not AIClient.is_error(result["answer"]):
+                doc_refs = {source["doc_ref"] for source in result["sources"]}
+                semantic_cache.store(query, query_vector, dict(result), doc_refs, scope, generation=generation)
+            return result
+
+        return await in_flight.do(("rag", normalize_query(query), *scope), answer)
+
+    @staticmethod
+    async def answer_from_docs(query: str, db: Session, tags: Optional[List[str]] = None,
+                               owner_id: Optional[int] = None, app: Optional[str] = None,
+                               query_vector: Optional[np.ndarray] = None) -> dict:
+        """rag_search_and_answer の本体(検索・プロンプト作成・LLM呼び出し・ログ保存)。"""
         try:
-            docs = RAGSearcher.search_docs(query)
-            if not docs:
-                return "No relevant docs found"
-            combined = "\n".join(docs)
-            prompt = f"以下の文書を参考に質問に回答:\n{combined}\n質問:{query}"
-            generated_answer = AIClient.call_llm(prompt)
+            context = await run_in_threadpool(AIService.retrieve_context, query, tags, owner_id, app,
+                                              query_vector)
+            hits = context.hits
+            if not hits:
+                return {"answer": "No relevant docs found", "sources": []}
+            prompt = AIService.build_rag_prompt(query, hits)
+            generated_answer = await AIClient.acall_llm(prompt)
             # ログを保存
-            log = AICallLogs(
-                app_name="AIService",
-                user_id=None,  # 必要に応じてユーザーIDを設定
-                prompt=prompt,
-                response=generated_answer,
-                created_at=datetime.utcnow()
-            )
-            db.add(log)
-            db.commit()
-            return generated_answer
+            await AIService.save_call_log(db, prompt, generated_answer)
+            return {
+                "answer": generated_answer,
+                "sources": AIService.to_sources(hits),
+                "context": {"tokens": context.tokens, "saved_tokens": context.saved_tokens,
+                            "dropped_chunks": context.dropped},
+            }
         except Exception as e:
             logging.error(f"Error in rag_search_and_answer: {e}")
-            raise e
\ No newline at end of file
+            raise e
+
+    @staticmethod
+    async def stream_text(prompt: str, db: Session, use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        generate_text のストリーミング版。LLMの応答を断片ごとにそのまま返す。
+        キャッシュにあればその応答を1つの断片として返す。ログとキャッシュは応答の完了後に保存する。
+        """
+        key = cache_key(AIClient.model_name(), prompt, AIClient.params())
+        if response_cache.enabled and use_cache:
+            cached = await AIService.cached_response(db, key)
+            if cached is not None:
+                yield cached
+                return
+        parts = []
+        async for token in AIClient.astream_llm(prompt):
+            parts.append(token)
+            yield token
+        # ログを保存
+        await AIService.save_call_log(db, prompt, "".join(parts), key if response_cache.enabled else None)
+
+    @staticmethod
+    async def stream_rag_answer(query: str, db: Session, tags: Optional[List[str]] = None,
+                                owner_id: Optional[int] = None,
+                                app: Optional[str] = None) -> AsyncIterator[Tuple[str, object]]:
+        """
+        rag_search_and_answer のストリーミング版。(イベント名, データ) を順に返す。
+        最初に引用元("sources")を返し、続いて回答の断片("token")を生成された順に返す。
+        """
+        context = await run_in_threadpool(AIService.retrieve_context, query, tags, owner_id, app)
+        hits = context.hits
+        yield "sources", AIService.to_sources(hits)
+        if not hits:
+            yield "token", "No relevant docs found"
+            return
+        prompt = AIService.build_rag_prompt(query, hits)
+        parts = []
+        async for token in AIClient.astream_llm(prompt):
+            parts.append(token)
+            yield "token", token
+        # ログを保存
+        await AIService.save_call_log(db, prompt, "".join(parts))
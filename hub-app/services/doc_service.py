@@ -1,9 +1,13 @@
 # .\hub-app\services\doc_service.py
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, Session
 from dbschemas.docs_schema import BaseDocs, Document
 from config import Settings
+from shared_libs.rag_utils import HUB_DOCS_SOURCE, LOCAL_DOCS_SOURCE, RAGSearcher
+from shared_libs.index_pipeline import IndexingPipeline
+from typing import Optional, Tuple
+from datetime import datetime
 import logging
 
 settings = Settings()
@@ -11,6 +15,9 @@ settings = Settings()
 engine = create_engine(settings.DATABASE_URL, future=True, pool_pre_ping=True)
 SessionLocal = sessionmaker(bind=engine, future=True)
 
+# user-app-docs のローカル文書(有効なもののみ)の本文
+LOCAL_DOC_SQL = text("SELECT content FROM doc_app.local_docs WHERE id = :doc_id AND is_active = 1")
+
 class DocService:
     @staticmethod
     def create_document(db: Session, title: str, content: str) -> int:
@@ -19,11 +26,106 @@ class DocService:
             db.add(doc)
             db.commit()
             db.refresh(doc)
-            return doc.id
         except Exception as e:
             logging.error(f"Error in create_document: {e}")
             db.rollback()
             raise e
+        # 索引登録はバックグラウンドで行い、作成のレスポンスを待たせない
+        index_pipeline.submit((HUB_DOCS_SOURCE, doc.id))
+        return doc.id
+
+    @staticmethod
+    def update_document(db: Session, doc_id: int, title: Optional[str] = None,
+                        content: Optional[str] = None) -> bool:
+        """
+        文書のタイトル・本文を更新する。文書が存在しない場合は False を返す。
+        本文が変わった場合は索引の再登録を要求する。
+        """
+        try:
+            doc = db.get(Document, doc_id)
+            if doc is None:
+                return False
+            content_changed = content is not None and content != doc.content
+            if title is not None:
+                doc.title = title
+            if content is not None:
+                doc.content = content
+            db.commit()
+        except Exception as e:
+            logging.error(f"Error in update_document: {e}")
+            db.rollback()
+            raise e
+        if content_changed:
+            index_pipeline.submit((HUB_DOCS_SOURCE, doc_id))
+        return True
+
+    @staticmethod
+    def request_local_index(doc_id: int) -> bool:
+        """
+        user-app-docs のローカル文書(doc_app.local_docs)の索引登録を要求する。
+        本文・タグ・所有者はワーカーが処理時点の内容をDBから読み直す。
+        """
+        return index_pipeline.submit((LOCAL_DOCS_SOURCE, doc_id))
+
+    @staticmethod
+    def refresh_local_metadata(db: Session, doc_id: int) -> bool:
+        """
+        ローカル文書のタグ・所有者をDBから読み直し、RAG検索の絞り込み条件に反映する
+        (本文は変わらないため再索引はしない)。文書が存在しない場合は False を返す。
+        """
+        try:
+            return RAGSearcher.load_metadata(db, [doc_id]) > 0
+        except Exception as e:
+            logging.error(f"Error in refresh_local_metadata: {e}")
+            db.rollback()
+            raise e
+
+    @staticmethod
+    def run_index_job(key: Tuple[str, int]) -> int:
+        """索引登録パイプラインのワーカーから (文書の元テーブル, 文書ID) を受け取り、元テーブルに応じて登録する。"""
+        source, doc_id = key
+        if source == LOCAL_DOCS_SOURCE:
+            return DocService.index_local_document_by_id(doc_id)
+        return DocService.index_document_by_id(doc_id)
+
+    @staticmethod
+    def index_document_by_id(doc_id: int) -> int:
+        """
+        バックグラウンドのワーカーから呼ばれ、文書の最新の本文を読み直して索引に登録する。
+        文書が削除されている場合は索引からも取り除く。例外は再試行のため呼び出し元に送出する。
+        """
+        db = SessionLocal()
+        try:
+            doc = db.get(Document, doc_id)
+            if doc is None:
+                RAGSearcher.delete_document(RAGSearcher.doc_ref_for(doc_id), db)
+                return 0
+            return RAGSearcher.index_document(doc.id, doc.content, db)
+        finally:
+            db.close()
+
+    @staticmethod
+    def index_local_document_by_id(doc_id: int) -> int:
+        """
+        ローカル文書のタグ・所有者と本文を読み直して索引に登録する。
+        文書が削除・無効化されている場合は索引とEmbeddingからも取り除く。
+        """
+        db = SessionLocal()
+        try:
+            RAGSearcher.load_metadata(db, [doc_id])
+            row = db.execute(LOCAL_DOC_SQL, {"doc_id": doc_id}).first()
+            doc_ref = RAGSearcher.doc_ref_for(doc_id, LOCAL_DOCS_SOURCE)
+            if row is None:
+                RAGSearcher.delete_document(doc_ref, db)
+                return 0
+            return RAGSearcher.index_document(doc_id, row[0], db, source=LOCAL_DOCS_SOURCE)
+        finally:
+            db.close()
+
+    @staticmethod
+    def index_status() -> dict:
+        # embedding: 索引登録したチャンクのうちEmbedding化した件数と、保存済みのベクトルを再利用した件数
+        return {**index_pipeline.status(), "embedding": dict(RAGSearcher.embed_stats)}
 
     @staticmethod
     def list_documents(db: Session) -> list:
@@ -32,4 +134,14 @@ class DocService:
             return [{"id": d.id, "title": d.title, "created_at": d.created_at} for d in docs]
         except Exception as e:
             logging.error(f"Error in list_documents: {e}")
-            raise e
\ No newline at end of file
+            raise e
+
+# 文書の索引登録を行うバックグラウンドパイプライン(起動・停止は main.py のイベントで行う)
+# キーは (文書の元テーブル, 文書ID)
+index_pipeline = IndexingPipeline(
+    DocService.run_index_job,
+    workers=settings.INDEX_WORKERS,
+    max_queue_size=settings.INDEX_QUEUE_SIZE,
+    max_retries=settings.INDEX_MAX_RETRIES,
+    name="doc-index",
+)
@@ -1,5 +1,6 @@
 # .\hub-app\tests\test_ai.py
 
+import json
 from fastapi.testclient import TestClient
 from hubapp.main import app
 import pytest
@@ -45,7 +46,10 @@ def test_generate_text(client, test_db, monkeypatch):
         assert prompt == "Hello"
         return "Mocked LLM response"
 
-    monkeypatch.setattr(AIService, "generate_text", lambda p, db: mock_call_llm(p))
+    async def mock_generate_text(prompt, db, use_cache=True):
+        return mock_call_llm(prompt)
+
+    monkeypatch.setattr(AIService, "generate_text", mock_generate_text)
 
     resp = client.post("/ai/generate", json={"prompt": "Hello"})
     assert resp.status_code == 200
@@ -53,13 +57,51 @@ def test_generate_text(client, test_db, monkeypatch):
     assert data["generated_text"] == "Mocked LLM response"
 
 def test_rag_search(client, test_db, monkeypatch):
-    def mock_rag_search_and_answer(query, db):
+    async def mock_rag_search_and_answer(query, db, tags=None, owner_id=None, app=None):
         assert query == "What is AI?"
-        return "AI stands for Artificial Intelligence."
+        return {
+            "answer": "AI stands for Artificial Intelligence.",
+            "sources": [{"ref": 1, "chunk_id": 10, "doc_ref": "hub_docs.documents:1",
+                         "start": 0, "end": 120, "score": 0.9}],
+        }
 
     monkeypatch.setattr(AIService, "rag_search_and_answer", mock_rag_search_and_answer)
 
     resp = client.get("/ai/rag_search", params={"query": "What is AI?"})
     assert resp.status_code == 200
     data = resp.json()
-    assert data["answer"] == "AI stands for Artificial Intelligence."
\ No newline at end of file
+    assert data["answer"] == "AI stands for Artificial Intelligence."
+    assert data["sources"][0]["doc_ref"] == "hub_docs.documents:1"
+    assert (data["sources"][0]["start"], data["sources"][0]["end"]) == (0, 120)
+
+def test_rag_search_stream_sends_sources_first(client, monkeypatch):
+    async def mock_stream_rag_answer(query, db, tags=None, owner_id=None, app=None):
+        yield "sources", [{"ref": 1, "chunk_id": 10, "doc_ref": "hub_docs.documents:1",
+                           "start": 0, "end": 120, "score": 0.9}]
+        for token in ["AI is ", "Artificial ", "Intelligence."]:
+            yield "token", token
+
+    monkeypatch.setattr(AIService, "stream_rag_answer", mock_stream_rag_answer)
+
+    resp = client.get("/ai/rag_search/stream", params={"query": "What is AI?"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n")[0] for block in resp.text.strip().split("\n\n")]
+    assert events == ["event: sources"] + ["event: token"] * 3 + ["event: done"]
+    assert '"text": "Artificial "' in resp.text
+
+def test_generate_batch_streams_ndjson(client, monkeypatch):
+    async def mock_generate_batch(prompts, db, concurrency, use_cache=True):
+        assert concurrency >= 1
+        for index in reversed(range(len(prompts))):
+            yield {"index": index, "generated_text": prompts[index].upper(), "cached": False}
+
+    monkeypatch.setattr(AIService, "generate_batch", mock_generate_batch)
+
+    resp = client.post("/ai/generate_batch", json={"prompts": ["a", "b", "c"], "concurrency": 2})
+    assert resp.status_code == 200
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [line["index"] for line in lines] == [2, 1, 0]
+    assert lines[0]["generated_text"] == "C"
+
+    assert client.post("/ai/generate_batch", json={"prompts": []}).status_code == 400
\ No newline at end of file
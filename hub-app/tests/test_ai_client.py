@@ -0,0 +1,156 @@
+# .\hub-app\tests\test_ai_client.py
+
+import asyncio
+import httpx
+import pytest
+from shared_libs.ai_client import AIClient, AIClientError, ERROR_CIRCUIT_OPEN, ERROR_CONNECTION
+from shared_libs.llm_provider import StubProvider
+from shared_libs.stub_llm_server import StubLLMServer
+
+@pytest.fixture
+def mock_client(monkeypatch):
+    """共有の接続プールを MockTransport を使うクライアントに差し替える。"""
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(AIClient, "backoff_base", 0.0)
+    monkeypatch.setattr(AIClient, "max_retries", 2)
+    # 流量制御の状態はテストごとに作り直す
+    for name in ("_rate_limiter", "_concurrency", "_breaker", "_hedging"):
+        monkeypatch.setattr(AIClient, name, None)
+
+    def install(handler):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(AIClient, "_client", client)
+        return client
+    yield install
+    AIClient._client = None
+
+def test_acall_llm_retries_transient_errors(mock_client):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise httpx.ConnectError("connection refused", request=request)
+        if len(calls) == 2:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        return httpx.Response(200, json={"choices": [{"text": " answer "}]})
+
+    mock_client(handler)
+    assert asyncio.run(AIClient.acall_llm("Hello")) == "answer"
+    assert len(calls) == 3
+    assert calls[0].headers["Authorization"] == "Bearer test-key"
+
+def test_acall_llm_gives_up_after_max_retries(mock_client):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429)
+
+    mock_client(handler)
+    assert asyncio.run(AIClient.acall_llm("Hello")) == ERROR_CONNECTION
+    # 初回 + 再試行2回
+    assert len(calls) == 3
+
+def test_acall_llm_does_not_retry_client_errors(mock_client):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(400)
+
+    mock_client(handler)
+    assert asyncio.run(AIClient.acall_llm("Hello")) == ERROR_CONNECTION
+    assert len(calls) == 1
+
+def test_astream_llm_yields_tokens_in_order(mock_client):
+    body = "".join(f'data: {{"choices": [{{"text": "{token}"}}]}}\n\n' for token in ["Hel", "lo", "!"])
+    body += "data: [DONE]\n\n"
+
+    def handler(request):
+        assert b'"stream": true' in request.content or b'"stream":true' in request.content
+        return httpx.Response(200, content=body.encode(), headers={"Content-Type": "text/event-stream"})
+
+    mock_client(handler)
+
+    async def collect():
+        return [token async for token in AIClient.astream_llm("Hello")]
+
+    assert asyncio.run(collect()) == ["Hel", "lo", "!"]
+
+def test_astream_llm_raises_after_retries(mock_client):
+    mock_client(lambda request: httpx.Response(500))
+
+    async def collect():
+        return [token async for token in AIClient.astream_llm("Hello")]
+
+    with pytest.raises(AIClientError):
+        asyncio.run(collect())
+
+def test_open_circuit_fails_fast(mock_client, monkeypatch):
+    monkeypatch.setattr(AIClient, "breaker_failures", 3)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+
+    mock_client(handler)
+    assert asyncio.run(AIClient.acall_llm("Hello")) == ERROR_CONNECTION
+    assert len(calls) == 3
+    # 3回連続の失敗でブレーカーが開き、以降はサービスを呼ばない
+    assert asyncio.run(AIClient.acall_llm("Hello")) == ERROR_CIRCUIT_OPEN
+    assert len(calls) == 3
+    stats = AIClient.stats()
+    assert stats["circuit_breaker"]["state"] == "open"
+    assert stats["circuit_breaker"]["rejected"] == 1
+
+def test_hedged_call_returns_faster_duplicate(mock_client, monkeypatch):
+    monkeypatch.setattr(AIClient, "hedge", True)
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        # 3件目(ヘッジ対象の元の要求)だけ応答が遅い
+        if len(calls) == 3:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={"choices": [{"text": f"answer{len(calls)}"}]})
+
+    mock_client(handler)
+    policy = AIClient.hedging()
+    policy.min_samples = 2
+    policy.budget = 1.0
+
+    async def run():
+        assert await AIClient.acall_llm("Hello") == "answer1"
+        assert await AIClient.acall_llm("Hello") == "answer2"
+        started = asyncio.get_running_loop().time()
+        text = await AIClient.acall_llm("Hello")
+        return text, asyncio.get_running_loop().time() - started
+
+    text, elapsed = asyncio.run(run())
+    assert text == "answer4" and elapsed < 1
+    stats = AIClient.stats()["hedging"]
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1
+
+def test_acall_llm_against_stub_server(monkeypatch):
+    server = StubLLMServer(port=0, latency="fixed:0", token_rate=0, tokens=3)
+    monkeypatch.setattr(AIClient, "provider", StubProvider(base_url=server.start()))
+    for name in ("_client", "_rate_limiter", "_concurrency", "_breaker", "_hedging"):
+        monkeypatch.setattr(AIClient, name, None)
+
+    async def run():
+        try:
+            text = await AIClient.acall_llm("Hello")
+            tokens = [token async for token in AIClient.astream_llm("Hello")]
+            return text, tokens
+        finally:
+            await AIClient.aclose()
+
+    try:
+        text, tokens = asyncio.run(run())
+    finally:
+        server.stop()
+    assert text == "token0 token1 token2"
+    assert tokens == [" token0", " token1", " token2"]
+    assert AIClient.model_name() == "stub:stub"
\ No newline at end of file
@@ -0,0 +1,58 @@
+# .\hub-app\tests\test_batch_writer.py
+
+import asyncio
+import threading
+import time
+from shared_libs.batch_writer import BatchWriter
+
+def test_batch_writer_flushes_by_size_and_interval():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=3, flush_interval=0.05, capacity=10)
+    writer.start()
+    try:
+        for i in range(4):
+            assert writer.submit({"i": i})
+        # 3件たまった時点で書き込み、残りの1件は flush_interval 後に書き込む
+        deadline = time.monotonic() + 5
+        while sum(len(batch) for batch in batches) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [len(batch) for batch in batches] == [3, 1]
+        assert [row["i"] for batch in batches for row in batch] == [0, 1, 2, 3]
+    finally:
+        writer.stop(timeout=5)
+    assert writer.stats()["written"] == 4 and writer.stats()["batches"] == 2
+
+def test_batch_writer_drops_when_full_and_flushes_on_stop():
+    gate = threading.Event()
+    written = []
+
+    def slow_writer(rows):
+        gate.wait(5)
+        written.extend(rows)
+
+    writer = BatchWriter(slow_writer, batch_size=2, flush_interval=10, capacity=4, block_timeout=0.01)
+    writer.start()
+    assert writer.submit({"i": 0}) and writer.submit({"i": 1})
+    # 書き込み中のバッチの間にバッファ(4件)が埋まると、以降は待ってから破棄する
+    time.sleep(0.05)
+    results = [writer.submit({"i": i}) for i in range(2, 8)]
+    assert results == [True] * 4 + [False] * 2
+    assert asyncio.run(writer.asubmit({"i": 8})) is False
+    stats = writer.stats()
+    assert stats["dropped"] == 3 and stats["blocked"] == 3
+    gate.set()
+    writer.stop(timeout=5)
+    # 停止時にバッファに残った行も書き込む
+    assert [row["i"] for row in written] == list(range(6))
+    assert not writer.submit({"i": 9})
+
+def test_batch_writer_counts_failed_batches():
+    def failing_writer(rows):
+        raise RuntimeError("database unavailable")
+
+    writer = BatchWriter(failing_writer, batch_size=2, capacity=4)
+    writer.submit({"i": 0})
+    assert writer.flush()
+    stats = writer.stats()
+    assert stats["failed"] == 1 and stats["written"] == 0
+    assert "database unavailable" in stats["last_error"]
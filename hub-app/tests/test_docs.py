@@ -53,4 +53,19 @@ def test_list_documents(client, test_db):
     docs = resp.json()
     assert isinstance(docs, list)
     assert len(docs) == 1
-    assert docs[0]["title"] == "TestDoc"
\ No newline at end of file
+    assert docs[0]["title"] == "TestDoc"
+
+def test_update_document(client, test_db):
+    resp = client.put("/doc/update/1", json={"content": "Updated Content"})
+    assert resp.status_code == 200
+    assert test_db.get(Document, 1).content == "Updated Content"
+    resp = client.put("/doc/update/9999", json={"title": "Missing"})
+    assert resp.status_code == 404
+
+def test_index_status(client):
+    resp = client.get("/doc/index_status")
+    assert resp.status_code == 200
+    data = resp.json()
+    assert "backlog" in data
+    assert "oldest_pending_seconds" in data
+    assert set(data["embedding"]) == {"chunks", "embedded", "reused"}
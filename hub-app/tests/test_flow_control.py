@@ -0,0 +1,82 @@
+# .\hub-app\tests\test_flow_control.py
+
+import asyncio
+import time
+from shared_libs.flow_control import (
+    CLOSED, HALF_OPEN, OPEN, AdaptiveConcurrencyLimiter, CircuitBreaker, HedgingPolicy, TokenBucket,
+)
+
+def test_token_bucket_spaces_out_calls_beyond_burst():
+    bucket = TokenBucket(rate=10, burst=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert 0.05 < waits[2] <= 0.1 and 0.15 < waits[3] <= 0.2
+    assert bucket.stats()["delayed"] == 2
+    assert TokenBucket(rate=0).reserve() == 0.0
+
+def test_adaptive_limiter_backs_off_on_overload_and_recovers():
+    limiter = AdaptiveConcurrencyLimiter(initial=10, min_limit=2, max_limit=10, target_latency=1.0)
+
+    async def run():
+        await limiter.acquire()
+        await limiter.release(latency=0.1, overloaded=True)
+        assert limiter.stats()["limit"] == 7
+        await limiter.acquire()
+        await limiter.release(latency=5.0)
+        assert limiter.stats()["limit"] == 4
+        for _ in range(20):
+            await limiter.acquire()
+            await limiter.release(latency=0.1)
+        return limiter.stats()
+
+    stats = asyncio.run(run())
+    assert stats["limit"] > 4 and stats["in_flight"] == 0
+
+def test_adaptive_limiter_blocks_beyond_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial=2, min_limit=1, max_limit=2)
+    peak = 0
+
+    async def work():
+        nonlocal peak
+        await limiter.acquire()
+        peak = max(peak, limiter.in_flight)
+        await asyncio.sleep(0.01)
+        await limiter.release(latency=0.01)
+
+    async def run():
+        await asyncio.gather(*(work() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+    time.sleep(0.06)
+    # 半開状態では試行を1件だけ通す
+    assert breaker.allow() and not breaker.allow()
+    assert breaker.state == HALF_OPEN
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["opened"] == 2
+
+def test_hedging_policy_uses_percentile_deadline_and_budget():
+    policy = HedgingPolicy(percentile=90, budget=0.5, min_delay=0.01, min_samples=10, burst=1)
+    # 応答時間の記録が足りないうちはヘッジしない
+    assert policy.deadline() is None
+    for i in range(1, 11):
+        policy.record(i / 10)
+    assert policy.deadline() == 0.9
+    # 予算は呼び出し2件ごとに1件分(上限1件)
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    policy.record_winner(hedge_won=True)
+    stats = policy.stats()
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1 and stats["budget_exhausted"] == 1
@@ -0,0 +1,58 @@
+# .\hub-app\tests\test_index_pipeline.py
+
+import threading
+from shared_libs.index_pipeline import IndexingPipeline
+
+def test_pipeline_processes_and_coalesces():
+    seen = []
+    gate = threading.Event()
+
+    def handler(key):
+        gate.wait(5)
+        seen.append(key)
+
+    pipeline = IndexingPipeline(handler, workers=1, max_queue_size=10)
+    pipeline.start()
+    try:
+        for key in [1, 2, 2, 3, 3, 3]:
+            assert pipeline.submit(key)
+        gate.set()
+        assert pipeline.join(timeout=5)
+        # 未処理の間の重複要求は1回にまとめられる
+        assert sorted(seen) == [1, 2, 3]
+        status = pipeline.status()
+        assert status["processed"] == 3
+        assert status["backlog"] == 0
+    finally:
+        pipeline.stop(timeout=5)
+
+def test_pipeline_retries_then_succeeds():
+    attempts = []
+
+    def handler(key):
+        attempts.append(key)
+        if len(attempts) < 3:
+            raise RuntimeError("temporary failure")
+
+    pipeline = IndexingPipeline(handler, workers=2, max_retries=3, retry_backoff=0.01)
+    pipeline.start()
+    try:
+        pipeline.submit("doc")
+        assert pipeline.join(timeout=5)
+        status = pipeline.status()
+        assert len(attempts) == 3
+        assert status["retried"] == 2 and status["failed"] == 0 and status["processed"] == 1
+    finally:
+        pipeline.stop(timeout=5)
+
+def test_pipeline_drops_when_queue_full():
+    gate = threading.Event()
+    pipeline = IndexingPipeline(lambda key: gate.wait(5), workers=1, max_queue_size=2)
+    # ワーカー未起動なのでキューは消費されない
+    assert pipeline.submit(1) and pipeline.submit(2)
+    assert not pipeline.submit(3)
+    assert pipeline.status()["dropped"] == 1
+    gate.set()
+    pipeline.start()
+    assert pipeline.join(timeout=5)
+    pipeline.stop(timeout=5)
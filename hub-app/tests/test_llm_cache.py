@@ -0,0 +1,71 @@
+# .\hub-app\tests\test_llm_cache.py
+
+import time
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from shared_libs.llm_cache import LLMResponseCache, cache_key
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def attach_schema(conn, record):
+        conn.execute("ATTACH DATABASE ':memory:' AS ai_schema")
+
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE ai_schema.llm_response_cache (cache_key BLOB PRIMARY KEY, model TEXT, "
+            "response TEXT, created_at TIMESTAMP, expires_at TIMESTAMP)"
+        ))
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+def test_cache_key_depends_on_model_prompt_and_params():
+    key = cache_key("m", "Hello", {"max_tokens": 200, "temperature": 0})
+    assert key == cache_key("m", "Hello", {"temperature": 0, "max_tokens": 200})
+    assert key != cache_key("m2", "Hello", {"max_tokens": 200, "temperature": 0})
+    assert key != cache_key("m", "Hello", {"max_tokens": 100, "temperature": 0})
+
+def test_memory_tier_lru_and_ttl():
+    cache = LLMResponseCache(max_entries=2, ttl_seconds=0.05, use_db=False)
+    for name in ("a", "b"):
+        cache.put(None, name.encode(), "m", name.upper())
+    assert cache.get(None, b"a") == "A"
+    # 最も長く使われていない b が追い出される
+    cache.put(None, b"c", "m", "C")
+    assert cache.get(None, b"b") is None
+    assert cache.get(None, b"c") == "C"
+    time.sleep(0.06)
+    assert cache.get(None, b"a") is None
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["evictions"], stats["expired"]) == (2, 2, 1, 1)
+
+def test_db_tier_survives_memory_loss_and_expires(db):
+    cache = LLMResponseCache(max_entries=10, ttl_seconds=60)
+    cache.put(db, b"k", "m", "response")
+    cache.put(db, b"k", "m", "updated")
+    db.commit()
+    cache.clear()
+    assert cache.get(db, b"k") == "updated"
+    assert cache.stats()["db_hits"] == 1
+    # DBから読んだ項目はメモリにも載る
+    assert cache.get_memory(b"k") == "updated"
+    db.execute(text("UPDATE ai_schema.llm_response_cache SET expires_at = '2000-01-01 00:00:00'"))
+    cache.clear()
+    assert cache.get(db, b"k") is None
+    assert cache.purge_expired(db) == 1
+
+def test_bulk_get_and_put(db):
+    cache = LLMResponseCache(max_entries=10, ttl_seconds=60)
+    cache.put_many(db, "m", [(b"a", "A"), (b"b", "B")])
+    db.commit()
+    cache.clear()
+    cache.get_memory(b"a")
+    assert cache.get_many(db, [b"a", b"b", b"c", b"a"]) == {b"a": "A", b"b": "B"}
+    stats = cache.stats()
+    assert (stats["db_hits"], stats["misses"], stats["entries"]) == (2, 1, 2)
\ No newline at end of file
@@ -0,0 +1,126 @@
+# .\hub-app\tests\test_log_partitions.py
+
+import pytest
+from datetime import date, datetime
+from sqlalchemy import Column, MetaData, Table, create_engine, insert, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+from dbschemas.ai_schema import AICallLogs
+from dbschemas.logs_schema import APILog
+from shared_libs.log_partitions import PartitionedTable, PartitionMaintainer, add_months, apply_retention, ensure_partitions
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = len(rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+class RecordingSession:
+    """パーティションの一覧(と既定パーティションに行がある月)を返し、実行したDDLを記録するテスト用のセッション"""
+    def __init__(self, partitions, default_months=()):
+        self.partitions = partitions
+        self.default_months = default_months
+        self.statements = []
+        self.commits = 0
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        if sql.startswith("SELECT DISTINCT"):
+            return Result([(month,) for month in self.default_months])
+        if sql.startswith("SELECT"):
+            return Result([(name,) for name in self.partitions])
+        self.statements.append(sql)
+        return Result([])
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+@pytest.fixture
+def sqlite_log_tables():
+    """パーティション表の写しを SQLite に作る。
+    SQLite は複合主キーの自動採番に対応しないため、自動採番の列だけを主キーにする"""
+    engine = create_engine("sqlite://")
+    metadata = MetaData()
+    tables = {}
+    for table in (AICallLogs.__table__, APILog.__table__):
+        tables[table.name] = Table(table.name, metadata, *[
+            Column(column.name, column.type, primary_key=column.autoincrement is True, nullable=column.nullable,
+                   default=column.default.arg if column.default is not None else None)
+            for column in table.columns])
+    metadata.create_all(engine)
+    yield engine, tables
+    engine.dispose()
+
+def test_log_models_compile_partitioned_ddl():
+    # 主キーにパーティションキーを含め、月単位のレンジパーティション表として作成する
+    ddl = str(CreateTable(AICallLogs.__table__).compile(dialect=postgresql.dialect()))
+    assert "PRIMARY KEY (call_id, created_at)" in ddl and ddl.rstrip().endswith("PARTITION BY RANGE (created_at)")
+    ddl = str(CreateTable(APILog.__table__).compile(dialect=postgresql.dialect()))
+    assert "PRIMARY KEY (id, timestamp)" in ddl and ddl.rstrip().endswith("PARTITION BY RANGE (timestamp)")
+
+def test_log_models_insert_rows_on_sqlite(sqlite_log_tables):
+    engine, tables = sqlite_log_tables
+    with engine.begin() as conn:
+        conn.execute(insert(tables["ai_call_logs"]).values([{"app_name": "hub", "prompt": "p1"},
+                                                            {"app_name": "hub", "prompt": "p2"}]))
+        rows = conn.execute(select(tables["ai_call_logs"].c.call_id, tables["ai_call_logs"].c.created_at)).all()
+    # 自動採番とパーティションキーの既定値は PostgreSQL と同じように埋まる
+    assert [row.call_id for row in rows] == [1, 2] and all(row.created_at for row in rows)
+
+def test_partition_names_and_month_arithmetic():
+    spec = PartitionedTable("ai_schema", "ai_call_logs", 12)
+    assert spec.qualified_name == "ai_schema.ai_call_logs"
+    assert spec.partition_name(date(2026, 3, 1)) == "ai_call_logs_p202603"
+    assert spec.month_of("ai_call_logs_p202603") == date(2026, 3, 1)
+    assert spec.month_of("ai_call_logs_default") is None
+    assert add_months(date(2026, 11, 1), 3) == date(2027, 2, 1)
+    assert add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+
+def test_apply_retention_keeps_recent_months_and_default_partition():
+    spec = PartitionedTable("logs_schema", "api_logs", 3, key="timestamp")
+    db = RecordingSession(["api_logs_default", "api_logs_p202607", "api_logs_p202608",
+                           "api_logs_p202609", "api_logs_p202610"])
+    # 保持3か月(今月を含む)なので、2026年8月より前のパーティションだけが対象になる
+    expired = apply_retention(db, spec, "detach", now=datetime(2026, 10, 18))
+    assert expired == ["api_logs_p202607"]
+    assert db.statements == ["ALTER TABLE logs_schema.api_logs DETACH PARTITION logs_schema.api_logs_p202607"]
+    db.statements.clear()
+    assert apply_retention(db, spec, "drop", now=datetime(2026, 11, 1)) == ["api_logs_p202607", "api_logs_p202608"]
+    assert db.statements[-2] == "DROP TABLE logs_schema.api_logs_p202608"
+    # drop の場合は既定パーティションに残った保持期間より前の行も削除する
+    assert db.statements[-1] == "DELETE FROM logs_schema.api_logs_default WHERE \"timestamp\" < '2026-09-01'"
+    assert apply_retention(db, spec._replace(retention_months=0), "drop") == []
+
+def test_ensure_partitions_moves_rows_stranded_in_default_partition():
+    spec = PartitionedTable("logs_schema", "api_logs", 3, key="timestamp")
+    # 保守が止まっていた間の2026年6月と、作成予定の今月の行が既定パーティションに入っている
+    db = RecordingSession(["api_logs_default", "api_logs_p202605"], default_months=[date(2026, 6, 1), date(2026, 10, 1)])
+    created = ensure_partitions(db, spec, months_ahead=1, now=datetime(2026, 10, 18))
+    assert created == ["api_logs_p202606", "api_logs_p202610", "api_logs_p202611"]
+    june = "\"timestamp\" >= '2026-06-01' AND \"timestamp\" < '2026-07-01'"
+    assert db.statements[:5] == [
+        "ALTER TABLE logs_schema.api_logs DETACH PARTITION logs_schema.api_logs_default",
+        "CREATE TABLE IF NOT EXISTS logs_schema.api_logs_p202606 PARTITION OF logs_schema.api_logs "
+        "FOR VALUES FROM ('2026-06-01') TO ('2026-07-01')",
+        f"INSERT INTO logs_schema.api_logs_p202606 SELECT * FROM logs_schema.api_logs_default WHERE {june}",
+        f"DELETE FROM logs_schema.api_logs_default WHERE {june}",
+        "ALTER TABLE logs_schema.api_logs ATTACH PARTITION logs_schema.api_logs_default DEFAULT",
+    ]
+    assert db.statements[5].startswith("ALTER TABLE logs_schema.api_logs DETACH PARTITION")
+    # 行のない来月は通常どおり作成し、月ごとにコミットする
+    assert db.statements[-1].startswith("CREATE TABLE IF NOT EXISTS logs_schema.api_logs_p202611 PARTITION OF")
+    assert db.commits == 3
+    # 移したパーティションは保持期間(3か月)を過ぎているため、次の保持期間の適用で切り離される
+    db = RecordingSession(["api_logs_default", "api_logs_p202605", "api_logs_p202606", "api_logs_p202610"])
+    assert apply_retention(db, spec, now=datetime(2026, 10, 18)) == ["api_logs_p202605", "api_logs_p202606"]
+
+def test_maintainer_skips_databases_without_partitioning():
+    engine = create_engine("sqlite://")
+    maintainer = PartitionMaintainer(sessionmaker(bind=engine), [PartitionedTable("ai_schema", "ai_call_logs", 12)])
+    assert maintainer.run_once() == {}
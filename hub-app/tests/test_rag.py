@@ -0,0 +1,816 @@
+# .\hub-app\tests\test_rag.py
+
+import os
+import threading
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from shared_libs.vector_index import SNIPPET_CHARS, VectorIndex, top_k_indices
+from shared_libs.rag_utils import RAGSearcher, content_hash
+from shared_libs.ann_index import IVFIndex
+from shared_libs.vector_codec import pack_vector, unpack_vector, unpack_matrix, text_to_blob
+from shared_libs.chunker import iter_chunks
+from shared_libs.bm25_index import BM25Index, query_terms
+from shared_libs.rag_utils import fuse_hits
+from shared_libs.vector_index import SearchHit
+from shared_libs.embedding import Embedder, HashingEmbedder
+from shared_libs.row_bitsets import RowBitsets
+from shared_libs.rag_utils import LOCAL_DOCS_SOURCE
+from shared_libs.quantized_index import QuantizedIndex, recall_report
+from shared_libs.quantization import ProductQuantizer
+from shared_libs.vector_index import normalize_rows
+from shared_libs import sharded_index
+from shared_libs.sharded_index import ShardedIndex
+from shared_libs.context_packer import CHUNK_OVERHEAD_TOKENS, ContextPacker, approximate_tokens
+from shared_libs.semantic_cache import SemanticCache
+
+DIM = 16
+
+class FixedEmbedder(Embedder):
+    """どのテキストにも同じベクトルを返すテスト用のEmbedder"""
+    def __init__(self, vector):
+        self.vector = np.asarray(vector, dtype=np.float32)
+        self.dim = self.vector.shape[0]
+        self.model_name = "fixed"
+
+    def embed_batch(self, texts):
+        return np.tile(self.vector, (len(texts), 1))
+
+@pytest.fixture
+def sample_index():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((200, DIM)).astype(np.float32)
+    chunk_ids = list(range(1, 201))
+    doc_refs = [f"hub_docs.documents:{i}" for i in chunk_ids]
+    snippets = [f"snippet {i}" for i in chunk_ids]
+    index = VectorIndex(DIM, initial_capacity=8)
+    index.add(chunk_ids[:50], vectors[:50], doc_refs[:50], snippets[:50])
+    index.add(chunk_ids[50:], vectors[50:], doc_refs[50:], snippets[50:])
+    return index, vectors
+
+def test_top_k_indices_matches_full_sort():
+    scores = np.random.default_rng(1).standard_normal(1000).astype(np.float32)
+    expected = np.argsort(-scores)[:10]
+    assert list(top_k_indices(scores, 10)) == list(expected)
+    assert len(top_k_indices(scores, 5000)) == 1000
+
+def test_vector_index_search_ranks_by_cosine(sample_index):
+    index, vectors = sample_index
+    assert len(index) == 200
+    hits = index.search(vectors[42], top_k=3)
+    assert hits[0].chunk_id == 43
+    assert hits[0].doc_ref == "hub_docs.documents:43"
+    assert hits[0].snippet == "snippet 43"
+    assert hits[0].score == pytest.approx(1.0, abs=1e-5)
+    assert hits[0].score >= hits[1].score >= hits[2].score
+
+def test_vector_index_rejects_dimension_mismatch(sample_index):
+    index, _ = sample_index
+    with pytest.raises(ValueError):
+        index.search(np.ones(DIM + 1, dtype=np.float32))
+
+def test_search_docs_uses_configured_index(sample_index):
+    index, vectors = sample_index
+    RAGSearcher.configure(embedder=FixedEmbedder(vectors[7]), index=index)
+    hits = RAGSearcher.search_docs("anything", top_k=2)
+    assert [hit.chunk_id for hit in hits][0] == 8
+    RAGSearcher._index = None
+    RAGSearcher._embedder = None
+
+def test_vector_codec_roundtrip():
+    vector = np.array([0.11, -0.22, 0.33], dtype=np.float32)
+    blob = pack_vector(vector)
+    assert blob == vector.astype("<f4").tobytes()
+    assert np.array_equal(unpack_vector(blob, 3), vector)
+    matrix = unpack_matrix([blob, text_to_blob("[1.0, 2.0, 3.0]")], 3)
+    assert matrix.shape == (2, 3)
+    assert matrix[1].tolist() == [1.0, 2.0, 3.0]
+    with pytest.raises(ValueError):
+        unpack_vector(blob, 4)
+
+def _clustered_vectors(n, dim, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim))
+    labels = rng.integers(0, n_clusters, n)
+    return (centers[labels] + 0.3 * rng.standard_normal((n, dim))).astype(np.float32)
+
+def test_ivf_index_recall_and_persistence(tmp_path):
+    vectors = _clustered_vectors(2000, DIM)
+    chunk_ids = list(range(1, 2001))
+    refs = [f"hub_docs.documents:{i}" for i in chunk_ids]
+    path = str(tmp_path / "ivf")
+    index = IVFIndex(DIM, n_lists=16, n_probe=4, path=path, train_size=500, initial_capacity=64)
+    for start in range(0, 2000, 250):
+        end = start + 250
+        index.add(chunk_ids[start:end], vectors[start:end], refs[start:end], refs[start:end])
+    assert index.is_trained
+    exact = VectorIndex.from_arrays(chunk_ids, vectors, refs, refs)
+
+    queries = _clustered_vectors(50, DIM, seed=1)
+    def recall(idx, **kwargs):
+        found = 0
+        for q in queries:
+            expected = {h.chunk_id for h in exact.search(q, top_k=10)}
+            found += len(expected & {h.chunk_id for h in idx.search(q, top_k=10, **kwargs)})
+        return found / (10 * len(queries))
+    assert recall(index) >= 0.8
+    assert recall(index, n_probe=16) == 1.0
+
+    index.flush()
+    reloaded = IVFIndex.load(path)
+    assert len(reloaded) == 2000
+    assert reloaded.max_chunk_id() == 2000
+    assert recall(reloaded, n_probe=16) == 1.0
+    reloaded.add([2001], vectors[:1], ["hub_docs.documents:2001"], ["new"])
+    assert reloaded.search(vectors[0], top_k=2, n_probe=16)[0].chunk_id in (1, 2001)
+
+def test_persisted_ivf_index_drops_chunks_deleted_in_db(tmp_path):
+    vectors = _clustered_vectors(100, DIM)
+    path = str(tmp_path / "ivf")
+    index = IVFIndex(DIM, n_lists=4, path=path, train_size=50)
+    index.add(list(range(1, 101)), vectors, [f"hub_docs.documents:{i // 10}" for i in range(1, 101)],
+              ["s"] * 100)
+    index.flush()
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def attach_schema(conn, record):
+        conn.execute("ATTACH DATABASE ':memory:' AS ai_schema")
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ai_schema.doc_embeddings (embedding_id INTEGER PRIMARY KEY, "
+                          "embedding_model TEXT)"))
+        # 別のプロセスが文書1(チャンク10〜19)を削除し、チャンク1を別のIDで登録し直した状態
+        conn.execute(text("INSERT INTO ai_schema.doc_embeddings VALUES (:id, 'm')"),
+                     [{"id": i} for i in range(2, 101) if not 10 <= i < 20] + [{"id": 101}])
+    reloaded = IVFIndex.load(path)
+    db = sessionmaker(bind=engine)()
+    stale = RAGSearcher._stale_chunk_ids(db, reloaded, reloaded.max_chunk_id(), "m")
+    assert stale.tolist() == [1] + list(range(10, 20))
+    assert reloaded.remove_chunks(stale.tolist()) == 11
+    assert "hub_docs.documents:1" not in reloaded.doc_refs() and len(reloaded) == 89
+    hits = reloaded.search(vectors[12], top_k=100, n_probe=4)
+    assert not {hit.chunk_id for hit in hits} & set(stale.tolist())
+    # 外した行は削除済みとしてファイルに残る
+    reloaded.flush()
+    assert len(IVFIndex.load(path)) == 89
+
+def test_ivf_index_compacts_to_next_generation(tmp_path):
+    vectors = _clustered_vectors(200, DIM)
+    refs = [f"hub_docs.documents:{i // 10}" for i in range(200)]
+    path = str(tmp_path / "ivf")
+    index = IVFIndex(DIM, n_lists=4, path=path, train_size=100)
+    index.add(list(range(200)), vectors, refs, refs)
+    index.set_doc_keys("hub_docs.documents:15", {"tag:x"})
+    for doc in range(10):
+        index.remove_doc(f"hub_docs.documents:{doc}")
+    assert index.compact() == 100
+    # 生きている行だけを次の世代のファイルに書き写し、前の世代のファイルは削除する
+    assert index.generation == 1 and not os.path.exists(os.path.join(path, "vectors.f32"))
+    expected = [hit.chunk_id for hit in index.search(vectors[150], top_k=5, n_probe=4)]
+    filtered = index.search(vectors[150], top_k=20, n_probe=4, where=["tag:x"])
+    assert {hit.chunk_id for hit in filtered} == set(range(150, 160))
+    reloaded = IVFIndex.load(path)
+    assert len(reloaded) == 100 and reloaded.generation == 1
+    assert [hit.chunk_id for hit in reloaded.search(vectors[150], top_k=5, n_probe=4)] == expected
+    assert min(hit.chunk_id for hit in reloaded.search(vectors[150], top_k=100, n_probe=4)) >= 100
+
+def test_iter_chunks_offsets_and_sentence_boundaries():
+    text = "".join(f"これは{i}番目の文です。" for i in range(200))
+    chunks = list(iter_chunks(text, chunk_size=100, overlap=20))
+    assert chunks[0].start == 0 and chunks[-1].end == len(text)
+    for prev, chunk in zip(chunks, chunks[1:]):
+        # 隣り合うチャンクは重なり、途中のチャンクは文末で終わる
+        assert chunk.start < prev.end
+        assert prev.text.endswith("。")
+    for chunk in chunks:
+        assert text[chunk.start:chunk.end] == chunk.text
+        assert len(chunk.text) <= 100
+
+def test_iter_chunks_streams_from_iterable():
+    text = "あいうえお。" * 500
+    pieces = (text[i:i + 7] for i in range(0, len(text), 7))
+    assert list(iter_chunks(pieces, chunk_size=120, overlap=30)) == list(iter_chunks(text, 120, 30))
+
+def test_index_document_replaces_previous_chunks():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    assert RAGSearcher.index_document(1, "古い本文。" * 300) > 1
+    count = RAGSearcher.index_document(1, "新しい本文。")
+    assert count == 1
+    index = RAGSearcher.get_index()
+    assert len(index) == 1
+    hits = RAGSearcher.search_docs("新しい本文。")
+    assert hits[0].doc_ref == "hub_docs.documents:1"
+    assert (hits[0].start, hits[0].end) == (0, len("新しい本文。"))
+    assert len(RAGSearcher.get_lexical_index()) == 1
+    # 置き換えられた古いチャンクの行は詰め直されている
+    assert index.vectors().shape[0] == 1
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+
+class FailingEmbedder(HashingEmbedder):
+    """fail を True にするとEmbedding化で例外を送出するテスト用のEmbedder"""
+    fail = False
+
+    def embed_batch(self, texts):
+        if self.fail:
+            raise RuntimeError("Embedding化に失敗しました")
+        return super().embed_batch(texts)
+
+def test_index_document_keeps_old_chunks_when_indexing_fails():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._local_vectors.clear()
+    embedder = FailingEmbedder(DIM)
+    RAGSearcher.configure(embedder=embedder)
+    RAGSearcher.index_document(1, "就業規則の改定について。")
+    embedder.fail = True
+    with pytest.raises(RuntimeError):
+        RAGSearcher.index_document(1, "経費精算の手順。")
+    embedder.fail = False
+    # 登録に失敗した場合は古いチャンクが検索対象に残る
+    hits = RAGSearcher.search_docs("就業規則の改定")
+    assert [(hit.doc_ref, hit.text) for hit in hits] == [("hub_docs.documents:1", "就業規則の改定について。")]
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._local_vectors.clear()
+
+def test_store_chunks_maps_returned_ids_by_chunk_start():
+    chunks = list(iter_chunks("".join(f"これは{i}番目の文です。" for i in range(200)), 500, 100))
+
+    class ReversedReturningSession:
+        """RETURNING の行を VALUES と逆の順序で返すセッション"""
+        def execute(self, statement):
+            return [(100 + i, chunk.start) for i, chunk in reversed(list(enumerate(chunks)))]
+
+    hashes = [content_hash(chunk.text) for chunk in chunks]
+    ids = RAGSearcher._store_chunks(ReversedReturningSession(), "hub_docs.documents:1", chunks, hashes, DIM, "m")
+    assert len(chunks) > 2 and ids == [100 + i for i in range(len(chunks))]
+
+class BarrierEmbedder(HashingEmbedder):
+    """全スレッドがEmbedding化に達するまで待たせ、索引の作成を同時に行わせるテスト用のEmbedder"""
+    def __init__(self, dim, parties):
+        super().__init__(dim)
+        self.barrier = threading.Barrier(parties)
+
+    def embed_batch(self, texts):
+        self.barrier.wait(5)
+        return super().embed_batch(texts)
+
+def test_concurrent_index_document_creates_one_index():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._local_vectors.clear()
+    RAGSearcher.configure(embedder=BarrierEmbedder(DIM, parties=8))
+    threads = [threading.Thread(target=RAGSearcher.index_document, args=(i, f"文書{i}の本文。"))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    # 索引がない状態で同時に登録しても、どの文書のチャンクも失われない
+    assert len(RAGSearcher.get_index()) == 8
+    assert len(RAGSearcher.get_lexical_index()) == 8
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._local_vectors.clear()
+
+def test_vector_index_compacts_rows_of_removed_docs():
+    vectors = np.random.default_rng(8).standard_normal((100, DIM)).astype(np.float32)
+    refs = [f"d{i // 10}" for i in range(100)]
+    index = VectorIndex(DIM, initial_capacity=8)
+    index.add(list(range(100)), vectors, refs, refs)
+    index.set_doc_keys("d5", {"tag:x"})
+    index.remove_doc("d1")
+    # 削除済みの行が割合に満たない間は詰め直さない
+    assert index.compact(0.25) == 0
+    index.remove_doc("d2")
+    index.remove_doc("d3")
+    assert index.compact(0.25) == 30
+    assert len(index) == 70 and index.vectors().shape[0] == 70
+    hit = index.search(vectors[45], top_k=1)[0]
+    assert (hit.chunk_id, hit.doc_ref, hit.text) == (45, "d4", "d4")
+    assert {hit.chunk_id for hit in index.search(vectors[55], top_k=20, where=["tag:x"])} == set(range(50, 60))
+    index.remove_doc("d4")
+    assert 45 not in [hit.chunk_id for hit in index.search(vectors[45], top_k=70)]
+
+def test_query_terms_use_normalized_char_ngrams():
+    # 全角・大文字は正規化され、bigram 3語 + trigram 2語になる
+    assert list(query_terms("ＡＢＣ型")) == list(query_terms("abc型"))
+    assert len(query_terms("abc型")) == 5
+    # 空白をまたぐn-gramは作らず、1文字の断片は1語として残る
+    assert len(query_terms("x 東京")) == 2
+    assert len(query_terms("")) == 0
+
+def test_bm25_ranks_exact_terms():
+    texts = ["製品コードXR-200の仕様書です。", "XR-300の取扱説明書。", "東京本社の所在地について。"]
+    index = BM25Index()
+    index.add([1, 2, 3], texts, ["a", "b", "c"], texts, spans=[(0, len(t)) for t in texts])
+    hits = index.search("xr-200", top_k=3)
+    assert [hit.chunk_id for hit in hits][:2] == [1, 2]
+    assert index.search("本社")[0].chunk_id == 3
+    assert index.search("存在しない語") == []
+    index.remove_doc("a")
+    assert [hit.chunk_id for hit in index.search("xr-200")] == [2]
+
+def test_bm25_compact_keeps_scores_of_remaining_rows():
+    index = BM25Index()
+    for i, word in enumerate(("契約書", "経費精算", "休暇申請", "出張旅費", "出張の精算")):
+        index.add([i], [f"{word}の手続きについて"], [f"d{i}"])
+    index.remove_doc("d0")
+    index.remove_doc("d1")
+    before = index.search("出張旅費の精算", top_k=5)
+    assert index.compact() == 2
+    assert index.segment_count == 1
+    after = index.search("出張旅費の精算", top_k=5)
+    assert [(hit.chunk_id, hit.text) for hit in after] == [(hit.chunk_id, hit.text) for hit in before]
+    assert np.allclose([hit.score for hit in after], [hit.score for hit in before])
+    index.add([5], ["経費精算の手続きについて"], ["d1"])
+    assert index.search("経費精算", top_k=1)[0].chunk_id == 5
+
+def test_fuse_hits_modes():
+    vector = [SearchHit(1, "a", 0.9, ""), SearchHit(2, "b", 0.8, ""), SearchHit(3, "c", 0.1, "")]
+    lexical = [SearchHit(2, "b", 12.0, ""), SearchHit(3, "c", 6.0, "")]
+    assert [hit.chunk_id for hit in fuse_hits(vector, lexical, 2, "rrf")] == [2, 3]
+    assert [hit.chunk_id for hit in fuse_hits(vector, lexical, 3, "linear", alpha=0.9)][0] == 1
+    assert [hit.chunk_id for hit in fuse_hits(vector, lexical, 2, "bm25")] == [2, 3]
+    with pytest.raises(ValueError):
+        fuse_hits(vector, lexical, 2, "unknown")
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    texts = ["東京本社の所在地", "大阪支社の所在地", "XR-200 製品仕様書"]
+    first = HashingEmbedder(64).embed_batch(texts)
+    second = HashingEmbedder(64).embed_batch(texts)
+    assert first.shape == (3, 64) and first.dtype == np.float32
+    assert np.array_equal(first, second)
+    assert np.allclose(np.linalg.norm(first, axis=1), 1.0, atol=1e-5)
+    # バッチ処理と1件ずつの処理で結果が変わらない
+    assert np.allclose(HashingEmbedder(64).embed(texts[2]), first[2])
+    assert HashingEmbedder(64).embed_batch([]).shape == (0, 64)
+
+def test_hashing_embedder_ranks_overlapping_text():
+    embedder = HashingEmbedder(256)
+    docs = ["製品コードXR-200の仕様書です。", "今日は晴れて気持ちがいい。", "会議室の予約方法について。"]
+    index = VectorIndex.from_arrays([1, 2, 3], embedder.embed_batch(docs), ["a", "b", "c"], docs)
+    assert index.search(embedder.embed("XR-200の仕様"), top_k=1)[0].chunk_id == 1
+    assert index.search(embedder.embed("会議室を予約したい"), top_k=1)[0].chunk_id == 3
+
+def test_row_bitsets_mask_and_key_updates():
+    bits = RowBitsets()
+    bits.add_rows(0, ["a", "a", "b"], [{"tag:x", "owner:1"}, {"tag:x", "owner:1"}, {"tag:x"}])
+    assert bits.mask(3, ["tag:x"]).tolist() == [True, True, True]
+    assert bits.mask(3, ["tag:x", "owner:1"]).tolist() == [True, True, False]
+    assert bits.mask(3, ["tag:unknown"]).tolist() == [False, False, False]
+    # 文書のキーを差し替えると、その文書の行だけが変わる
+    bits.set_doc_keys("a", [0, 1], {"tag:y"})
+    assert bits.mask(3, ["tag:x"]).tolist() == [False, False, True]
+    # 後から追加した行は、文書に設定済みのキーを引き継ぐ
+    bits.add_rows(3, ["a"])
+    assert bits.mask(1000, ["tag:y"]).nonzero()[0].tolist() == [0, 1, 3]
+
+def test_row_bitsets_compact_renumbers_rows():
+    bits = RowBitsets()
+    bits.add_rows(0, ["a", "b", "c", "d"], [{"tag:x"}, {"tag:y"}, {"tag:x"}, {"tag:x", "tag:y"}])
+    compacted = bits.compact(np.array([0, 2, 3]), 4)
+    assert compacted.mask(3, ["tag:x"]).tolist() == [True, True, True]
+    assert compacted.mask(3, ["tag:y"]).tolist() == [False, False, True]
+    # 元のビット集合は変更しない
+    assert bits.mask(4, ["tag:y"]).tolist() == [False, True, False, True]
+
+def test_vector_search_where_filters_before_top_k(sample_index):
+    index, vectors = sample_index
+    for i in range(1, 201):
+        index.set_doc_keys(f"hub_docs.documents:{i}", {"tag:even"} if i % 2 == 0 else {"tag:odd"})
+    # 条件に合う行が少ない場合(部分行列の計算)と多い場合(マスク)の両方を確認する
+    index.set_doc_keys("hub_docs.documents:7", {"tag:odd", "tag:rare"})
+    hits = index.search(vectors[0], top_k=5, where=["tag:rare"])
+    assert [hit.chunk_id for hit in hits] == [7]
+    hits = index.search(vectors[0], top_k=5, where=["tag:even"])
+    assert len(hits) == 5 and all(hit.chunk_id % 2 == 0 for hit in hits)
+    scores = vectors / np.linalg.norm(vectors, axis=1, keepdims=True) @ (vectors[0] / np.linalg.norm(vectors[0]))
+    expected = [int(i) + 1 for i in np.argsort(-scores) if (i + 1) % 2 == 0][:5]
+    assert [hit.chunk_id for hit in hits] == expected
+
+def test_ivf_search_where_keeps_recall_for_selective_filter():
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((2000, DIM)).astype(np.float32)
+    index = IVFIndex(DIM, n_lists=32, n_probe=2, train_size=2000)
+    refs = [f"d{i}" for i in range(2000)]
+    row_keys = [{"owner:1"} if i % 50 == 0 else {"owner:2"} for i in range(2000)]
+    index.add(list(range(2000)), vectors, refs, refs, row_keys=row_keys)
+    assert index.is_trained
+    query = vectors[123]
+    hits = index.search(query, top_k=10, where=["owner:1"])
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    allowed = np.arange(0, 2000, 50)
+    exact = allowed[np.argsort(-(normalized[allowed] @ (query / np.linalg.norm(query))))][:10]
+    assert [hit.chunk_id for hit in hits] == exact.tolist()
+    # 条件の緩い絞り込みではクラスタ走査の候補から条件に合う行だけを返す
+    assert all(hit.chunk_id % 50 != 0 for hit in index.search(query, top_k=10, where=["owner:2"]))
+
+def test_bm25_where_restricts_scored_rows():
+    texts = ["契約書の更新手続き", "契約書のひな形", "会議室の予約"]
+    index = BM25Index()
+    index.add([1, 2, 3], texts, ["a", "b", "c"], texts, row_keys=[{"tag:法務"}, set(), {"tag:法務"}])
+    assert {hit.chunk_id for hit in index.search("契約書")} == {1, 2}
+    assert [hit.chunk_id for hit in index.search("契約書", where=["tag:法務"])] == [1]
+    assert index.search("契約書", where=["tag:なし"]) == []
+
+def test_search_docs_filters_by_tag_owner_and_app():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    RAGSearcher.set_doc_metadata(RAGSearcher.doc_ref_for(1, LOCAL_DOCS_SOURCE), ["法務"], owner_id=3)
+    RAGSearcher.index_document(1, "契約書の更新手続きについて。", source=LOCAL_DOCS_SOURCE)
+    RAGSearcher.index_document(2, "契約書の更新手続きについて。", source=LOCAL_DOCS_SOURCE)
+    RAGSearcher.index_document(5, "契約書の更新手続きについて。")
+    refs = lambda hits: sorted(hit.doc_ref for hit in hits)
+    assert len(RAGSearcher.search_docs("契約書")) == 3
+    assert refs(RAGSearcher.search_docs("契約書", tags=["法務"])) == ["doc_app.local_docs:1"]
+    assert refs(RAGSearcher.search_docs("契約書", owner_id=3)) == ["doc_app.local_docs:1"]
+    assert refs(RAGSearcher.search_docs("契約書", app="hub-app")) == ["hub_docs.documents:5"]
+    # 索引登録後のタグ変更も反映される
+    RAGSearcher.set_doc_metadata(RAGSearcher.doc_ref_for(2, LOCAL_DOCS_SOURCE), ["法務"])
+    assert len(RAGSearcher.search_docs("契約書", tags=["法務"], app="user-app-docs")) == 2
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._doc_keys.clear()
+
+def metadata_db():
+    """doc_app のローカル文書・タグの表を持つSQLiteのセッション"""
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+
+    @event.listens_for(engine, "connect")
+    def attach_schema(conn, record):
+        conn.execute("ATTACH DATABASE ':memory:' AS doc_app")
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE doc_app.local_docs (id INTEGER PRIMARY KEY, owner_id INTEGER, "
+                          "content TEXT, is_active INTEGER)"))
+        conn.execute(text("CREATE TABLE doc_app.doc_tags (tag_id INTEGER PRIMARY KEY, tag_name TEXT)"))
+        conn.execute(text("CREATE TABLE doc_app.doc_tag_links (doc_id INTEGER, tag_id INTEGER)"))
+    return sessionmaker(bind=engine)()
+
+def test_search_docs_filters_by_tags_and_owner_loaded_from_db():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    db = metadata_db()
+    db.execute(text("INSERT INTO doc_app.local_docs VALUES (1, 3, '契約書の更新手続き。', 1), "
+                    "(2, 4, '契約書の更新手続き。', 1)"))
+    db.execute(text("INSERT INTO doc_app.doc_tags VALUES (1, '法務'), (2, '人事')"))
+    db.execute(text("INSERT INTO doc_app.doc_tag_links VALUES (1, 1), (1, 2), (2, 2)"))
+    db.commit()
+    assert RAGSearcher.load_metadata(db) == 2
+    for doc_id, content in db.execute(text("SELECT id, content FROM doc_app.local_docs")).all():
+        RAGSearcher.index_document(doc_id, content, source=LOCAL_DOCS_SOURCE)
+    RAGSearcher.index_document(5, "契約書の更新手続き。")
+    refs = lambda **kwargs: sorted(hit.doc_ref for hit in RAGSearcher.search_docs("契約書", **kwargs))
+    assert refs(tags=["法務"]) == ["doc_app.local_docs:1"]
+    assert refs(tags=["人事"]) == ["doc_app.local_docs:1", "doc_app.local_docs:2"]
+    assert refs(owner_id=4) == ["doc_app.local_docs:2"]
+    # タグの追加・削除と文書の削除は、その文書のメタデータを読み直すと反映される
+    db.execute(text("INSERT INTO doc_app.doc_tag_links VALUES (2, 1)"))
+    db.execute(text("DELETE FROM doc_app.doc_tag_links WHERE doc_id = 1 AND tag_id = 2"))
+    db.commit()
+    assert RAGSearcher.load_metadata(db, [1, 2]) == 2
+    assert refs(tags=["法務"]) == ["doc_app.local_docs:1", "doc_app.local_docs:2"]
+    assert refs(tags=["人事"]) == ["doc_app.local_docs:2"]
+    db.execute(text("DELETE FROM doc_app.local_docs WHERE id = 2"))
+    db.commit()
+    assert RAGSearcher.load_metadata(db, [2]) == 0
+    assert refs(owner_id=4) == [] and refs(tags=["法務"]) == ["doc_app.local_docs:1"]
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._doc_keys.clear()
+
+@pytest.mark.parametrize("mode", ["int8", "pq"])
+def test_quantized_index_reranks_to_exact_order(mode):
+    rng = np.random.default_rng(4)
+    vectors = rng.standard_normal((600, DIM)).astype(np.float32)
+    index = QuantizedIndex(DIM, mode=mode, n_subvectors=4, train_size=300, initial_capacity=8)
+    refs = [f"d{i}" for i in range(600)]
+    index.add(list(range(300)), vectors[:300], refs[:300], refs[:300])
+    index.add(list(range(300, 600)), vectors[300:], refs[300:], refs[300:])
+    assert index.is_trained
+    assert index.memory_bytes() < 600 * DIM * 4 / 3
+    query = vectors[42]
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = top_k_indices(normalized @ (query / np.linalg.norm(query)), 5)
+    hits = index.search(query, top_k=5)
+    assert [hit.chunk_id for hit in hits] == exact.tolist()
+    assert np.isclose(hits[0].score, 1.0, atol=1e-5)
+    # 削除と絞り込みは VectorIndex と同じ
+    index.remove_doc("d42")
+    assert 42 not in [hit.chunk_id for hit in index.search(query, top_k=5)]
+    index.set_doc_keys("d7", {"tag:x"})
+    assert [hit.chunk_id for hit in index.search(query, top_k=5, where=["tag:x"])] == [7]
+
+class GatedProductQuantizer(ProductQuantizer):
+    """学習を止めておき、学習中の検索・追加を確かめるテスト用の直積量子化"""
+    started = threading.Event()
+    gate = threading.Event()
+
+    def train(self, sample, iterations=15, seed=0):
+        self.started.set()
+        self.gate.wait(5)
+        super().train(sample, iterations=iterations, seed=1)
+
+def test_quantized_index_retrains_without_mixing_codebooks_and_codes():
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((700, DIM)).astype(np.float32)
+    refs = [f"d{i}" for i in range(700)]
+    index = QuantizedIndex(DIM, mode="pq", n_subvectors=4, train_size=300, initial_capacity=8)
+    index.add(list(range(300)), vectors[:300], refs[:300], refs[:300])
+    before = [hit.chunk_id for hit in index.search(vectors[3], top_k=10, rerank_factor=0)]
+    index.quantizer.__class__ = GatedProductQuantizer
+    thread = threading.Thread(target=index.train)
+    thread.start()
+    assert GatedProductQuantizer.started.wait(5)
+    # 学習中も検索は古い代表点と符号の組で行われ、追加は学習を待たない
+    assert [hit.chunk_id for hit in index.search(vectors[3], top_k=10, rerank_factor=0)] == before
+    index.add(list(range(300, 700)), vectors[300:], refs[300:], refs[300:])
+    GatedProductQuantizer.gate.set()
+    thread.join(5)
+    # 差し替え後は学習中に追加された行も含め、全行が新しい代表点で符号化されている
+    codes, _ = index.quantizer.encode(normalize_rows(vectors))
+    assert np.array_equal(index._codes[:700], codes)
+    assert index.search(vectors[650], top_k=1)[0].chunk_id == 650
+
+def test_quantized_index_compact_copies_codes_and_rerank_vectors(tmp_path):
+    rng = np.random.default_rng(9)
+    vectors = rng.standard_normal((400, DIM)).astype(np.float32)
+    refs = [f"d{i // 100}" for i in range(400)]
+    index = QuantizedIndex(DIM, mode="pq", n_subvectors=4, train_size=200, initial_capacity=8, path=str(tmp_path))
+    index.add(list(range(400)), vectors, refs, refs)
+    index.set_doc_keys("d3", {"tag:x"})
+    index.remove_doc("d0")
+    before = index.search(vectors[250], top_k=5)
+    assert index.compact() == 100
+    assert index.memory_bytes() == 300 * index.quantizer.bytes_per_vector()
+    assert not (tmp_path / "rerank_vectors.f32").exists()
+    after = index.search(vectors[250], top_k=5)
+    assert [hit.chunk_id for hit in after] == [hit.chunk_id for hit in before]
+    assert np.allclose([hit.score for hit in after], [hit.score for hit in before])
+    assert {hit.doc_ref for hit in index.search(vectors[250], top_k=5, where=["tag:x"])} == {"d3"}
+    index.add([400], vectors[:1], ["d4"], ["d4"])
+    assert index.search(vectors[0], top_k=1)[0].chunk_id == 400
+
+def test_recall_report_lists_each_mode():
+    rng = np.random.default_rng(5)
+    vectors = rng.standard_normal((400, DIM)).astype(np.float32)
+    report = recall_report(vectors, vectors[:20] + 0.01, top_k=5, n_subvectors=4)
+    by_mode = {row["mode"]: row for row in report}
+    assert set(by_mode) == {"float32", "int8", "pq"}
+    assert by_mode["int8"]["compression"] > 3 and by_mode["pq"]["compression"] == 16
+    for row in report:
+        assert row["recall_rerank"] >= row["recall_approx"] - 1e-9
+    assert by_mode["int8"]["recall_rerank"] > 0.95
+
+def test_sharded_index_matches_flat_search():
+    rng = np.random.default_rng(6)
+    vectors = rng.standard_normal((3000, DIM)).astype(np.float32)
+    refs = [f"d{i % 30}" for i in range(3000)]
+    sharded = ShardedIndex(DIM, workers=2, initial_capacity=8, min_rows_per_shard=500)
+    flat = VectorIndex(DIM)
+    try:
+        for start in range(0, 2000, 700):
+            end = min(start + 700, 2000)
+            for index in (sharded, flat):
+                index.add(list(range(start, end)), vectors[start:end], refs[start:end], refs[start:end])
+        assert sharded.shard_ranges(2000) == [(0, 1000), (1000, 2000)]
+        ids = lambda hits: [hit.chunk_id for hit in hits]
+        assert ids(sharded.search(vectors[3], top_k=10)) == ids(flat.search(vectors[3], top_k=10))
+        # 検索後に行列を作り直しても、ワーカーは新しい共有メモリを参照する
+        for index in (sharded, flat):
+            index.add(list(range(2000, 3000)), vectors[2000:], refs[2000:], refs[2000:])
+            index.remove_doc("d3")
+            index.set_doc_keys("d4", {"tag:x"})
+        assert ids(sharded.search(vectors[3], top_k=10)) == ids(flat.search(vectors[3], top_k=10))
+        assert ids(sharded.search(vectors[4], top_k=10, where=["tag:x"])) == \
+            ids(flat.search(vectors[4], top_k=10, where=["tag:x"]))
+    finally:
+        sharded.close()
+
+def test_sharded_index_close_waits_for_running_searches(monkeypatch):
+    vectors = np.random.default_rng(7).standard_normal((10, DIM)).astype(np.float32)
+    index = ShardedIndex(DIM, workers=2, initial_capacity=16)
+    index.add(list(range(10)), vectors, ["d"] * 10, ["s"] * 10)
+    name = index._shm.name
+    started, release = threading.Event(), threading.Event()
+    score = sharded_index._top_k_in_range
+
+    def blocked_score(*args):
+        started.set()
+        release.wait(5)
+        return score(*args)
+
+    monkeypatch.setattr(sharded_index, "_top_k_in_range", blocked_score)
+    results = []
+    search = threading.Thread(target=lambda: results.extend(index.search(vectors[2], top_k=1)))
+    search.start()
+    assert started.wait(5)
+    # 検索中はタイムアウトしても共有メモリを解放せず、新しい検索も受け付けない
+    assert index.close(timeout=0.05) is False
+    sharded_index.shared_memory.SharedMemory(name=name).close()
+    assert index.search(vectors[2]) == []
+    release.set()
+    search.join(5)
+    assert [hit.chunk_id for hit in results] == [2]
+    with pytest.raises(FileNotFoundError):
+        sharded_index.shared_memory.SharedMemory(name=name)
+    assert index.close() is True
+
+def test_sharded_index_compacts_and_rejects_changes_after_close():
+    vectors = np.random.default_rng(10).standard_normal((100, DIM)).astype(np.float32)
+    refs = [f"d{i // 10}" for i in range(100)]
+    index = ShardedIndex(DIM, workers=2, initial_capacity=8)
+    flat = VectorIndex(DIM)
+    try:
+        for target in (index, flat):
+            target.add(list(range(100)), vectors, refs, refs)
+            for doc_ref in ("d0", "d1", "d2"):
+                target.remove_doc(doc_ref)
+        assert index.compact() == 30 and len(index) == 70
+        ids = lambda hits: [hit.chunk_id for hit in hits]
+        assert ids(index.search(vectors[55], top_k=10)) == ids(flat.search(vectors[55], top_k=10))
+    finally:
+        index.close()
+    # close() の後に届いた変更は、共有メモリを参照する前に分かるエラーにする
+    with pytest.raises(RuntimeError):
+        index.add([100], vectors[:1], ["d9"], ["d9"])
+    with pytest.raises(RuntimeError):
+        index.remove_doc("d5")
+    assert index.compact(0.0) == 0 and index.search(vectors[0]) == []
+
+class CountingEmbedder(HashingEmbedder):
+    """Embedding化したテキスト数を数えるテスト用のEmbedder"""
+    def __init__(self, dim):
+        super().__init__(dim)
+        self.embedded = 0
+
+    def embed_batch(self, texts):
+        self.embedded += len(texts)
+        return super().embed_batch(texts)
+
+def test_index_document_embeds_only_new_chunks():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._local_vectors.clear()
+    embedder = CountingEmbedder(DIM)
+    RAGSearcher.configure(embedder=embedder)
+    sentences = [f"第{j}節の本文{'です' * (j * 7 % 11 + 1)}。" for j in range(1200)]
+    total = RAGSearcher.index_document(1, "".join(sentences))
+    assert embedder.embedded == total
+    # 途中の文を編集した場合は、変わったチャンクだけをEmbedding化する
+    embedder.embedded = 0
+    sentences[600] = "この節を書き換えました。" * 3
+    edited = "".join(sentences)
+    count = RAGSearcher.index_document(1, edited)
+    assert 0 < embedder.embedded < count / 10
+    # 同じ内容の別文書はベクトルを共有し、Embedding化しない
+    embedder.embedded = 0
+    RAGSearcher.index_document(2, edited)
+    assert embedder.embedded == 0
+    hits = RAGSearcher.search_docs("この章を書き換えました。", top_k=2, fusion="vector")
+    assert {hit.doc_ref for hit in hits} == {"hub_docs.documents:1", "hub_docs.documents:2"}
+    assert np.isclose(hits[0].score, hits[1].score)
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._local_vectors.clear()
+
+def test_local_vectors_are_released_with_the_last_referencing_document():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._local_vectors.clear()
+    RAGSearcher._local_doc_vectors.clear()
+    RAGSearcher._local_refcounts.clear()
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    RAGSearcher.index_document(1, "共通の本文。")
+    RAGSearcher.index_document(2, "共通の本文。")
+    RAGSearcher.index_document(1, "文書1の新しい本文。")
+    # 文書2が参照しているベクトルは残し、どの文書も参照しなくなったものだけを削除する
+    assert len(RAGSearcher._local_vectors) == 2
+    RAGSearcher.delete_document("hub_docs.documents:2")
+    assert len(RAGSearcher._local_vectors) == 1
+    RAGSearcher.delete_document("hub_docs.documents:1")
+    assert not RAGSearcher._local_vectors and not RAGSearcher._local_refcounts
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+
+def test_approximate_tokens_counts_wide_chars_individually():
+    assert approximate_tokens("") == 0
+    assert approximate_tokens("abcdefgh") == 2
+    assert approximate_tokens("日本語の文書") == 6
+
+def test_context_packer_dedups_and_fits_budget():
+    hits = [
+        SearchHit(1, "hub_docs.documents:1", 0.9, "a" * 40),
+        SearchHit(2, "hub_docs.documents:2", 0.8, "a" * 40),   # 本文が重複
+        SearchHit(3, "hub_docs.documents:3", 0.7, "b" * 400),  # 予算に収まらない
+        SearchHit(4, "hub_docs.documents:4", 0.6, "c" * 40),
+    ]
+    packer = ContextPacker(budget_tokens=40, count_tokens=approximate_tokens)
+    packed = packer.pack(hits)
+    assert [hit.chunk_id for hit in packed.hits] == [1, 4]
+    assert packed.tokens == 28
+    assert packed.saved_tokens == 14 + 104
+    assert packer.stats()["duplicates"] == 1 and packer.stats()["dropped_chunks"] == 1
+
+def test_search_hits_carry_full_chunk_text_for_the_prompt():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._local_vectors.clear()
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    content = "".join(f"これは{i}番目の規程の文です。" for i in range(100))
+    RAGSearcher.index_document(1, content)
+    hits = RAGSearcher.search_docs("50番目の規程", top_k=3)
+    # 検索結果はチャンク本文全体を持ち、スニペットは表示用に先頭だけを返す
+    assert len(hits[0].text) > SNIPPET_CHARS
+    for hit in hits:
+        assert hit.text == content[hit.start:hit.end]
+        assert hit.snippet == hit.text[:SNIPPET_CHARS]
+    packed = ContextPacker(budget_tokens=100000, count_tokens=approximate_tokens).pack(hits)
+    assert packed.tokens == sum(approximate_tokens(hit.text) + CHUNK_OVERHEAD_TOKENS for hit in hits)
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher._embedder = None
+    RAGSearcher._local_vectors.clear()
+
+def test_semantic_cache_matches_similar_query_within_scope():
+    rng = np.random.default_rng(2)
+    base = rng.standard_normal(DIM).astype(np.float32)
+    cache = SemanticCache(max_entries=4, threshold=0.9)
+    cache.store("休暇の申請方法は?", base, {"answer": "A"}, ["hub_docs.documents:1"], scope=((), 1, None))
+    near = base + 0.05 * rng.standard_normal(DIM).astype(np.float32)
+    hit = cache.lookup(near, scope=((), 1, None))
+    assert hit is not None and hit.answer == {"answer": "A"} and hit.similarity >= 0.9
+    # 絞り込み条件が違う場合と、類似度が閾値未満の場合は使わない
+    assert cache.lookup(near, scope=((), 2, None)) is None
+    assert cache.lookup(rng.standard_normal(DIM), scope=((), 1, None)) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+def test_semantic_cache_evicts_lru_and_invalidates_cited_docs():
+    vectors = np.eye(DIM, dtype=np.float32)
+    cache = SemanticCache(max_entries=2, threshold=0.9)
+    cache.store("q0", vectors[0], {"answer": "0"}, ["doc:a"])
+    cache.store("q1", vectors[1], {"answer": "1"}, ["doc:b"])
+    assert cache.lookup(vectors[0]) is not None
+    cache.store("q2", vectors[2], {"answer": "2"}, ["doc:a", "doc:c"])
+    # 最も長く使われていない q1 が追い出される
+    assert cache.lookup(vectors[1]) is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.invalidate_docs(["doc:a"]) == 2
+    assert len(cache) == 0
+    # 生成中に引用文書が破棄された回答は保存しない
+    generation = cache.generation()
+    cache.invalidate_docs(["doc:b"])
+    assert not cache.store("q1", vectors[1], {"answer": "1"}, ["doc:b"], generation=generation)
+    assert cache.store("q3", vectors[3], {"answer": "3"}, ["doc:d"], generation=generation)
+
+def test_semantic_cache_reuses_ids_of_scopes_without_entries():
+    vectors = np.eye(DIM, dtype=np.float32)
+    cache = SemanticCache(max_entries=2, threshold=0.9)
+    for i in range(50):
+        cache.store(f"q{i}", vectors[i % DIM], {"answer": str(i)}, [f"doc:{i}"], scope=((), i, None))
+    # 追い出された項目の絞り込み条件は番号を解放し、番号は保持できる項目数を超えない
+    assert len(cache._scope_ids) == 2 and max(cache._scope_ids.values()) < 2
+    assert cache.lookup(vectors[49 % DIM], scope=((), 49, None)).answer == {"answer": "49"}
+    assert cache.lookup(vectors[48 % DIM], scope=((), 47, None)) is None
+    cache.invalidate_docs(["doc:48", "doc:49"])
+    assert cache._scope_ids == {}
+
+def test_hashing_embedder_scores_paraphrases_below_semantic_threshold():
+    # 文字n-gramのハッシュは言い換えを近いベクトルにしないため、意味的キャッシュには使わない
+    embedder = HashingEmbedder(256)
+    assert not embedder.semantic
+    first, second = embedder.embed_batch(["ログイン方法は？", "どうやってログインする？"])
+    assert float(first @ second) < 0.5
+
+def test_index_document_notifies_change_listeners():
+    RAGSearcher._index = None
+    RAGSearcher._lexical = None
+    RAGSearcher.configure(embedder=HashingEmbedder(DIM))
+    changed = []
+    RAGSearcher.add_change_listener(changed.append)
+    try:
+        RAGSearcher.index_document(1, "本文。")
+        RAGSearcher.set_doc_metadata("hub_docs.documents:1", ["規程"])
+        RAGSearcher.remove_document("hub_docs.documents:1")
+        assert changed == ["hub_docs.documents:1"] * 3
+    finally:
+        RAGSearcher._change_listeners.remove(changed.append)
+        RAGSearcher._index = None
+        RAGSearcher._lexical = None
+        RAGSearcher._embedder = None
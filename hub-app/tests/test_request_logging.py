@@ -0,0 +1,85 @@
+# .\hub-app\tests\test_request_logging.py
+
+import asyncio
+import json
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from shared_libs.batch_writer import BatchWriter
+from shared_libs.request_logging import TRUNCATED_MARK, RequestLoggingMiddleware, api_log_writer
+
+class Route:
+    path = "/docs/{doc_id}"
+
+async def echo_app(scope, receive, send):
+    """本文を読み、ルートを設定して200を返すテスト用のASGIアプリ"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    scope["route"] = Route()
+    await send({"type": "http.response.start", "status": 201, "headers": []})
+    await send({"type": "http.response.body", "body": body})
+
+def call(middleware, path, body=b"", content_type=b"application/json"):
+    scope = {"type": "http", "method": "POST", "path": path,
+             "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]}
+    chunks = [body[:5], body[5:]]
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    return sent
+
+def test_middleware_records_route_status_size_and_truncated_body():
+    rows = []
+    writer = BatchWriter(rows.extend, batch_size=10, capacity=10)
+    middleware = RequestLoggingMiddleware(echo_app, writer, "hub-app", body_sample_rate=1.0, max_body_bytes=8)
+    body = json.dumps({"query": "x" * 20}).encode()
+    sent = call(middleware, "/docs/1", body)
+    # 応答はそのまま返る
+    assert sent[0]["status"] == 201 and sent[1]["body"] == body
+    call(middleware, "/auth/token", b'{"password": "secret"}')
+    call(middleware, "/static/app.css")
+    writer.flush()
+    assert len(rows) == 2
+    row = rows[0]
+    assert row["endpoint"] == "/docs/{doc_id}" and row["method"] == "POST"
+    assert row["response_status"] == 201 and row["request_size"] == len(body)
+    assert row["request_body"] == body[:8].decode() + TRUNCATED_MARK
+    assert row["latency_ms"] >= 0 and row["app_name"] == "hub-app"
+    # 認証情報を含むパスの本文は記録しない
+    assert rows[1]["endpoint"] == "/docs/{doc_id}" and rows[1]["request_body"] is None
+
+def test_api_log_writer_inserts_rows_in_one_statement():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def attach_schema(conn, record):
+        conn.execute("ATTACH DATABASE ':memory:' AS logs_schema")
+
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE logs_schema.api_logs (id INTEGER PRIMARY KEY, endpoint TEXT, method TEXT, "
+            "request_body TEXT, response_status INTEGER, latency_ms REAL, request_size INTEGER, "
+            "app_name TEXT, timestamp TIMESTAMP)"
+        ))
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    writer = api_log_writer(sessionmaker(bind=engine), batch_size=10, capacity=10)
+    middleware = RequestLoggingMiddleware(echo_app, writer, "user-app-docs")
+    for _ in range(3):
+        call(middleware, "/docs/1", b"{}")
+    writer.flush()
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT endpoint, response_status, app_name FROM logs_schema.api_logs")).all()
+    assert [tuple(row) for row in rows] == [("/docs/{doc_id}", 201, "user-app-docs")] * 3
+    assert sum(statement.startswith("INSERT") for statement in statements) == 1
@@ -0,0 +1,52 @@
+# .\hub-app\tests\test_single_flight.py
+
+import asyncio
+from shared_libs.single_flight import SingleFlight, normalize_query
+
+def test_normalize_query():
+    assert normalize_query("  What　is\tＡＩ? ") == normalize_query("what is ai?")
+    assert normalize_query("AIとは") != normalize_query("MLとは")
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        results = await asyncio.gather(*(flights.do("q", work) for _ in range(10)))
+        # 完了後は改めて実行する
+        again = await flights.do("q", work)
+        return results, again
+
+    results, again = asyncio.run(main())
+    assert results == ["answer"] * 10 and again == "answer"
+    assert len(calls) == 2
+    assert flights.stats() == {"leaders": 2, "followers": 9, "in_flight": 0}
+
+def test_errors_are_shared_and_leader_cancellation_does_not_affect_followers():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        return 42
+
+    async def main():
+        outcomes = await asyncio.gather(flights.do("e", fail), flights.do("e", fail), return_exceptions=True)
+        leader = asyncio.ensure_future(flights.do("s", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("s", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return outcomes, await follower
+
+    outcomes, value = asyncio.run(main())
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+    assert value == 42
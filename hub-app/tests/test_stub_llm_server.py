@@ -0,0 +1,63 @@
+# .\hub-app\tests\test_stub_llm_server.py
+
+import json
+import random
+import urllib.error
+import urllib.request
+import pytest
+from shared_libs.llm_provider import StubProvider, get_provider
+from shared_libs.stub_llm_server import LatencyModel, StubLLMServer
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**options):
+        server = StubLLMServer(port=0, **options)
+        servers.append(server)
+        return server, server.start()
+    yield start
+    for server in servers:
+        server.stop()
+
+def _post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=5) as resp:
+        return resp.read().decode()
+
+def test_latency_model_parse_and_sample():
+    rng = random.Random(0)
+    assert LatencyModel.parse("fixed:0.2").sample(rng) == 0.2
+    assert 0.1 <= LatencyModel.parse("uniform:0.1,0.3").sample(rng) <= 0.3
+    samples = sorted(LatencyModel.parse("lognormal:0.5,0.8").sample(rng) for _ in range(2001))
+    assert 0.4 < samples[1000] < 0.6
+    with pytest.raises(ValueError):
+        LatencyModel.parse("gamma:1")
+
+def test_stub_server_speaks_completions_format(stub):
+    server, base_url = stub(latency="fixed:0", token_rate=0, tokens=4)
+    provider = StubProvider(base_url=base_url)
+    url, headers, payload = provider.completion_request("Hello", max_tokens=2)
+    data = json.loads(_post(url, payload))
+    assert provider.parse_completion(data) == " token0 token1"
+
+    url, headers, payload = provider.completion_request("Hello", max_tokens=10, stream=True)
+    lines = [line[len("data: "):] for line in _post(url, payload).splitlines() if line.startswith("data: ")]
+    assert lines[-1] == "[DONE]"
+    assert [provider.parse_stream_event(json.loads(line)) for line in lines[:-1]] == [f" token{i}" for i in range(4)]
+    assert server.stats()["requests"] == 2 and server.stats()["streams"] == 1
+
+def test_stub_server_injects_errors(stub):
+    server, base_url = stub(latency="fixed:0", error_rate=1.0, error_status=429)
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        _post(f"{base_url}/completions", {"prompt": "Hello"})
+    assert excinfo.value.code == 429
+    assert excinfo.value.headers["Retry-After"] == "1"
+    assert server.stats()["errors"] == 1
+
+def test_get_provider():
+    assert get_provider("stub").name == "stub"
+    assert get_provider("openai", model="gpt-x").model == "gpt-x"
+    with pytest.raises(ValueError):
+        get_provider("unknown")
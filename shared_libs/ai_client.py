@@ -1,38 +1,403 @@
 # .\shared-libs\ai_client.py
 """
 ai_client.py
-AI(LLM)を呼び出すクライアント処理をまとめる例
+AI(LLM)を呼び出すクライアント処理(接続を使い回す非同期HTTPクライアント・タイムアウト・再試行)
 """
 
-import os
-import requests
+import asyncio
+import json
 import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from shared_libs.flow_control import AdaptiveConcurrencyLimiter, CircuitBreaker, HedgingPolicy, TokenBucket
+from shared_libs.llm_provider import LLMProvider, OpenAIProvider
 
 logger = logging.getLogger(__name__)
 
+# 再試行の対象とするHTTPステータス(レート制限・一時的なサーバーエラー)
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+ERROR_PREFIX = "エラー:"
+ERROR_UNAVAILABLE = f"{ERROR_PREFIX} サービスが利用できません。"
+ERROR_CONNECTION = f"{ERROR_PREFIX} AIサービスへの接続に失敗しました。"
+ERROR_CIRCUIT_OPEN = f"{ERROR_PREFIX} AIサービスが混雑しています。しばらくしてから再度お試しください。"
+
+
+class AIClientError(Exception):
+    """ストリーミング呼び出しの失敗(途中まで送った応答を取り消せないため、文字列ではなく例外で伝える)。"""
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出さなかった。"""
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
 class AIClient:
+    """
+    LLM呼び出しのクライアント。呼び出し先は provider(LLMProvider)で差し替えられる。
+    プロセス内で1つの httpx.AsyncClient(接続プール)を共有し、
+    TCP/TLS接続を使い回す(h2 がインストールされていれば HTTP/2 で多重化する)。
+
+    - 接続・読み取り・書き込み・プール待ちそれぞれにタイムアウトを設定する。
+    - 接続エラー・タイムアウト・RETRY_STATUSES の応答は、指数バックオフ + ジッター(full jitter)で
+      max_retries 回まで再試行する。429 / 503 の Retry-After は上限 backoff_max まで尊重する。
+    - 失敗時は従来どおり例外ではなくエラーメッセージの文字列を返す。
+    - プロセス全体で共有するトークンバケット(毎秒 rate_limit 件)、応答時間と429に応じて上限を変える
+      同時実行数の制限、連続した失敗で呼び出しを止めるサーキットブレーカーを通して呼び出す。
+      ブレーカーが開いている間は ERROR_CIRCUIT_OPEN を即座に返す。状態と件数は stats() で返す。
+    - hedge を有効にすると、acall_llm の応答が直近の応答時間の hedge_percentile パーセンタイルを過ぎても
+      返らない場合に同じ要求をもう1件送り、先に成功した方を返す(残りは取り消す)。
+      追加の要求は呼び出し件数の hedge_budget の割合までに抑える(HedgingPolicy)。
+    """
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 5.0
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    provider: LLMProvider = OpenAIProvider()
+    max_tokens: int = 200
+    rate_limit: float = 0.0
+    rate_burst: Optional[float] = None
+    min_concurrency: int = 1
+    max_concurrency: int = 50
+    target_latency: float = 20.0
+    breaker_failures: int = 5
+    breaker_reset_seconds: float = 30.0
+    hedge: bool = False
+    hedge_percentile: float = 95.0
+    hedge_budget: float = 0.05
+    hedge_min_delay: float = 0.05
+    _client: Optional[httpx.AsyncClient] = None
+    _rate_limiter: Optional[TokenBucket] = None
+    _concurrency: Optional[AdaptiveConcurrencyLimiter] = None
+    _breaker: Optional[CircuitBreaker] = None
+    _hedging: Optional[HedgingPolicy] = None
+
     @staticmethod
-    def call_llm(prompt: str) -> str:
-        api_key = os.getenv("OPENAI_API_KEY", "")
-        if not api_key:
-            logger.error("OpenAI APIキーが設定されていません。")
-            return "エラー: サービスが利用できません。"
-
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": "text-davinci-003",
-            "prompt": prompt,
-            "max_tokens": 200
+    def configure(**settings) -> None:
+        """タイムアウト・接続数・再試行回数などを設定する。作成済みの接続プールは次回から作り直す。"""
+        for name, value in settings.items():
+            if value is None:
+                continue
+            if not hasattr(AIClient, name) or name.startswith("_"):
+                raise ValueError(f"未対応の設定です: {name}")
+            setattr(AIClient, name, value)
+        AIClient._client = None
+        AIClient._rate_limiter = None
+        AIClient._concurrency = None
+        AIClient._breaker = None
+        AIClient._hedging = None
+
+    @staticmethod
+    def timeout() -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=AIClient.connect_timeout,
+            read=AIClient.read_timeout,
+            write=AIClient.write_timeout,
+            pool=AIClient.pool_timeout,
+        )
+
+    @staticmethod
+    def get_client() -> httpx.AsyncClient:
+        """共有の接続プールを返す(初回呼び出し時に作成する)。"""
+        if AIClient._client is None or AIClient._client.is_closed:
+            AIClient._client = httpx.AsyncClient(
+                http2=_http2_available(),
+                timeout=AIClient.timeout(),
+                limits=httpx.Limits(
+                    max_connections=AIClient.max_connections,
+                    max_keepalive_connections=AIClient.max_keepalive_connections,
+                    keepalive_expiry=AIClient.keepalive_expiry,
+                ),
+            )
+        return AIClient._client
+
+    @staticmethod
+    def rate_limiter() -> TokenBucket:
+        if AIClient._rate_limiter is None:
+            AIClient._rate_limiter = TokenBucket(AIClient.rate_limit, AIClient.rate_burst)
+        return AIClient._rate_limiter
+
+    @staticmethod
+    def concurrency() -> AdaptiveConcurrencyLimiter:
+        if AIClient._concurrency is None:
+            AIClient._concurrency = AdaptiveConcurrencyLimiter(
+                initial=AIClient.max_concurrency,
+                min_limit=AIClient.min_concurrency,
+                max_limit=AIClient.max_concurrency,
+                target_latency=AIClient.target_latency,
+            )
+        return AIClient._concurrency
+
+    @staticmethod
+    def breaker() -> CircuitBreaker:
+        if AIClient._breaker is None:
+            AIClient._breaker = CircuitBreaker(AIClient.breaker_failures, AIClient.breaker_reset_seconds)
+        return AIClient._breaker
+
+    @staticmethod
+    def hedging() -> HedgingPolicy:
+        if AIClient._hedging is None:
+            AIClient._hedging = HedgingPolicy(
+                percentile=AIClient.hedge_percentile,
+                budget=AIClient.hedge_budget,
+                min_delay=AIClient.hedge_min_delay,
+            )
+        return AIClient._hedging
+
+    @staticmethod
+    def stats() -> dict:
+        """流量制御の状態と件数(ダッシュボード用)。"""
+        return {
+            "rate_limiter": AIClient.rate_limiter().stats(),
+            "concurrency": AIClient.concurrency().stats(),
+            "circuit_breaker": AIClient.breaker().stats(),
+            "hedging": {"enabled": AIClient.hedge, **AIClient.hedging().stats()},
         }
+
+    @staticmethod
+    @asynccontextmanager
+    async def guarded() -> AsyncIterator[dict]:
+        """
+        1回の呼び出し(再試行の1回分)をサーキットブレーカー・トークンバケット・同時実行数の制限で囲む。
+        ブロック内で送出された例外から結果を判定し、ブレーカーと同時実行数の上限に反映する。
+        ストリーミングでは応答ヘッダーを受け取った時点の経過秒数を yield した辞書の "latency" に入れる。
+        """
+        breaker = AIClient.breaker()
+        if not breaker.allow():
+            raise CircuitOpenError()
+        await AIClient.rate_limiter().acquire()
+        limiter = AIClient.concurrency()
+        await limiter.acquire()
+        outcome: dict = {}
+        started = time.monotonic()
+        latency = None
+        overloaded = False
         try:
-            resp = requests.post("https://api.openai.com/v1/completions", 
-                                 headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            return data["choices"][0]["text"].strip()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"LLM呼び出しエラー: {e}")
-            return "エラー: AIサービスへの接続に失敗しました。"
\ No newline at end of file
+            yield outcome
+            latency = outcome.get("latency", time.monotonic() - started)
+            breaker.record_success()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            overloaded = status == 429 or isinstance(e, httpx.TimeoutException)
+            latency = time.monotonic() - started
+            if status is None or status == 429 or status >= 500:
+                breaker.record_failure()
+            else:
+                # 4xx(429以外)は要求側の問題で、サービスは応答しているため成功として扱う
+                breaker.record_success()
+            raise
+        finally:
+            await limiter.release(latency, overloaded)
+
+    @staticmethod
+    async def aclose() -> None:
+        """接続プールを閉じる(アプリ終了時に呼ぶ)。"""
+        client = AIClient._client
+        AIClient._client = None
+        if client is not None:
+            await client.aclose()
+
+    @staticmethod
+    def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+        """attempt 回目(0始まり)の失敗後に待つ秒数。Retry-After があればそれを優先する。"""
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), AIClient.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(AIClient.backoff_max, AIClient.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def model_name() -> str:
+        """呼び出し先とモデルの名前(応答キャッシュのキー・保存時のモデル名に使う)。"""
+        return f"{AIClient.provider.name}:{AIClient.provider.model}"
+
+    @staticmethod
+    def params() -> dict:
+        """プロンプト以外で応答に影響する生成パラメータ(応答キャッシュのキーに含める)。"""
+        return {"max_tokens": AIClient.max_tokens}
+
+    @staticmethod
+    def is_error(response: str) -> bool:
+        """call_llm / acall_llm が失敗時に返すエラーメッセージかどうか。"""
+        return response.startswith(ERROR_PREFIX)
+
+    @staticmethod
+    def _request(prompt: str, stream: bool = False) -> Optional[tuple]:
+        return AIClient.provider.completion_request(prompt, AIClient.max_tokens, stream=stream)
+
+    @staticmethod
+    async def acall_llm(prompt: str) -> str:
+        """LLMを非同期に呼び出し、生成されたテキストを返す。待機中はイベントループを塞がない。"""
+        if not AIClient.hedge:
+            return await AIClient._acall_llm(prompt)
+        return await AIClient._hedged_call(prompt)
+
+    @staticmethod
+    async def _hedged_call(prompt: str) -> str:
+        """
+        HedgingPolicy の待ち時間までに応答がなければ、予算の範囲で同じ要求をもう1件送る。
+        先に成功した応答を返し、もう一方は取り消す。両方が失敗した場合は元の要求の結果を返す。
+        """
+        policy = AIClient.hedging()
+        deadline = policy.deadline()
+        started = time.monotonic()
+        primary = asyncio.ensure_future(AIClient._acall_llm(prompt))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=deadline)
+            if not done and policy.try_hedge():
+                logger.info(f"LLMの応答が {deadline:.2f} 秒を過ぎたため、同じ要求をもう1件送ります。")
+                tasks.append(asyncio.ensure_future(AIClient._acall_llm(prompt)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in tasks if task in done and not AIClient.is_error(task.result())),
+                              None)
+                if winner is not None:
+                    if len(tasks) > 1:
+                        policy.record_winner(hedge_won=winner is not primary)
+                    policy.record(time.monotonic() - started)
+                    return winner.result()
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    async def _acall_llm(prompt: str) -> str:
+        """acall_llm の1件分の呼び出し(再試行を含む)。"""
+        request = AIClient._request(prompt)
+        if request is None:
+            logger.error(f"LLMプロバイダー({AIClient.provider.name})の認証情報が設定されていません。")
+            return ERROR_UNAVAILABLE
+        url, headers, payload = request
+        client = AIClient.get_client()
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with AIClient.guarded():
+                    resp = await client.post(url, headers=headers, json=payload)
+                    if resp.status_code in RETRY_STATUSES and attempt < AIClient.max_retries:
+                        retry_after = resp.headers.get("Retry-After")
+                        raise httpx.HTTPStatusError(f"status={resp.status_code}", request=resp.request, response=resp)
+                    resp.raise_for_status()
+                return AIClient.provider.parse_completion(resp.json()).strip()
+            except CircuitOpenError:
+                logger.warning("サーキットブレーカーが開いているため、LLMを呼び出しません。")
+                return ERROR_CIRCUIT_OPEN
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = isinstance(e, httpx.TransportError) or e.response.status_code in RETRY_STATUSES
+                if not retryable or attempt >= AIClient.max_retries:
+                    logger.error(f"LLM呼び出しエラー: {e}")
+                    return ERROR_CONNECTION
+                delay = AIClient.backoff_delay(attempt, retry_after)
+                logger.warning(f"LLM呼び出しを {delay:.2f} 秒後に再試行します({attempt + 1}/{AIClient.max_retries}): {e}")
+                attempt += 1
+                await asyncio.sleep(delay)
+            except (KeyError, IndexError, ValueError) as e:
+                logger.error(f"LLM応答の形式が不正です: {e}")
+                return ERROR_CONNECTION
+
+    @staticmethod
+    async def astream_llm(prompt: str) -> AsyncIterator[str]:
+        """
+        LLMの応答を生成された順に断片(トークン)ごとに返す非同期ジェネレータ。
+        応答全体を保持しないため、応答の長さによらずメモリ使用量は一定。
+        最初の断片を返す前の失敗は acall_llm と同じ条件で再試行し、それ以外の失敗は AIClientError を送出する。
+        """
+        request = AIClient._request(prompt, stream=True)
+        if request is None:
+            logger.error(f"LLMプロバイダー({AIClient.provider.name})の認証情報が設定されていません。")
+            raise AIClientError(ERROR_UNAVAILABLE)
+        url, headers, payload = request
+        client = AIClient.get_client()
+        attempt = 0
+        started = False
+        while True:
+            retry_after = None
+            try:
+                async with AIClient.guarded() as outcome:
+                    sent_at = time.monotonic()
+                    async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                        outcome["latency"] = time.monotonic() - sent_at
+                        if resp.status_code in RETRY_STATUSES and attempt < AIClient.max_retries:
+                            retry_after = resp.headers.get("Retry-After")
+                            raise httpx.HTTPStatusError(f"status={resp.status_code}", request=resp.request, response=resp)
+                        resp.raise_for_status()
+                        async for line in resp.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                break
+                            text = AIClient.provider.parse_stream_event(json.loads(data))
+                            if text:
+                                started = True
+                                yield text
+                return
+            except CircuitOpenError as e:
+                logger.warning("サーキットブレーカーが開いているため、LLMを呼び出しません。")
+                raise AIClientError(ERROR_CIRCUIT_OPEN) from e
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = isinstance(e, httpx.TransportError) or e.response.status_code in RETRY_STATUSES
+                if started or not retryable or attempt >= AIClient.max_retries:
+                    logger.error(f"LLMストリーミング呼び出しエラー: {e}")
+                    raise AIClientError(ERROR_CONNECTION) from e
+                delay = AIClient.backoff_delay(attempt, retry_after)
+                logger.warning(f"LLM呼び出しを {delay:.2f} 秒後に再試行します({attempt + 1}/{AIClient.max_retries}): {e}")
+                attempt += 1
+                await asyncio.sleep(delay)
+            except (KeyError, IndexError, ValueError) as e:
+                logger.error(f"LLM応答の形式が不正です: {e}")
+                raise AIClientError(ERROR_CONNECTION) from e
+
+    @staticmethod
+    def call_llm(prompt: str) -> str:
+        """
+        同期版。イベントループの外(スクリプトなど)から呼ぶ場合に使う。
+        非同期版と同じタイムアウト・再試行の設定で、呼び出しごとに接続を閉じる。
+        """
+        request = AIClient._request(prompt)
+        if request is None:
+            logger.error(f"LLMプロバイダー({AIClient.provider.name})の認証情報が設定されていません。")
+            return ERROR_UNAVAILABLE
+        url, headers, payload = request
+        with httpx.Client(timeout=AIClient.timeout()) as client:
+            for attempt in range(AIClient.max_retries + 1):
+                # 同期版はトークンバケットだけを共有する
+                time.sleep(AIClient.rate_limiter().reserve())
+                try:
+                    resp = client.post(url, headers=headers, json=payload)
+                    if resp.status_code not in RETRY_STATUSES or attempt >= AIClient.max_retries:
+                        resp.raise_for_status()
+                        return AIClient.provider.parse_completion(resp.json()).strip()
+                    delay = AIClient.backoff_delay(attempt, resp.headers.get("Retry-After"))
+                except httpx.TransportError as e:
+                    if attempt >= AIClient.max_retries:
+                        logger.error(f"LLM呼び出しエラー: {e}")
+                        return ERROR_CONNECTION
+                    delay = AIClient.backoff_delay(attempt)
+                except (httpx.HTTPStatusError, KeyError, IndexError, ValueError) as e:
+                    logger.error(f"LLM呼び出しエラー: {e}")
+                    return ERROR_CONNECTION
+                time.sleep(delay)
+        return ERROR_CONNECTION
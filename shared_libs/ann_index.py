@@ -0,0 +1,479 @@
+# .\shared-libs\ann_index.py
+"""
+ann_index.py
+IVF(転置ファイル)方式の近似最近傍索引と、メモリマップファイルへの永続化
+"""
+
+import json
+import logging
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_libs.row_bitsets import RowBitsets
+from shared_libs.vector_index import (
+    COMPACT_RATIO, SearchHit, group_rows, normalize_rows, to_span_array, top_k_indices,
+)
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+CENTROIDS_FILE = "centroids.npy"
+VECTORS_FILE = "vectors.f32"
+CHUNK_IDS_FILE = "chunk_ids.i64"
+LIST_IDS_FILE = "list_ids.i32"
+REFS_FILE = "refs.jsonl"
+
+# 未学習の行に割り当てるリスト番号
+UNASSIGNED = -1
+# 削除済みの行に割り当てるリスト番号
+DELETED = -2
+
+
+def train_centroids(vectors: np.ndarray, n_lists: int, iterations: int = 10,
+                    seed: int = 0, batch_size: int = 65536) -> np.ndarray:
+    """
+    球面k-means(内積で割り当て、平均を正規化)でクラスタ中心を学習する。
+    """
+    vectors = normalize_rows(vectors)
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists, vectors.shape[0])
+    centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(n_lists, dtype=np.int64)
+        for start in range(0, vectors.shape[0], batch_size):
+            batch = vectors[start:start + batch_size]
+            assign = np.argmax(batch @ centroids.T, axis=1)
+            np.add.at(sums, assign, batch)
+            counts += np.bincount(assign, minlength=n_lists)
+        empty = counts == 0
+        if empty.any():
+            # 空クラスタはランダムな点で再初期化する
+            sums[empty] = vectors[rng.choice(vectors.shape[0], int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    ベクトルを n_lists 個のクラスタに分け、クエリに近い n_probe 個のクラスタだけを走査する索引。
+    n_probe を増やすと再現率が上がり、減らすと検索が速くなる。
+    path を指定するとベクトル本体をメモリマップファイルに置き、再起動時に再構築せず読み込める。
+    文書単位の削除は行をクラスタから外して DELETED を記録するだけで、削除済みの行が増えたら
+    compact で生きている行だけを次の世代のファイルに書き写す(メタ情報が現在の世代を指す)。
+    絞り込み用のビット集合(filters)はメモリ上にのみ持ち、読み込み後に set_doc_keys で設定し直す。
+    """
+
+    def __init__(self, dim: int, n_lists: int = 256, n_probe: int = 8,
+                 path: Optional[str] = None, train_size: Optional[int] = None,
+                 initial_capacity: int = 1024, generation: int = 0):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.path = path
+        # この件数に達した時点で自動的にクラスタ中心を学習する
+        self.train_size = train_size or n_lists * 40
+        self.centroids: Optional[np.ndarray] = None
+        # 永続化ファイルの世代(compact のたびに増やし、ファイル名に付ける。load はメタ情報の値を渡す)
+        self.generation = generation
+        self._lists: List[array] = [array("q") for _ in range(n_lists)]
+        self._doc_refs: List[str] = []
+        self._texts: List[str] = []
+        self._spans: List[Tuple[int, int]] = []
+        self._rows_by_ref: Dict[str, List[int]] = {}
+        self.filters = RowBitsets()
+        self._deleted = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self._open_storage(max(initial_capacity, 1))
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def doc_refs(self) -> List[str]:
+        """登録されている(削除されていない)文書参照の一覧を返す。"""
+        with self._lock:
+            return list(self._rows_by_ref)
+
+    def set_doc_keys(self, doc_ref: str, keys: Iterable[str]) -> None:
+        """文書 doc_ref の全チャンクの絞り込み用キーを置き換える。"""
+        with self._lock:
+            self.filters.set_doc_keys(doc_ref, self._rows_by_ref.get(doc_ref, []), keys)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    # ---- ストレージ ----
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _data_file(self, name: str, generation: Optional[int] = None) -> str:
+        """行ごとのデータを置くファイルのパス。世代0は元のファイル名、以降は世代番号を付ける。"""
+        generation = self.generation if generation is None else generation
+        return self._file(name if generation == 0 else f"{name}.{generation}")
+
+    def _open_array(self, name: str, dtype, shape, old: Optional[np.ndarray]) -> np.ndarray:
+        if not self.path:
+            data = np.zeros(shape, dtype=dtype)
+            if old is not None:
+                data[:old.shape[0]] = old
+            return data
+        if old is not None and isinstance(old, np.memmap):
+            old.flush()
+        file_path = self._data_file(name)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(file_path, "ab") as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        return np.memmap(file_path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_storage(self, capacity: int) -> None:
+        old = getattr(self, "_vectors", None)
+        old_ids = getattr(self, "_chunk_ids", None)
+        old_lists = getattr(self, "_list_ids", None)
+        self._vectors = self._open_array(VECTORS_FILE, np.float32, (capacity, self.dim), old)
+        self._chunk_ids = self._open_array(CHUNK_IDS_FILE, np.int64, (capacity,), old_ids)
+        self._list_ids = self._open_array(LIST_IDS_FILE, np.int32, (capacity,), old_lists)
+        self._capacity = capacity
+
+    def _reserve(self, required: int) -> None:
+        if required <= self._capacity:
+            return
+        capacity = self._capacity
+        while capacity < required:
+            capacity *= 2
+        self._open_storage(capacity)
+
+    def _write_meta(self) -> None:
+        if not self.path:
+            return
+        meta = {
+            "dim": self.dim,
+            "n_lists": self.n_lists,
+            "n_probe": self.n_probe,
+            "train_size": self.train_size,
+            "size": self._size,
+            "capacity": self._capacity,
+            "trained": self.is_trained,
+            "generation": self.generation,
+        }
+        tmp_path = self._file(META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file(META_FILE))
+
+    # ---- 学習・追加 ----
+
+    def train(self, sample: Optional[np.ndarray] = None, iterations: int = 10) -> None:
+        """
+        クラスタ中心を学習し、登録済みの全行をクラスタへ割り当て直す。
+        sample を省略した場合は登録済みベクトルから学習する。
+        """
+        if sample is None:
+            sample = np.asarray(self._vectors[:self._size])
+        if sample.shape[0] < self.n_lists:
+            raise ValueError(f"学習には少なくとも {self.n_lists} 件のベクトルが必要です。")
+        # k-means はロックの外で実行し、割り当ての差し替えだけをロック内で行う
+        centroids = train_centroids(sample, self.n_lists, iterations=iterations)
+        with self._lock:
+            self.centroids = centroids
+            if self.path:
+                np.save(self._file(CENTROIDS_FILE), self.centroids)
+            if self._size:
+                assign = self._assign(self._vectors[:self._size])
+                live = np.asarray(self._list_ids[:self._size]) != DELETED
+                self._list_ids[:self._size][live] = assign[live]
+            self._rebuild_lists()
+            self._write_meta()
+        logger.info(f"IVF索引を学習しました: lists={self.n_lists}, rows={self._size}")
+
+    def _assign(self, vectors: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        assign = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], batch_size):
+            assign[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ self.centroids.T, axis=1)
+        return assign
+
+    def _rebuild_lists(self) -> None:
+        list_ids = np.asarray(self._list_ids[:self._size])
+        order = np.argsort(list_ids, kind="stable")
+        bounds = np.searchsorted(list_ids[order], np.arange(self.n_lists + 1))
+        self._lists = [array("q", order[bounds[i]:bounds[i + 1]].tolist()) for i in range(self.n_lists)]
+
+    def add(self, chunk_ids: Sequence[int], vectors: np.ndarray,
+            doc_refs: Sequence[str], texts: Sequence[str],
+            spans: Optional[Sequence[Tuple[int, int]]] = None,
+            row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """
+        チャンクを追加する。学習済みなら最も近いクラスタへ即座に割り当てる。
+        row_keys は各チャンクの絞り込み用キー(省略時は文書に設定済みのキー)。
+        """
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"次元数が一致しません: expected={self.dim}, actual={vectors.shape[1]}")
+        if not (len(chunk_ids) == len(doc_refs) == len(texts) == count):
+            raise ValueError("chunk_ids / vectors / doc_refs / texts の件数が一致しません。")
+        span_list = [tuple(span) for span in to_span_array(spans, count).tolist()]
+        with self._lock:
+            start = self._size
+            self._reserve(start + count)
+            self._vectors[start:start + count] = vectors
+            self._chunk_ids[start:start + count] = np.asarray(chunk_ids, dtype=np.int64)
+            if self.is_trained:
+                assign = self._assign(vectors)
+                self._list_ids[start:start + count] = assign
+                for offset, list_id in enumerate(assign.tolist()):
+                    self._lists[list_id].append(start + offset)
+            else:
+                self._list_ids[start:start + count] = UNASSIGNED
+            self._doc_refs.extend(doc_refs)
+            self._texts.extend(texts)
+            self._spans.extend(span_list)
+            for offset, doc_ref in enumerate(doc_refs):
+                self._rows_by_ref.setdefault(doc_ref, []).append(start + offset)
+            self.filters.add_rows(start, doc_refs, row_keys)
+            if self.path:
+                self._append_refs(doc_refs, texts, span_list)
+            self._size = start + count
+            self._write_meta()
+        if not self.is_trained and self._size >= self.train_size:
+            self.train()
+
+    def _append_refs(self, doc_refs: Sequence[str], texts: Sequence[str],
+                     span_list: Sequence[Tuple[int, int]]) -> None:
+        with open(self._data_file(REFS_FILE), "a", encoding="utf-8") as f:
+            for doc_ref, chunk_text, (span_start, span_end) in zip(doc_refs, texts, span_list):
+                f.write(json.dumps([doc_ref, chunk_text, span_start, span_end], ensure_ascii=False) + "\n")
+
+    def remove_doc(self, doc_ref: str) -> int:
+        """doc_ref に属するチャンクを検索対象から外し、外した件数を返す。"""
+        with self._lock:
+            rows = self._rows_by_ref.pop(doc_ref, [])
+            if rows:
+                list_ids = np.asarray(self._list_ids[rows])
+                self._list_ids[rows] = DELETED
+                # クラスタごとに1回だけ、外す行の集合で絞り込んで作り直す
+                removed = set(rows)
+                for list_id in np.unique(list_ids[list_ids >= 0]).tolist():
+                    self._lists[list_id] = array("q", [row for row in self._lists[list_id] if row not in removed])
+                self._deleted += len(rows)
+        return len(rows)
+
+    def compact(self, min_ratio: float = COMPACT_RATIO) -> int:
+        """
+        削除済みの行が全行の min_ratio 以上あれば、生きている行だけを次の世代の配列(ファイル)に書き写して
+        差し替え、取り除いた行数を返す。メタ情報を書き換えた時点で新しい世代に切り替わるため、途中で停止しても
+        前の世代から読み込める。差し替え前に始まった検索は古い配列のまま最後まで実行できる。
+        """
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            if deleted == 0 or deleted < size * min_ratio:
+                return 0
+            keep = np.flatnonzero(np.asarray(self._list_ids[:size]) != DELETED)
+            count = keep.shape[0]
+            old_generation = self.generation
+            self.generation += 1
+            doc_refs = [self._doc_refs[row] for row in keep.tolist()]
+            texts = [self._texts[row] for row in keep.tolist()]
+            spans = [self._spans[row] for row in keep.tolist()]
+            capacity = max(count, 1)
+            vectors = self._open_array(VECTORS_FILE, np.float32, (capacity, self.dim), None)
+            vectors[:count] = self._vectors[keep]
+            chunk_ids = self._open_array(CHUNK_IDS_FILE, np.int64, (capacity,), None)
+            chunk_ids[:count] = self._chunk_ids[keep]
+            list_ids = self._open_array(LIST_IDS_FILE, np.int32, (capacity,), None)
+            list_ids[:count] = self._list_ids[keep]
+            if self.path:
+                for data in (vectors, chunk_ids, list_ids):
+                    data.flush()
+                self._append_refs(doc_refs, texts, spans)
+            self._vectors, self._chunk_ids, self._list_ids = vectors, chunk_ids, list_ids
+            self._doc_refs, self._texts, self._spans = doc_refs, texts, spans
+            self._rows_by_ref = group_rows(doc_refs)
+            self.filters = self.filters.compact(keep, size)
+            self._capacity = capacity
+            self._deleted = 0
+            self._size = count
+            self._rebuild_lists()
+            self._write_meta()
+            if self.path:
+                self._remove_generation(old_generation)
+        logger.info(f"IVF索引を詰め直しました: rows={count}, removed={deleted}, generation={self.generation}")
+        return deleted
+
+    def _remove_generation(self, generation: int) -> None:
+        """使わなくなった世代のファイルを削除する(開いたままで削除できない環境では次の起動後に残る)。"""
+        for name in (VECTORS_FILE, CHUNK_IDS_FILE, LIST_IDS_FILE, REFS_FILE):
+            try:
+                os.remove(self._data_file(name, generation))
+            except OSError as e:
+                logger.warning(f"IVF索引の古いファイルを削除できませんでした: {e}")
+
+    def live_chunk_ids(self) -> np.ndarray:
+        """削除されていない行のチャンクIDを返す。"""
+        with self._lock:
+            live = np.asarray(self._list_ids[:self._size]) != DELETED
+            return np.asarray(self._chunk_ids[:self._size])[live]
+
+    def remove_chunks(self, chunk_ids: Iterable[int]) -> int:
+        """
+        chunk_ids のチャンクを検索対象から外し、外した件数を返す
+        (他のプロセスがDBで削除・置換したチャンクを、永続化済みの索引から除くために使う)。
+        """
+        targets = np.fromiter(chunk_ids, dtype=np.int64)
+        with self._lock:
+            size = self._size
+            live = np.asarray(self._list_ids[:size]) != DELETED
+            rows = np.flatnonzero(np.isin(self._chunk_ids[:size], targets) & live)
+            if rows.shape[0] == 0:
+                return 0
+            self._list_ids[rows] = DELETED
+            removed = set(rows.tolist())
+            for doc_ref in {self._doc_refs[row] for row in removed}:
+                remaining = [row for row in self._rows_by_ref[doc_ref] if row not in removed]
+                if remaining:
+                    self._rows_by_ref[doc_ref] = remaining
+                else:
+                    del self._rows_by_ref[doc_ref]
+            self._deleted += len(removed)
+            self._rebuild_lists()
+        return len(removed)
+
+    # ---- 検索 ----
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5,
+               n_probe: Optional[int] = None,
+               where: Optional[Sequence[str]] = None) -> List[SearchHit]:
+        """
+        クエリに近い n_probe 個のクラスタ内だけを走査し、上位 top_k 件を返す。
+        未学習の間は全件を走査する。
+
+        where を指定した場合は、そのキーをすべて持つ行だけを対象にする。
+        条件に合う行がクラスタ走査で見る行数より少なければ、その行だけを総当たりで
+        正確に計算する(絞り込みが厳しいとクラスタ内に候補が残らず再現率が落ちるため)。
+        """
+        query = normalize_rows(query_vector)[0]
+        if query.shape[0] != self.dim:
+            raise ValueError(f"クエリの次元数が一致しません: expected={self.dim}, actual={query.shape[0]}")
+        n_probe = n_probe or self.n_probe
+        # 配列は追加・学習・compact で差し替わるため、同じ時点の組とクラスタの行番号をロック内で取り出す
+        with self._lock:
+            size, deleted, centroids = self._size, self._deleted, self.centroids
+            vectors, list_ids, filters = self._vectors, self._list_ids, self.filters
+            row_data = (self._chunk_ids, self._spans, self._doc_refs, self._texts)
+            parts = []
+            if size and centroids is not None:
+                probes = top_k_indices(centroids @ query, n_probe)
+                parts = [np.array(self._lists[p], dtype=np.int64) for p in probes.tolist() if len(self._lists[p])]
+        if size == 0:
+            return []
+        mask = None
+        if where:
+            mask = filters.mask(size, where) & (np.asarray(list_ids[:size]) != DELETED)
+            selected = np.flatnonzero(mask)
+            if centroids is None or selected.shape[0] <= size * n_probe / self.n_lists:
+                rows = selected
+                scores = vectors[rows] @ query
+                return self._to_hits(rows, scores, top_k, row_data)
+        if centroids is None:
+            rows = np.arange(size)
+            scores = vectors[:size] @ query
+            if deleted:
+                scores[np.asarray(list_ids[:size]) == DELETED] = -np.inf
+        else:
+            if not parts:
+                return []
+            rows = np.concatenate(parts)
+            rows = rows[rows < size]
+            if mask is not None:
+                rows = rows[mask[rows]]
+            scores = vectors[rows] @ query
+        return self._to_hits(rows, scores, top_k, row_data)
+
+    @staticmethod
+    def _to_hits(rows: np.ndarray, scores: np.ndarray, top_k: int, row_data: tuple) -> List[SearchHit]:
+        """候補行とそのスコアから、検索開始時点の行データ row_data で上位 top_k 件の検索結果を作る。"""
+        chunk_ids, spans, doc_refs, texts = row_data
+        best = top_k_indices(scores, top_k)
+        hits = []
+        for i in best[np.isfinite(scores[best])]:
+            row = int(rows[i])
+            start, end = spans[row]
+            hits.append(SearchHit(
+                chunk_id=int(chunk_ids[row]),
+                doc_ref=doc_refs[row],
+                score=float(scores[i]),
+                text=texts[row],
+                start=start if start >= 0 else None,
+                end=end if end >= 0 else None,
+            ))
+        return hits
+
+    def max_chunk_id(self) -> int:
+        """登録済みの最大チャンクID(DBとの差分取り込みに使用)。"""
+        if self._size == 0:
+            return 0
+        return int(np.max(self._chunk_ids[:self._size]))
+
+    # ---- 永続化 ----
+
+    def flush(self) -> None:
+        """メモリマップの内容をディスクへ書き出す。"""
+        with self._lock:
+            for data in (self._vectors, self._chunk_ids, self._list_ids):
+                if isinstance(data, np.memmap):
+                    data.flush()
+            self._write_meta()
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    @staticmethod
+    def load(path: str, n_probe: Optional[int] = None) -> "IVFIndex":
+        """
+        永続化済みの索引をメモリマップで開く。ベクトル本体は必要になるまで読み込まない。
+        """
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        index = IVFIndex(
+            meta["dim"],
+            n_lists=meta["n_lists"],
+            n_probe=n_probe or meta["n_probe"],
+            path=path,
+            train_size=meta["train_size"],
+            initial_capacity=meta["capacity"],
+            generation=meta.get("generation", 0),
+        )
+        index._size = meta["size"]
+        with open(index._data_file(REFS_FILE), encoding="utf-8") as f:
+            lines = f.readlines()
+        for line in lines[:index._size]:
+            doc_ref, chunk_text, span_start, span_end = json.loads(line)
+            index._doc_refs.append(doc_ref)
+            index._texts.append(chunk_text)
+            index._spans.append((span_start, span_end))
+        if len(lines) != index._size:
+            # 書き込み途中で停止した場合は、メタ情報と参照情報の件数を揃える
+            index._size = len(index._doc_refs)
+            with open(index._data_file(REFS_FILE), "w", encoding="utf-8") as f:
+                f.writelines(lines[:index._size])
+            index._write_meta()
+        list_ids = np.asarray(index._list_ids[:index._size])
+        for row, doc_ref in enumerate(index._doc_refs):
+            if list_ids[row] != DELETED:
+                index._rows_by_ref.setdefault(doc_ref, []).append(row)
+        index._deleted = int(np.count_nonzero(list_ids == DELETED))
+        if meta["trained"]:
+            index.centroids = np.load(index._file(CENTROIDS_FILE))
+            index._rebuild_lists()
+        logger.info(f"IVF索引を読み込みました: path={path}, rows={index._size}")
+        return index
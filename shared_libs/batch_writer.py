@@ -0,0 +1,203 @@
+# .\shared-libs\batch_writer.py
+"""
+batch_writer.py
+ログなどの行をメモリ上のリングバッファにため、バックグラウンドのスレッドでまとめて書き込む処理
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    submit された行を容量 capacity のバッファにため、batch_size 件たまるか、最初の行から
+    flush_interval 秒たつと、writer(行の一覧を受け取り一括で書き込む関数)をワーカースレッドで呼ぶ。
+
+    - バッファが満杯の場合、submit は最大 block_timeout 秒だけ空きを待ち(背圧)、
+      それでも空かなければ行を破棄して件数(dropped)を数える。呼び出し元の処理は止めない。
+    - writer が例外を送出した場合、そのバッチは破棄して件数(failed)を数える
+      (書き込み先の障害でバッファがあふれ続けないようにするため、再試行はしない)。
+    - stop() はバッファに残った行を書き込んでから停止する。stop() 後の submit は破棄する。
+    """
+
+    def __init__(self, writer: Callable[[List[dict]], None], batch_size: int = 500,
+                 flush_interval: float = 1.0, capacity: int = 10000, block_timeout: float = 0.0,
+                 name: str = "batch-writer"):
+        if batch_size <= 0 or capacity < batch_size:
+            raise ValueError("1 <= batch_size <= capacity を満たすよう指定してください。")
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.block_timeout = block_timeout
+        self.name = name
+        self._buffer: Deque[dict] = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # バッファの最も古い行を受け付けた時刻(空の場合は None)
+        self._oldest: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._writing = 0
+        self._stats = {"submitted": 0, "written": 0, "batches": 0, "dropped": 0, "blocked": 0,
+                       "failed": 0}
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        """ワーカースレッドを起動する。起動済みの場合は何もしない。"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+            self._thread.start()
+        logger.info(f"{self.name}: 書き込みスレッドを起動しました。")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """バッファに残った行を書き込んでから、ワーカースレッドを停止する。"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stopping = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        else:
+            # 起動していない場合は呼び出し元のスレッドで書き込む
+            self._drain()
+        logger.info(f"{self.name}: 書き込みスレッドを停止しました。")
+
+    def submit(self, row: dict, timeout: Optional[float] = None) -> bool:
+        """
+        行をバッファに追加する。満杯の場合は timeout(省略時は block_timeout)秒まで空きを待ち、
+        空かなければ破棄して False を返す。
+        """
+        timeout = self.block_timeout if timeout is None else timeout
+        with self._lock:
+            if self._stopping:
+                self._stats["dropped"] += 1
+                return False
+            if len(self._buffer) >= self.capacity:
+                self._stats["blocked"] += 1
+                deadline = time.monotonic() + timeout
+                while len(self._buffer) >= self.capacity and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._not_full.wait(remaining)
+                if len(self._buffer) >= self.capacity or self._stopping:
+                    self._stats["dropped"] += 1
+                    if self._stats["dropped"] % 1000 == 1:
+                        logger.warning(f"{self.name}: バッファが満杯のため行を破棄しました"
+                                       f"(累計 {self._stats['dropped']} 件)。")
+                    return False
+            self._append(row)
+            return True
+
+    def _append(self, row: dict) -> None:
+        """行をバッファに追加する(ロックを持った状態で呼ぶ)。"""
+        if not self._buffer:
+            self._oldest = time.monotonic()
+        self._buffer.append(row)
+        self._stats["submitted"] += 1
+        if len(self._buffer) >= self.batch_size:
+            self._not_empty.notify()
+
+    async def asubmit(self, row: dict) -> bool:
+        """
+        submit の非同期版。空きがあればその場で追加し、満杯の場合だけ空きの待機を
+        スレッドプールで行ってイベントループを塞がない。
+        """
+        with self._lock:
+            if not self._stopping and len(self._buffer) < self.capacity:
+                self._append(row)
+                return True
+        if self.block_timeout <= 0:
+            return self.submit(row, timeout=0.0)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.submit, row)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        その時点でバッファにある行の書き込みを促し、書き込み終わるまで待つ。
+        タイムアウトした場合は False を返す。
+        """
+        with self._lock:
+            running = self._thread is not None
+            self._oldest = 0.0 if self._buffer else None
+            self._not_empty.notify()
+        if not running:
+            self._drain()
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._buffer and not self._writing:
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "buffered": len(self._buffer), "capacity": self.capacity,
+                    "running": self._thread is not None, "last_error": self.last_error}
+
+    def _take_batch(self) -> List[dict]:
+        """バッファの先頭から最大 batch_size 件を取り出す(ロックを持った状態で呼ぶ)。"""
+        count = min(self.batch_size, len(self._buffer))
+        batch = [self._buffer.popleft() for _ in range(count)]
+        self._oldest = time.monotonic() if self._buffer else None
+        self._writing += 1
+        self._not_full.notify_all()
+        return batch
+
+    def _write(self, batch: List[dict]) -> None:
+        try:
+            self.writer(batch)
+        except Exception as e:
+            with self._lock:
+                self._stats["failed"] += len(batch)
+                self.last_error = str(e)
+            logger.error(f"{self.name}: {len(batch)} 件の書き込みに失敗しました: {e}")
+        else:
+            with self._lock:
+                self._stats["written"] += len(batch)
+                self._stats["batches"] += 1
+        finally:
+            with self._lock:
+                self._writing -= 1
+
+    def _drain(self) -> None:
+        while True:
+            with self._lock:
+                if not self._buffer:
+                    return
+                batch = self._take_batch()
+            self._write(batch)
+
+    def _worker(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    if len(self._buffer) >= self.batch_size:
+                        break
+                    if self._oldest is not None:
+                        wait = self._oldest + self.flush_interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._not_empty.wait(wait)
+                if self._stopping and not self._buffer:
+                    return
+                batch = self._take_batch()
+            self._write(batch)
@@ -0,0 +1,350 @@
+# .\shared-libs\bm25_index.py
+"""
+bm25_index.py
+文字bigram/trigramの転置索引によるBM25検索(日本語向け、ポスティングは配列で保持)
+"""
+
+import math
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_libs.row_bitsets import RowBitsets
+from shared_libs.vector_index import COMPACT_RATIO, SearchHit, group_rows, to_span_array, top_k_indices
+
+# 1つのチャンク内での出現回数の上限(ポスティングを uint16 で保持するため)
+MAX_TF = 65535
+# 同程度の大きさのセグメントがこの個数たまったら1つに併合する
+MERGE_FANIN = 4
+# n-gramを区切る空白文字(NFKC正規化後なので全角空白は半角になっている)
+WHITESPACE = np.array([ord(c) for c in " \t\n\r\x0b\x0c\x85\u2028\u2029"], dtype=np.uint64)
+# 語ID: コードポイント(21bit)を詰めた整数。trigramは最上位ビットで bigram / 1文字と区別する
+CODE_BITS = np.uint64(21)
+TRIGRAM_FLAG = np.uint64(1 << 63)
+
+
+def normalize_text(value: str) -> str:
+    """全角・半角や大文字・小文字の揺れを吸収する(NFKC正規化 + 小文字化)。"""
+    return unicodedata.normalize("NFKC", value).lower()
+
+
+def to_codepoints(value: str) -> np.ndarray:
+    """正規化した文字列をコードポイントの配列にする。"""
+    return np.frombuffer(normalize_text(value).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+
+def ngram_terms(codes: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    連結したコードポイント列 codes と各文字の行番号 rows から、文字bigram/trigramの
+    語IDと行番号の組を返す。空白や行の境界をまたぐn-gramは作らず、前後を区切られた
+    1文字だけの断片はそのまま1語とする(型番の1文字クエリなど)。
+    文字列の辞書を持たずに語IDを算術的に作るため、トークン化はすべて NumPy で行える。
+    """
+    space = np.isin(codes, WHITESPACE)
+    same_row = rows[1:] == rows[:-1]
+    terms = []
+    term_rows = []
+    if codes.shape[0] >= 2:
+        valid = ~space[:-1] & ~space[1:] & same_row
+        terms.append(((codes[:-1] << CODE_BITS) | codes[1:])[valid])
+        term_rows.append(rows[:-1][valid])
+    if codes.shape[0] >= 3:
+        valid = ~space[:-2] & ~space[1:-1] & ~space[2:] & same_row[:-1] & same_row[1:]
+        trigram = TRIGRAM_FLAG | (codes[:-2] << (CODE_BITS * np.uint64(2))) | (codes[1:-1] << CODE_BITS) | codes[2:]
+        terms.append(trigram[valid])
+        term_rows.append(rows[:-2][valid])
+    breaks = space[:-1] | space[1:] | ~same_row
+    single = ~space & np.r_[True, breaks] & np.r_[breaks, True]
+    terms.append(codes[single])
+    term_rows.append(rows[single])
+    return np.concatenate(terms), np.concatenate(term_rows)
+
+
+def query_terms(query: str) -> np.ndarray:
+    """クエリの語IDを重複なしで返す。"""
+    codes = to_codepoints(query)
+    terms, _ = ngram_terms(codes, np.zeros(codes.shape[0], dtype=np.int32))
+    return np.unique(terms)
+
+
+class Segment(NamedTuple):
+    """
+    追加1回分のポスティングをCSR形式で保持する不変の配列の組。
+    語IDの昇順に並べた terms と、語ごとの範囲 offsets[i]:offsets[i+1] で rows / tfs を引く。
+    """
+    terms: np.ndarray
+    offsets: np.ndarray
+    rows: np.ndarray
+    tfs: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return int(self.rows.shape[0])
+
+    def lookup(self, term_ids: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """語IDごとのポスティング(行番号, tf)を返す。含まれない語は空の配列。"""
+        positions = np.searchsorted(self.terms, term_ids)
+        postings = []
+        for term_id, i in zip(term_ids, positions):
+            if i == self.terms.shape[0] or self.terms[i] != term_id:
+                postings.append((self.rows[:0], self.tfs[:0]))
+                continue
+            begin, end = self.offsets[i], self.offsets[i + 1]
+            postings.append((self.rows[begin:end], self.tfs[begin:end]))
+        return postings
+
+
+def build_segment(term_ids: np.ndarray, rows: np.ndarray, tfs: np.ndarray) -> Segment:
+    """
+    語IDの昇順(同じ語の中では行番号の昇順)に並んだポスティングをセグメントにする。
+    """
+    if term_ids.shape[0]:
+        starts = np.flatnonzero(np.r_[True, term_ids[1:] != term_ids[:-1]])
+    else:
+        starts = np.empty(0, dtype=np.int64)
+    offsets = np.append(starts, term_ids.shape[0]).astype(np.int64)
+    return Segment(term_ids[starts], offsets, rows, tfs)
+
+
+def merge_segments(segments: Sequence[Segment]) -> Segment:
+    """
+    複数のセグメントを1つにする。セグメントは行番号の順に並んでいるため、
+    安定ソートで語ごとの行の昇順が保たれる(各セグメントは整列済みなのでソートはほぼ併合のみ)。
+    """
+    term_ids = np.concatenate([np.repeat(seg.terms, np.diff(seg.offsets)) for seg in segments])
+    order = np.argsort(term_ids, kind="stable")
+    return build_segment(
+        term_ids[order],
+        np.concatenate([seg.rows for seg in segments])[order],
+        np.concatenate([seg.tfs for seg in segments])[order],
+    )
+
+
+class BM25Index:
+    """
+    チャンク単位のBM25転置索引。ポスティングは追加ごとにCSR形式の配列(セグメント)として作り、
+    同程度の大きさのセグメントを MERGE_FANIN 個ずつ併合して個数を対数オーダーに保つ。
+    検索時は語ごとに各セグメントを二分探索し、NumPy でまとめてスコアを加算する。
+    行番号はチャンクの登録順で、文書単位の削除は VectorIndex と同様に行を無効化するだけで、
+    無効な行が増えたら compact で全セグメントを1つにまとめながら行番号を詰め直す。
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, initial_capacity: int = 1024):
+        self.k1 = k1
+        self.b = b
+        capacity = max(initial_capacity, 1)
+        self._segments: List[Segment] = []
+        self._chunk_ids = np.zeros(capacity, dtype=np.int64)
+        self._lengths = np.zeros(capacity, dtype=np.float32)
+        self._spans = np.full((capacity, 2), -1, dtype=np.int64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._doc_refs: List[str] = []
+        self._texts: List[str] = []
+        self._rows_by_ref: Dict[str, List[int]] = {}
+        self.filters = RowBitsets()
+        self._total_length = 0.0
+        self._deleted = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def doc_refs(self) -> List[str]:
+        """登録されている(削除されていない)文書参照の一覧を返す。"""
+        with self._lock:
+            return list(self._rows_by_ref)
+
+    def set_doc_keys(self, doc_ref: str, keys: Iterable[str]) -> None:
+        """文書 doc_ref の全チャンクの絞り込み用キーを置き換える。"""
+        with self._lock:
+            self.filters.set_doc_keys(doc_ref, self._rows_by_ref.get(doc_ref, []), keys)
+
+    @property
+    def posting_count(self) -> int:
+        return sum(segment.size for segment in self._segments)
+
+    @property
+    def segment_count(self) -> int:
+        return len(self._segments)
+
+    def _reserve(self, required: int) -> None:
+        capacity = self._chunk_ids.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        size = self._size
+        chunk_ids = np.zeros(capacity, dtype=np.int64)
+        chunk_ids[:size] = self._chunk_ids[:size]
+        lengths = np.zeros(capacity, dtype=np.float32)
+        lengths[:size] = self._lengths[:size]
+        spans = np.full((capacity, 2), -1, dtype=np.int64)
+        spans[:size] = self._spans[:size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:size] = self._alive[:size]
+        self._chunk_ids = chunk_ids
+        self._lengths = lengths
+        self._spans = spans
+        self._alive = alive
+
+    def add(self, chunk_ids: Sequence[int], texts: Sequence[str],
+            doc_refs: Sequence[str], hit_texts: Optional[Sequence[str]] = None,
+            spans: Optional[Sequence[Tuple[int, int]]] = None,
+            row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """
+        チャンク本文をトークン化し、1つのセグメントとして索引に追加する。
+        hit_texts は検索結果に返す本文(省略時は texts。範囲が不明な旧形式の行では文書の先頭部分を渡す)、
+        row_keys は各チャンクの絞り込み用キー(省略時は文書に設定済みのキー)。
+        """
+        count = len(texts)
+        hit_texts = texts if hit_texts is None else hit_texts
+        if not (len(chunk_ids) == len(doc_refs) == len(hit_texts) == count):
+            raise ValueError("chunk_ids / texts / doc_refs / hit_texts の件数が一致しません。")
+        if count == 0:
+            return
+        # トークン化とポスティングの作成はロックの外で行う(行番号はバッチ内の相対値)
+        codes = [to_codepoints(value) for value in texts]
+        char_rows = np.repeat(np.arange(count, dtype=np.int32), [c.shape[0] for c in codes])
+        terms, term_rows = ngram_terms(np.concatenate(codes), char_rows)
+        order = np.lexsort((term_rows, terms))
+        terms, term_rows = terms[order], term_rows[order]
+        # 同じ (語, 行) の連続をまとめて tf にする
+        if terms.shape[0]:
+            firsts = np.flatnonzero(np.r_[True, (terms[1:] != terms[:-1]) | (term_rows[1:] != term_rows[:-1])])
+        else:
+            firsts = np.empty(0, dtype=np.int64)
+        tfs = np.minimum(np.diff(np.append(firsts, terms.shape[0])), MAX_TF).astype(np.uint16)
+        terms, term_rows = terms[firsts], term_rows[firsts]
+        lengths = np.bincount(term_rows, weights=tfs, minlength=count).astype(np.float32)
+        span_array = to_span_array(spans, count)
+        with self._lock:
+            start = self._size
+            self._reserve(start + count)
+            segments = self._segments + [build_segment(terms, term_rows + np.int32(start), tfs)]
+            while len(segments) >= MERGE_FANIN and segments[-MERGE_FANIN].size <= segments[-1].size * MERGE_FANIN:
+                segments[-MERGE_FANIN:] = [merge_segments(segments[-MERGE_FANIN:])]
+            self._lengths[start:start + count] = lengths
+            self._total_length += float(lengths.sum())
+            self._chunk_ids[start:start + count] = np.asarray(chunk_ids, dtype=np.int64)
+            self._spans[start:start + count] = span_array
+            self._alive[start:start + count] = True
+            self._doc_refs.extend(doc_refs)
+            self._texts.extend(hit_texts)
+            for offset, doc_ref in enumerate(doc_refs):
+                self._rows_by_ref.setdefault(doc_ref, []).append(start + offset)
+            self.filters.add_rows(start, doc_refs, row_keys)
+            # セグメントは不変なので、一覧を差し替えるだけで検索側と競合しない
+            self._segments = segments
+            self._size = start + count
+
+    def remove_doc(self, doc_ref: str) -> int:
+        """doc_ref に属するチャンクを検索対象から外し、外した件数を返す。"""
+        with self._lock:
+            rows = self._rows_by_ref.pop(doc_ref, [])
+            if rows:
+                self._alive[rows] = False
+                self._total_length -= float(self._lengths[rows].sum())
+                self._deleted += len(rows)
+        return len(rows)
+
+    def compact(self, min_ratio: float = COMPACT_RATIO) -> int:
+        """
+        無効な行が全行の min_ratio 以上あれば、全セグメントを1つに併合しながら無効な行のポスティングを除き、
+        行番号を詰め直して差し替える。取り除いた行数を返す。差し替え前に始まった検索は古い配列のまま実行できる。
+        """
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            if deleted == 0 or deleted < size * min_ratio:
+                return 0
+            alive = self._alive[:size]
+            keep = np.flatnonzero(alive)
+            count = keep.shape[0]
+            # 旧行番号 → 新行番号(生きている行だけが参照される)
+            new_rows = (np.cumsum(alive) - 1).astype(np.int32)
+            segments = []
+            if self._segments:
+                merged = merge_segments(self._segments)
+                term_ids = np.repeat(merged.terms, np.diff(merged.offsets))
+                live = alive[merged.rows]
+                segments = [build_segment(term_ids[live], new_rows[merged.rows[live]], merged.tfs[live])]
+            capacity = max(count, 1)
+            chunk_ids = np.zeros(capacity, dtype=np.int64)
+            chunk_ids[:count] = self._chunk_ids[keep]
+            lengths = np.zeros(capacity, dtype=np.float32)
+            lengths[:count] = self._lengths[keep]
+            spans = np.full((capacity, 2), -1, dtype=np.int64)
+            spans[:count] = self._spans[keep]
+            alive_rows = np.zeros(capacity, dtype=bool)
+            alive_rows[:count] = True
+            self._doc_refs = [self._doc_refs[row] for row in keep.tolist()]
+            self._texts = [self._texts[row] for row in keep.tolist()]
+            self._rows_by_ref = group_rows(self._doc_refs)
+            self.filters = self.filters.compact(keep, size)
+            self._segments = segments
+            self._chunk_ids = chunk_ids
+            self._lengths = lengths
+            self._spans = spans
+            self._alive = alive_rows
+            self._deleted = 0
+            self._size = count
+        return deleted
+
+    def score(self, query: str, where: Optional[Sequence[str]] = None) -> np.ndarray:
+        """
+        全行のBM25スコアを返す(削除済みの行と一致しない行は0)。
+        where を指定した場合は、そのキーをすべて持たない行も0にする(idfは全行で計算する)。
+        """
+        return self._score(query, where)[0]
+
+    def _score(self, query: str, where: Optional[Sequence[str]]) -> Tuple[np.ndarray, tuple]:
+        """score の本体。スコアと、同じ時点の行データ(検索結果の作成用)を返す。"""
+        term_ids = query_terms(query)
+        # 配列は追加時の拡張と compact で差し替わるため、同じ時点の組を取り出して使う
+        with self._lock:
+            size = self._size
+            segments = self._segments
+            alive = self._alive[:size].copy()
+            allowed = self.filters.mask(size, where) & alive if where else alive
+            lengths = self._lengths[:size]
+            n_docs = size - self._deleted
+            avg_length = self._total_length / n_docs if n_docs else 0.0
+            row_data = (self._chunk_ids, self._spans, self._doc_refs, self._texts)
+        scores = np.zeros(size, dtype=np.float32)
+        if term_ids.shape[0] == 0 or n_docs == 0:
+            return scores, row_data
+        norm = self.k1 * (1.0 - self.b + self.b * lengths / max(avg_length, 1e-9))
+        by_segment = [segment.lookup(term_ids) for segment in segments]
+        for i in range(term_ids.shape[0]):
+            rows = np.concatenate([postings[i][0] for postings in by_segment])
+            tfs = np.concatenate([postings[i][1] for postings in by_segment]).astype(np.float32)
+            df = int(np.count_nonzero(alive[rows]))
+            if df == 0:
+                continue
+            idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            keep = allowed[rows]
+            rows, tfs = rows[keep], tfs[keep]
+            # 1つの語のポスティング内で行番号は重複しないため、添字代入で加算できる
+            scores[rows] += idf * tfs * (self.k1 + 1.0) / (tfs + norm[rows])
+        return scores, row_data
+
+    def search(self, query: str, top_k: int = 5,
+               where: Optional[Sequence[str]] = None) -> List[SearchHit]:
+        """BM25スコアの高い順に、クエリの語を含むチャンクを最大 top_k 件返す。"""
+        scores, (chunk_ids, spans, doc_refs, texts) = self._score(query, where)
+        rows = top_k_indices(scores, top_k)
+        rows = rows[scores[rows] > 0]
+        hits = []
+        for row in rows:
+            start, end = spans[row]
+            hits.append(SearchHit(
+                chunk_id=int(chunk_ids[row]),
+                doc_ref=doc_refs[row],
+                score=float(scores[row]),
+                text=texts[row],
+                start=int(start) if start >= 0 else None,
+                end=int(end) if end >= 0 else None,
+            ))
+        return hits
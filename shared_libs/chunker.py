@@ -0,0 +1,96 @@
+# .\shared-libs\chunker.py
+"""
+chunker.py
+文書を重なりのあるチャンクに分割するジェネレータ(日本語の文末を考慮)
+"""
+
+from typing import Iterable, Iterator, NamedTuple, Union
+
+# 文の区切りとみなす文字(この文字の直後で区切る)
+SENTENCE_ENDINGS = "。！？!?\n"
+# 文字列を入力とした場合に一度にバッファへ取り込む文字数
+READ_SIZE = 4096
+
+
+class Chunk(NamedTuple):
+    """チャンク本文と、元文書内での文字オフセット [start, end)"""
+    start: int
+    end: int
+    text: str
+
+
+def _find_break(buf: str, start: int, limit: int, min_length: int) -> int:
+    """
+    buf[start:limit] の範囲で最も後ろにある文末の直後の位置を返す。
+    min_length 未満で区切ることになる場合や文末がない場合は limit を返す。
+    """
+    best = -1
+    for ch in SENTENCE_ENDINGS:
+        pos = buf.rfind(ch, start + min_length, limit)
+        if pos > best:
+            best = pos
+    return best + 1 if best >= 0 else limit
+
+
+def _find_overlap_start(buf: str, start: int, end: int, overlap: int) -> int:
+    """
+    次のチャンクの開始位置を返す。end から overlap 文字戻った位置以降で
+    最初の文頭に揃え、文頭が見つからない場合はそのままの位置を使う。
+    """
+    if overlap <= 0:
+        return end
+    target = max(end - overlap, start + 1)
+    best = end
+    for ch in SENTENCE_ENDINGS:
+        pos = buf.find(ch, target, end)
+        if 0 <= pos < best:
+            best = pos
+    if best + 1 < end:
+        return best + 1
+    return target
+
+
+def iter_chunks(source: Union[str, Iterable[str]], chunk_size: int = 500,
+                overlap: int = 100) -> Iterator[Chunk]:
+    """
+    文書を最大 chunk_size 文字のチャンクに分割して順に返す。
+    隣り合うチャンクは約 overlap 文字重なり、区切りは可能な限り文末(。！？ など)に揃える。
+
+    source には文字列のほか、ファイルオブジェクトなど文字列の断片を返すイテラブルも渡せる。
+    保持するのは現在のチャンク付近のバッファのみで、チャンクの一覧は作らない。
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size は 1 以上を指定してください。")
+    if not 0 <= overlap < chunk_size:
+        raise ValueError("overlap は 0 以上 chunk_size 未満を指定してください。")
+    if isinstance(source, str):
+        text = source
+        pieces: Iterator[str] = (text[i:i + READ_SIZE] for i in range(0, len(text), READ_SIZE))
+    else:
+        pieces = iter(source)
+
+    min_length = chunk_size // 2
+    buf = ""
+    base = 0  # buf[0] の元文書内でのオフセット
+    pos = 0   # 次のチャンクの buf 内での開始位置
+    exhausted = False
+    while True:
+        while not exhausted and len(buf) - pos < chunk_size:
+            piece = next(pieces, None)
+            if piece is None:
+                exhausted = True
+                break
+            # 取り込み済みの部分を捨ててからバッファを伸ばす
+            buf = buf[pos:] + piece
+            base += pos
+            pos = 0
+        if pos >= len(buf):
+            return
+        if exhausted and len(buf) - pos <= chunk_size:
+            end = len(buf)
+        else:
+            end = _find_break(buf, pos, pos + chunk_size, min_length)
+        yield Chunk(base + pos, base + end, buf[pos:end])
+        if exhausted and end >= len(buf):
+            return
+        pos = _find_overlap_start(buf, pos, end, overlap)
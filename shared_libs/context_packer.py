@@ -0,0 +1,114 @@
+# .\shared-libs\context_packer.py
+"""
+context_packer.py
+RAGのプロンプトに入れるチャンクを、推定トークン数の予算内に収まるよう選ぶ処理
+"""
+
+import logging
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from shared_libs.vector_index import SearchHit
+
+logger = logging.getLogger(__name__)
+
+# プロンプト内でチャンクごとに加わる "[番号] " と改行の推定トークン数
+CHUNK_OVERHEAD_TOKENS = 4
+
+# 1文字を1トークン前後として数える文字(CJK・かな・全角記号など)
+_WIDE_CHARS = re.compile(r"[⺀-鿿가-힯豈-﫿＀-￯]")
+_SPACES = re.compile(r"\s+")
+
+
+def approximate_tokens(text: str) -> int:
+    """
+    トークナイザーを使わない推定。CJK等の文字は1文字1トークン、それ以外は4文字1トークンとして数える
+    (英文で実際の値の±20%程度、日本語ではやや多めに見積もる)。
+    """
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + -(-(len(text) - wide) // 4)
+
+
+@lru_cache(maxsize=1)
+def _tiktoken_encoder():
+    """tiktoken がインストールされていれば読み込んだエンコーダを返す(読み込みはプロセスで1回だけ)。"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=65536)
+def estimate_tokens(text: str) -> int:
+    """text のトークン数。tiktoken があればそれで数え、なければ approximate_tokens で推定する(結果はキャッシュする)。"""
+    encoder = _tiktoken_encoder()
+    if encoder is None:
+        return approximate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def _dedup_key(text: str) -> str:
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class PackedContext(NamedTuple):
+    """選ばれたチャンク(プロンプトに入れる順)と、その推定トークン数・削減できたトークン数"""
+    hits: List[SearchHit]
+    tokens: int
+    saved_tokens: int
+    dropped: int
+
+
+class ContextPacker:
+    """
+    検索結果をスコアの高い順に見て、重複(同じチャンク・同じ本文)を除き、
+    チャンク本文全体(プロンプトに入れる text)のトークン数で budget_tokens に収まるものから貪欲に選ぶ。
+    収まらないチャンクは飛ばして、より短いものを試す。
+    全候補をそのまま入れた場合との差を削減トークン数として数える。
+    """
+
+    def __init__(self, budget_tokens: int = 1500,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        self.budget_tokens = budget_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "tokens": 0, "saved_tokens": 0, "dropped_chunks": 0, "duplicates": 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def pack(self, hits: Sequence[SearchHit]) -> PackedContext:
+        seen_chunks = set()
+        seen_texts = set()
+        selected: List[SearchHit] = []
+        used = 0
+        total = 0
+        duplicates = 0
+        over_budget = 0
+        for hit in sorted(hits, key=lambda hit: hit.score, reverse=True):
+            cost = self.count_tokens(hit.text) + CHUNK_OVERHEAD_TOKENS
+            total += cost
+            text_key = _dedup_key(hit.text)
+            if (hit.doc_ref, hit.chunk_id) in seen_chunks or text_key in seen_texts:
+                duplicates += 1
+                continue
+            if used + cost > self.budget_tokens:
+                over_budget += 1
+                continue
+            seen_chunks.add((hit.doc_ref, hit.chunk_id))
+            seen_texts.add(text_key)
+            selected.append(hit)
+            used += cost
+        packed = PackedContext(selected, used, total - used, duplicates + over_budget)
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["tokens"] += used
+            self._stats["saved_tokens"] += packed.saved_tokens
+            self._stats["dropped_chunks"] += over_budget
+            self._stats["duplicates"] += duplicates
+        return packed
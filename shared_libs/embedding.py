@@ -0,0 +1,136 @@
+# .\shared-libs\embedding.py
+"""
+embedding.py
+テキストのEmbedding化(共通インターフェースと、ネットワーク不要のローカル実装・OpenAI実装)
+"""
+
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from shared_libs.bm25_index import ngram_terms, to_codepoints
+from shared_libs.vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# ハッシュの攪拌に使う定数(splitmix64)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+class Embedder(ABC):
+    """
+    テキストを固定次元のベクトルに変換するインターフェース。
+    embed_batch は (件数, dim) のL2正規化済みfloat32行列を返す。
+    model_name は doc_embeddings.embedding_model に記録され、異なるモデルのベクトルの混在を防ぐ。
+    semantic は言い換えた文どうしのベクトルが近くなる(意味の近さを表す)実装かどうか。
+    """
+    dim: int
+    model_name: str
+    semantic: bool = True
+
+    @abstractmethod
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed(self, text: str) -> np.ndarray:
+        """1件のテキストをベクトル化する。"""
+        return self.embed_batch([text])[0]
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """uint64 の語IDを攪拌し、下位ビットに偏りのないハッシュ値にする。"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * _MIX_1
+    values = values ^ (values >> np.uint64(27))
+    values = values * _MIX_2
+    return values ^ (values >> np.uint64(31))
+
+
+class HashingEmbedder(Embedder):
+    """
+    文字bigram/trigram(BM25索引と同じ語ID)を feature hashing で dim 次元に射影するローカル実装。
+    学習済みモデルやネットワークを使わず、同じ入力には常に同じベクトルを返す。
+    語はハッシュ値の最上位ビットで符号を決めて衝突の偏りを打ち消し、
+    出現回数は log(1 + tf) で抑えてから正規化する。処理はバッチ全体をまとめて NumPy で行う。
+    文字の重なりしか見ないため、言い換えた文の類似度は低い(semantic=False)。
+    """
+    semantic = False
+
+    def __init__(self, dim: int = 256):
+        if dim <= 0:
+            raise ValueError("dim は 1 以上を指定してください。")
+        self.dim = dim
+        self.model_name = f"local-hashing-ngram23-{dim}"
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        count = len(texts)
+        if count == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        codes = [to_codepoints(value) for value in texts]
+        char_rows = np.repeat(np.arange(count, dtype=np.int64), [c.shape[0] for c in codes])
+        terms, rows = ngram_terms(np.concatenate(codes), char_rows)
+        hashed = _mix(terms)
+        buckets = (hashed % np.uint64(self.dim)).astype(np.int64)
+        signs = np.where(hashed >> np.uint64(63), -1.0, 1.0)
+        sums = np.bincount(rows * self.dim + buckets, weights=signs, minlength=count * self.dim)
+        vectors = (np.sign(sums) * np.log1p(np.abs(sums))).reshape(count, self.dim)
+        return normalize_rows(vectors)
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    OpenAI の Embeddings API を使う実装。max_batch 件ずつまとめて1回のリクエストで送る。
+    requests はこの実装を使う場合にのみ必要なため、ローカル実装だけの環境でも読み込めるよう遅延importする。
+    """
+
+    def __init__(self, model: str = "text-embedding-3-small", dim: int = 1536,
+                 api_key: Optional[str] = None, max_batch: int = 256, timeout: float = 30.0):
+        self.model = model
+        self.dim = dim
+        self.model_name = model
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY", "")
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        import requests
+
+        if not self.api_key:
+            raise RuntimeError("OpenAI APIキーが設定されていません。")
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        rows: List[List[float]] = []
+        for start in range(0, len(texts), self.max_batch):
+            payload = {"model": self.model, "input": list(texts[start:start + self.max_batch])}
+            try:
+                resp = requests.post("https://api.openai.com/v1/embeddings",
+                                     headers=headers, json=payload, timeout=self.timeout)
+                resp.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Embedding API呼び出しエラー: {e}")
+                raise e
+            data = sorted(resp.json()["data"], key=lambda item: item["index"])
+            rows.extend(item["embedding"] for item in data)
+        if not rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return normalize_rows(np.asarray(rows, dtype=np.float32))
+
+
+def get_embedder(backend: Optional[str] = None, dim: Optional[int] = None) -> Embedder:
+    """
+    環境変数 EMBEDDING_BACKEND(local / openai、既定は local)と EMBEDDING_DIM から Embedder を作る。
+    """
+    backend = (backend or os.getenv("EMBEDDING_BACKEND", "local")).lower()
+    env_dim = os.getenv("EMBEDDING_DIM")
+    dim = dim or (int(env_dim) if env_dim else None)
+    if backend == "local":
+        return HashingEmbedder(dim or 256)
+    if backend == "openai":
+        return OpenAIEmbedder(dim=dim or 1536)
+    raise ValueError(f"未対応のEmbeddingバックエンドです: {backend}")
@@ -0,0 +1,248 @@
+# .\shared-libs\flow_control.py
+"""
+flow_control.py
+外部サービス呼び出しの流量制御(トークンバケット・適応的な同時実行数の制限・サーキットブレーカー・ヘッジ要求の判定)
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class TokenBucket:
+    """
+    毎秒 rate 個補充され、最大 burst 個までためられるトークンバケット。
+    reserve() は1個を予約し、使えるようになるまでの待ち時間(秒)を返す(残数は負になりうる)。
+    待ち方(asyncio.sleep / time.sleep)は呼び出し元が選ぶため、同期・非同期の呼び出しで1つを共有できる。
+    rate が0以下の場合は制限しない。
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "delayed": 0, "wait_seconds": 0.0}
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            self._stats["acquired"] += 1
+            if wait:
+                self._stats["delayed"] += 1
+                self._stats["wait_seconds"] += wait
+        return wait
+
+    async def acquire(self) -> None:
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {**self._stats, "rate": self.rate, "burst": self.burst,
+                    "tokens": round(max(self._tokens, 0.0), 2)}
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    同時実行数の上限を AIMD(加算的に増やし、乗算的に減らす)で調整する。
+
+    - 応答時間が target_latency 以下で成功した場合、上限を 1/上限 ずつ増やす(上限分の成功でおよそ+1)。
+    - 過負荷(429・タイムアウト)か target_latency を超えた場合、上限を backoff 倍にする。
+    上限は min_limit〜max_limit の範囲に収める。イベントループ1つの中で使う。
+    """
+
+    def __init__(self, initial: int = 10, min_limit: int = 1, max_limit: int = 100,
+                 target_latency: float = 10.0, backoff: float = 0.7):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("1 <= min_limit <= max_limit を満たすよう指定してください。")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._stats = {"increases": 0, "decreases": 0, "waits": 0}
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> None:
+        condition = self._get_condition()
+        async with condition:
+            if self.in_flight >= int(self.limit):
+                self._stats["waits"] += 1
+            while self.in_flight >= int(self.limit):
+                await condition.wait()
+            self.in_flight += 1
+
+    async def release(self, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """latency が None の場合(キャンセル・応答と無関係な失敗)は上限を変えない。"""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if overloaded or (latency is not None and latency > self.target_latency):
+                limit = max(float(self.min_limit), self.limit * self.backoff)
+                if limit < self.limit:
+                    self._stats["decreases"] += 1
+                self.limit = limit
+            elif latency is not None and self.limit < self.max_limit:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                self._stats["increases"] += 1
+            condition.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        return {**self._stats, "limit": int(self.limit), "in_flight": self.in_flight,
+                "min_limit": self.min_limit, "max_limit": self.max_limit}
+
+
+class CircuitBreaker:
+    """
+    連続 failure_threshold 回の失敗で開き(open)、reset_seconds の間は呼び出しを即座に拒否する。
+    その後は試行を1件だけ通し(half_open)、成功すれば閉じ(closed)、失敗すれば再び開く。
+    試行が結果を報告しないまま reset_seconds が過ぎた場合は、次の試行を通す。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0, "failures": 0, "successes": 0}
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                self._probe_started = None
+            if self.state == HALF_OPEN and (
+                self._probe_started is None or now - self._probe_started >= self.reset_seconds
+            ):
+                self._probe_started = now
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._stats["successes"] += 1
+            self._failures = 0
+            if self.state != CLOSED:
+                logger.info("サーキットブレーカーを閉じました。")
+            self.state = CLOSED
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning(f"{self._failures} 回連続で失敗したため、サーキットブレーカーを開きます。")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+                self._stats["opened"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {**self._stats, "state": self.state, "consecutive_failures": self._failures}
+
+
+class HedgingPolicy:
+    """
+    ヘッジ要求(応答が遅い呼び出しと同じ要求をもう1件送り、先に返った方を使う)の待ち時間と予算を決める。
+
+    - 直近 window 件の応答時間の percentile パーセンタイルを待ち時間(deadline)とし、
+      その時間内に応答がなければヘッジを送る。応答時間が min_samples 件たまるまではヘッジしない。
+      待ち時間は min_delay を下回らない。
+    - 呼び出し1件ごとに budget 件分の予算がたまり(最大 burst 件)、ヘッジ1件で1件分を使う。
+      これにより追加の要求は全体の budget の割合(と burst 件の一時的な超過)に収まる。
+    - ヘッジした呼び出しのうち、ヘッジ側が先に成功した件数(hedge_wins)と元の要求が先に返った件数
+      (primary_wins)を数え、stats() で返す。
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, min_delay: float = 0.05,
+                 window: int = 500, min_samples: int = 20, burst: float = 10.0):
+        if not 0 < percentile < 100:
+            raise ValueError("percentile は0より大きく100未満で指定してください。")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.burst = burst
+        self._latencies: deque = deque(maxlen=window)
+        self._credits = 0.0
+        self._deadline: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0, "budget_exhausted": 0}
+
+    def _compute_deadline(self) -> Optional[float]:
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        rank = max(math.ceil(len(ordered) * self.percentile / 100.0) - 1, 0)
+        return max(ordered[rank], self.min_delay)
+
+    def deadline(self) -> Optional[float]:
+        """ヘッジを送るまでの待ち時間(秒)。応答時間の記録が足りない場合は None(ヘッジしない)。"""
+        with self._lock:
+            self._stats["calls"] += 1
+            self._credits = min(self.burst, self._credits + self.budget)
+            return self._deadline
+
+    def record(self, latency: float) -> None:
+        """成功した呼び出しの応答時間(呼び出し元から見た秒数)を記録する。"""
+        with self._lock:
+            self._latencies.append(latency)
+            self._deadline = self._compute_deadline()
+
+    def try_hedge(self) -> bool:
+        """予算が残っていれば1件分を使って True を返す。"""
+        with self._lock:
+            if self._credits < 1.0:
+                self._stats["budget_exhausted"] += 1
+                return False
+            self._credits -= 1.0
+            self._stats["hedged"] += 1
+            return True
+
+    def record_winner(self, hedge_won: bool) -> None:
+        with self._lock:
+            self._stats["hedge_wins" if hedge_won else "primary_wins"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = {**self._stats, "percentile": self.percentile, "budget": self.budget,
+                     "deadline": round(self._deadline, 4) if self._deadline is not None else None,
+                     "samples": len(self._latencies)}
+        stats["hedge_rate"] = round(stats["hedged"] / stats["calls"], 4) if stats["calls"] else 0.0
+        stats["win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+        return stats
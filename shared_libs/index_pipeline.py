@@ -0,0 +1,220 @@
+# .\shared-libs\index_pipeline.py
+"""
+index_pipeline.py
+文書の索引登録をバックグラウンドで行うパイプライン(上限付きキュー + ワーカースレッド + 再試行)
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class IndexJob(NamedTuple):
+    """キューに積む作業1件分(対象キー・最初に登録要求された時刻・試行回数)"""
+    key: Hashable
+    enqueued_at: float
+    attempt: int = 0
+
+
+class IndexingPipeline:
+    """
+    キー(文書IDなど)単位の索引登録を複数のワーカースレッドで非同期に処理する。
+
+    - キューは上限付きで、満杯のときは登録要求を待たずに破棄して件数を記録する。
+    - 同じキーが未処理のまま複数回登録された場合は1回にまとめる。
+      処理中のキーが再登録された場合は、処理完了後にもう一度処理する。
+    - handler が例外を送出した場合は指数バックオフで max_retries 回まで再試行する。
+
+    handler はキーだけを受け取るので、内容は処理時点の最新状態をDBから読み直すこと。
+    """
+
+    def __init__(self, handler: Callable[[Hashable], object], workers: int = 2,
+                 max_queue_size: int = 1000, max_retries: int = 3,
+                 retry_backoff: float = 1.0, name: str = "index-pipeline"):
+        if workers <= 0:
+            raise ValueError("workers は 1 以上を指定してください。")
+        self.handler = handler
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.name = name
+        self._queue: "queue.Queue[Optional[IndexJob]]" = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        # 未処理のキーと最初に登録要求された時刻
+        self._pending: Dict[Hashable, float] = {}
+        self._running: Set[Hashable] = set()
+        # 処理中に再登録されたキーと、その登録時刻
+        self._rerun: Dict[Hashable, float] = {}
+        self._retry_timers: Set[threading.Timer] = set()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.last_lag: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        """ワーカースレッドを起動する。起動済みの場合は何もしない。"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"{self.name}: ワーカー {self.workers} 件を起動しました。")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        ワーカースレッドを停止する。キューに積まれている作業は処理してから停止し、
+        待機中の再試行は取り消す。
+        """
+        with self._lock:
+            if not self._threads:
+                return
+            self._stopping = True
+            timers = list(self._retry_timers)
+            self._retry_timers.clear()
+            threads = self._threads
+            self._threads = []
+        for timer in timers:
+            timer.cancel()
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+        logger.info(f"{self.name}: ワーカーを停止しました。")
+
+    def submit(self, key: Hashable) -> bool:
+        """
+        key の索引登録を要求する。呼び出し元を待たせないため、キューが満杯の場合は
+        破棄して False を返す。既に未処理の要求がある場合はそれにまとめて True を返す。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._stopping:
+                return False
+            if key in self._pending:
+                return True
+            if key in self._running:
+                self._rerun.setdefault(key, now)
+                return True
+            try:
+                self._queue.put_nowait(IndexJob(key, now))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning(f"{self.name}: キューが満杯のため {key} の索引登録要求を破棄しました。")
+                return False
+            self._pending[key] = now
+            return True
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """未処理・処理中・再試行待ちの作業がなくなるまで待つ。タイムアウトした場合は False を返す。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                idle = not (self._pending or self._running or self._rerun or self._retry_timers)
+            if idle:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def status(self) -> dict:
+        """滞留件数・遅延・処理件数などの状態を返す。"""
+        now = time.monotonic()
+        with self._lock:
+            waiting = list(self._pending.values()) + list(self._rerun.values())
+            return {
+                "running": bool(self._threads),
+                "workers": self.workers,
+                "queue_capacity": self.max_queue_size,
+                "queued": len(self._pending),
+                "in_progress": len(self._running),
+                "retry_waiting": len(self._retry_timers),
+                "backlog": len(self._pending) + len(self._running) + len(self._rerun),
+                # 最も古い未処理要求の経過秒数(索引が文書に追いついていない時間)
+                "oldest_pending_seconds": round(now - min(waiting), 3) if waiting else 0.0,
+                "last_lag_seconds": None if self.last_lag is None else round(self.last_lag, 3),
+                "processed": self.processed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dropped": self.dropped,
+                "last_error": self.last_error,
+            }
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                # 処理開始前に未処理から外し、処理中の再登録を検知できるようにする
+                self._pending.pop(job.key, None)
+                self._running.add(job.key)
+            try:
+                self.handler(job.key)
+            except Exception as e:
+                self._on_failure(job, e)
+            else:
+                with self._lock:
+                    self.processed += 1
+                    self.last_lag = time.monotonic() - job.enqueued_at
+            finally:
+                self._finish(job.key)
+
+    def _finish(self, key: Hashable) -> None:
+        with self._lock:
+            self._running.discard(key)
+            enqueued_at = self._rerun.pop(key, None)
+            if enqueued_at is None or self._stopping or key in self._pending:
+                return
+            try:
+                self._queue.put_nowait(IndexJob(key, enqueued_at))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning(f"{self.name}: キューが満杯のため {key} の再登録要求を破棄しました。")
+                return
+            self._pending[key] = enqueued_at
+
+    def _on_failure(self, job: IndexJob, error: Exception) -> None:
+        with self._lock:
+            self.last_error = f"{job.key}: {error}"
+            if job.attempt >= self.max_retries or self._stopping:
+                self.failed += 1
+                logger.error(f"{self.name}: {job.key} の索引登録に失敗しました: {error}")
+                return
+            self.retried += 1
+            delay = self.retry_backoff * (2 ** job.attempt)
+            retry = IndexJob(job.key, job.enqueued_at, job.attempt + 1)
+            timer = threading.Timer(delay, self._requeue, args=(retry,))
+            timer.daemon = True
+            self._retry_timers.add(timer)
+        logger.warning(f"{self.name}: {job.key} の索引登録を {delay:.1f} 秒後に再試行します: {error}")
+        timer.start()
+
+    def _requeue(self, job: IndexJob) -> None:
+        with self._lock:
+            self._retry_timers.discard(threading.current_thread())
+            if self._stopping:
+                return
+            if job.key in self._pending or job.key in self._running:
+                # 再試行待ちの間に新しい要求が入っていればそちらにまとめる
+                if job.key in self._running:
+                    self._rerun.setdefault(job.key, job.enqueued_at)
+                return
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.failed += 1
+                logger.error(f"{self.name}: キューが満杯のため {job.key} の再試行を破棄しました。")
+                return
+            self._pending[job.key] = job.enqueued_at
@@ -0,0 +1,204 @@
+# .\shared-libs\llm_cache.py
+"""
+llm_cache.py
+LLMの応答キャッシュ(メモリ上のLRUとDB上の ai_schema.llm_response_cache の2段構成)
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import column, table
+
+logger = logging.getLogger(__name__)
+
+LLM_RESPONSE_CACHE = table(
+    "llm_response_cache",
+    column("cache_key"),
+    column("model"),
+    column("response"),
+    column("created_at"),
+    column("expires_at"),
+    schema="ai_schema",
+)
+
+# 期限切れの行を削除する間隔(DBへの保存回数)
+PURGE_INTERVAL = 1000
+# まとめて読み書きする際の1回あたりのキー数
+BULK_SIZE = 1000
+
+
+def cache_key(model: str, prompt: str, params: Optional[dict] = None) -> bytes:
+    """(モデル, プロンプト, 生成パラメータ) のSHA-256。パラメータはキーの順序に依存しない。"""
+    payload = json.dumps([model, prompt, params or {}], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).digest()
+
+
+class LLMResponseCache:
+    """
+    LLMの応答を cache_key ごとに保持するキャッシュ。
+
+    - メモリ: 最大 max_entries 件のLRU。ttl_seconds を過ぎた項目は読み出し時に捨てる。
+    - DB: use_db が True の場合に ai_schema.llm_response_cache へも保存し、メモリにない場合に参照する。
+      DBの有効期限は db_ttl_seconds(未指定時は ttl_seconds)。期限切れの行は PURGE_INTERVAL 回の保存ごとに削除する。
+    - ヒット・ミスなどの件数を stats() で返す。
+    DBの読み書きは同期I/Oのため、非同期処理からはスレッドプールで呼び出す。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600.0,
+                 use_db: bool = True, db_ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.use_db = use_db
+        self.db_ttl_seconds = ttl_seconds if db_ttl_seconds is None else db_ttl_seconds
+        self._entries: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        self._db_stores = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self.use_db
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def clear(self) -> None:
+        """メモリ上の項目を捨てる(DBの行は期限切れまで残る)。"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_memory(self, key: bytes) -> Optional[str]:
+        """メモリ上の項目だけを調べる。見つからない場合はミスとして数えない(続けて get_db を呼ぶ)。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats["expired"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["memory_hits"] += 1
+            return response
+
+    def get_db(self, db: Session, key: bytes) -> Optional[str]:
+        """DB上の有効な行を調べ、見つかればメモリにも載せる。見つからない場合はミスとして数える。"""
+        if not self.use_db:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        row = db.execute(
+            select(LLM_RESPONSE_CACHE.c.response)
+            .where(LLM_RESPONSE_CACHE.c.cache_key == key)
+            .where(LLM_RESPONSE_CACHE.c.expires_at > datetime.utcnow())
+        ).first()
+        with self._lock:
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["db_hits"] += 1
+        self._put_memory(key, row[0])
+        return row[0]
+
+    def get(self, db: Session, key: bytes) -> Optional[str]:
+        response = self.get_memory(key)
+        if response is None:
+            response = self.get_db(db, key)
+        return response
+
+    def get_many(self, db: Session, keys: Iterable[bytes]) -> Dict[bytes, str]:
+        """複数のキーをまとめて調べ、見つかったものを {キー: 応答} で返す。DBは BULK_SIZE 件ずつ1回で調べる。"""
+        found: Dict[bytes, str] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            response = self.get_memory(key)
+            if response is None:
+                missing.append(key)
+            else:
+                found[key] = response
+        if self.use_db:
+            now = datetime.utcnow()
+            for start in range(0, len(missing), BULK_SIZE):
+                rows = db.execute(
+                    select(LLM_RESPONSE_CACHE.c.cache_key, LLM_RESPONSE_CACHE.c.response)
+                    .where(LLM_RESPONSE_CACHE.c.cache_key.in_(missing[start:start + BULK_SIZE]))
+                    .where(LLM_RESPONSE_CACHE.c.expires_at > now)
+                )
+                for key, response in rows:
+                    found[bytes(key)] = response
+                    self._put_memory(bytes(key), response)
+        with self._lock:
+            db_hits = sum(1 for key in missing if key in found)
+            self._stats["db_hits"] += db_hits
+            self._stats["misses"] += len(missing) - db_hits
+        return found
+
+    def _put_memory(self, key: bytes, response: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def put(self, db: Session, key: bytes, model: str, response: str) -> None:
+        """応答を保存する。DBへの保存は呼び出し元のトランザクションで行い、コミットは呼び出し元が行う。"""
+        self.put_many(db, model, [(key, response)])
+
+    def put_many(self, db: Session, model: str, items: Sequence[Tuple[bytes, str]]) -> None:
+        """複数の応答をまとめて保存する。DBへは BULK_SIZE 件ずつ1文で書き込む。"""
+        items = list(dict(items).items())
+        for key, response in items:
+            self._put_memory(key, response)
+        with self._lock:
+            self._stats["stores"] += len(items)
+        if not self.use_db or not items:
+            return
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.db_ttl_seconds)
+        for start in range(0, len(items), BULK_SIZE):
+            rows = [
+                {"cache_key": key, "model": model, "response": response,
+                 "created_at": now, "expires_at": expires_at}
+                for key, response in items[start:start + BULK_SIZE]
+            ]
+            if db.get_bind().dialect.name == "postgresql":
+                stmt = postgresql.insert(LLM_RESPONSE_CACHE).values(rows)
+                db.execute(stmt.on_conflict_do_update(
+                    index_elements=["cache_key"],
+                    set_={name: stmt.excluded[name] for name in ("model", "response", "created_at", "expires_at")},
+                ))
+            else:
+                keys = [row["cache_key"] for row in rows]
+                db.execute(delete(LLM_RESPONSE_CACHE).where(LLM_RESPONSE_CACHE.c.cache_key.in_(keys)))
+                db.execute(insert(LLM_RESPONSE_CACHE), rows)
+        previous = self._db_stores
+        self._db_stores += len(items)
+        if self._db_stores // PURGE_INTERVAL != previous // PURGE_INTERVAL:
+            self.purge_expired(db)
+
+    def purge_expired(self, db: Session) -> int:
+        """DB上の期限切れの行を削除し、削除件数を返す。"""
+        deleted = db.execute(
+            delete(LLM_RESPONSE_CACHE).where(LLM_RESPONSE_CACHE.c.expires_at <= datetime.utcnow())
+        ).rowcount
+        if deleted:
+            logger.info(f"期限切れのLLM応答キャッシュを {deleted} 件削除しました。")
+        return deleted
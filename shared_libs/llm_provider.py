@@ -0,0 +1,90 @@
+# .\shared-libs\llm_provider.py
+"""
+llm_provider.py
+LLMの呼び出し先(共通インターフェースと、OpenAI実装・ローカルのスタブサーバー実装)
+"""
+
+import os
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+STUB_BASE_URL = "http://127.0.0.1:8900/v1"
+
+
+class LLMProvider(ABC):
+    """
+    LLMの呼び出し先を表すインターフェース。AIClient はここで作ったリクエストを送り、応答を解釈する。
+    応答の形式は OpenAI の completions API(ストリーミング時は "data: {...}" のSSE)を標準とし、
+    異なる形式のサービスは parse_completion / parse_stream_event を上書きする。
+    name と model は応答キャッシュのキーに含まれ、異なる呼び出し先の応答の混在を防ぐ。
+    """
+    name: str
+    model: str
+
+    @abstractmethod
+    def completion_request(self, prompt: str, max_tokens: int,
+                           stream: bool = False) -> Optional[Tuple[str, dict, dict]]:
+        """(URL, ヘッダー, 本文) を返す。認証情報がないなど呼び出せない場合は None を返す。"""
+        raise NotImplementedError
+
+    def parse_completion(self, data: dict) -> str:
+        return data["choices"][0]["text"]
+
+    def parse_stream_event(self, data: dict) -> str:
+        return data["choices"][0]["text"]
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI の completions API。APIキーは api_key 未指定時に呼び出しのたびに環境変数 OPENAI_API_KEY から読む。"""
+    name = "openai"
+
+    def __init__(self, model: str = "text-davinci-003", base_url: str = OPENAI_BASE_URL,
+                 api_key: Optional[str] = None):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+
+    def completion_request(self, prompt: str, max_tokens: int,
+                           stream: bool = False) -> Optional[Tuple[str, dict, dict]]:
+        api_key = self.api_key or os.getenv("OPENAI_API_KEY", "")
+        if not api_key:
+            return None
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "max_tokens": max_tokens
+        }
+        if stream:
+            payload["stream"] = True
+        return f"{self.base_url}/completions", headers, payload
+
+
+class StubProvider(OpenAIProvider):
+    """
+    ローカルのスタブサーバー(shared_libs.stub_llm_server)。OpenAI と同じ形式で応答し、認証は不要。
+    ネットワークのない環境での負荷試験・応答時間の計測に使う。
+    """
+    name = "stub"
+
+    def __init__(self, model: str = "stub", base_url: str = STUB_BASE_URL):
+        super().__init__(model=model, base_url=base_url, api_key="stub")
+
+
+def get_provider(backend: Optional[str] = None, model: Optional[str] = None,
+                 base_url: Optional[str] = None) -> LLMProvider:
+    """
+    環境変数 LLM_PROVIDER(openai / stub、既定は openai)・LLM_MODEL・LLM_BASE_URL から呼び出し先を作る。
+    """
+    backend = (backend or os.getenv("LLM_PROVIDER", "openai")).lower()
+    model = model or os.getenv("LLM_MODEL") or None
+    base_url = base_url or os.getenv("LLM_BASE_URL") or None
+    if backend == "openai":
+        return OpenAIProvider(model=model or "text-davinci-003", base_url=base_url or OPENAI_BASE_URL)
+    if backend == "stub":
+        return StubProvider(model=model or "stub", base_url=base_url or STUB_BASE_URL)
+    raise ValueError(f"未対応のLLMプロバイダーです: {backend}")
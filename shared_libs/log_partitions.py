@@ -0,0 +1,274 @@
+# .\shared-libs\log_partitions.py
+"""
+log_partitions.py
+ログ表(月単位のレンジパーティション)のパーティションの事前作成と、保持期間を過ぎたパーティションの切り離し・削除
+保守が止まっていた間に既定パーティションに入った行は、その月のパーティションを作成して移す
+"""
+
+import logging
+import re
+import threading
+from datetime import date, datetime
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+RETENTION_MODES = ("drop", "detach")
+
+PARTITIONED_SQL = text(
+    "SELECT 1 FROM pg_partitioned_table pt "
+    "JOIN pg_class c ON c.oid = pt.partrelid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE n.nspname = :schema AND c.relname = :table"
+)
+
+PARTITIONS_SQL = text(
+    "SELECT c.relname FROM pg_inherits i "
+    "JOIN pg_class c ON c.oid = i.inhrelid "
+    "JOIN pg_class p ON p.oid = i.inhparent "
+    "JOIN pg_namespace n ON n.oid = p.relnamespace "
+    "WHERE n.nspname = :schema AND p.relname = :table"
+)
+
+
+class PartitionedTable(NamedTuple):
+    """月単位でパーティション分割したログ表と、その保持月数(0以下は削除しない)・パーティションキーの列"""
+    schema: str
+    table: str
+    retention_months: int = 0
+    key: str = "created_at"
+
+    @property
+    def qualified_name(self) -> str:
+        return f"{self.schema}.{self.table}"
+
+    @property
+    def column(self) -> str:
+        """SQLに埋め込むパーティションキーの列名(timestamp などの型名と区別するため引用符で囲む)。"""
+        return f'"{self.key}"'
+
+    @property
+    def default_name(self) -> str:
+        """既定パーティション(範囲外の行の受け皿)の名前。"""
+        return f"{self.table}_default"
+
+    def partition_name(self, month: date) -> str:
+        """month(月初日)のパーティション名(例: ai_call_logs_p202610)。"""
+        return f"{self.table}_p{month:%Y%m}"
+
+    def month_of(self, partition_name: str) -> Optional[date]:
+        """partition_name が月のパーティションであればその月初日を、それ以外(既定パーティション)は None を返す。"""
+        match = re.fullmatch(re.escape(self.table) + r"_p(\d{4})(\d{2})", partition_name)
+        if match is None:
+            return None
+        return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def is_partitioned(db: Session, spec: PartitionedTable) -> bool:
+    return db.execute(PARTITIONED_SQL, {"schema": spec.schema, "table": spec.table}).first() is not None
+
+
+def list_partitions(db: Session, spec: PartitionedTable) -> List[str]:
+    return sorted(row[0] for row in db.execute(PARTITIONS_SQL, {"schema": spec.schema, "table": spec.table}))
+
+
+def default_months(db: Session, spec: PartitionedTable) -> List[date]:
+    """既定パーティションに行がある月(月初日)の一覧を返す。"""
+    result = db.execute(text(
+        f"SELECT DISTINCT CAST(date_trunc('month', {spec.column}) AS DATE) "
+        f"FROM {spec.schema}.{spec.default_name} WHERE {spec.column} IS NOT NULL"
+    ))
+    return sorted(month_start(row[0]) for row in result)
+
+
+def _month_range(spec: PartitionedTable, month: date) -> str:
+    return f"{spec.column} >= '{month.isoformat()}' AND {spec.column} < '{add_months(month, 1).isoformat()}'"
+
+
+def move_default_rows(db: Session, spec: PartitionedTable, month: date) -> None:
+    """
+    既定パーティションに month の行がある場合、その月のパーティションは直接作成できないため、
+    既定パーティションを切り離してから月のパーティションを作成して行を移し、既定パーティションに戻す。
+    コミットは呼び出し元で行う(途中で失敗した場合はロールバックで元に戻る)。
+    """
+    name = spec.partition_name(month)
+    default = f"{spec.schema}.{spec.default_name}"
+    db.execute(text(f"ALTER TABLE {spec.qualified_name} DETACH PARTITION {default}"))
+    db.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {spec.schema}.{name} PARTITION OF {spec.qualified_name} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+    db.execute(text(f"INSERT INTO {spec.schema}.{name} SELECT * FROM {default} WHERE {_month_range(spec, month)}"))
+    db.execute(text(f"DELETE FROM {default} WHERE {_month_range(spec, month)}"))
+    db.execute(text(f"ALTER TABLE {spec.qualified_name} ATTACH PARTITION {default} DEFAULT"))
+
+
+def ensure_partitions(db: Session, spec: PartitionedTable, months_ahead: int = 3,
+                      now: Optional[datetime] = None) -> List[str]:
+    """
+    今月から months_ahead か月先までの月のパーティションと既定パーティション(範囲外の行の受け皿)を作成し、
+    作成したパーティション名を返す。既定パーティションに行がある月(保守が止まっていた間の月など)は
+    そのパーティションを作成して行を移し、保持期間の対象にする。
+    月ごとにコミットし、1か月分の失敗は記録して残りの月を続ける。
+    """
+    current = month_start(now or datetime.utcnow())
+    existing = set(list_partitions(db, spec))
+    created = []
+    stranded = set()
+    if spec.default_name not in existing:
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {spec.schema}.{spec.default_name} "
+            f"PARTITION OF {spec.qualified_name} DEFAULT"
+        ))
+        db.commit()
+        created.append(spec.default_name)
+    else:
+        stranded = set(default_months(db, spec))
+    months = {add_months(current, offset) for offset in range(months_ahead + 1)} | stranded
+    for month in sorted(months):
+        name = spec.partition_name(month)
+        if name in existing:
+            continue
+        try:
+            if month in stranded:
+                move_default_rows(db, spec, month)
+                logger.warning(f"{spec.qualified_name}: 既定パーティションの {month:%Y-%m} の行を {name} に移しました。")
+            else:
+                db.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {spec.schema}.{name} PARTITION OF {spec.qualified_name} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                ))
+            db.commit()
+            created.append(name)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"パーティション {spec.schema}.{name} の作成中にエラーが発生しました: {e}")
+    if created:
+        logger.info(f"{spec.qualified_name}: パーティションを作成しました: {', '.join(created)}")
+    return created
+
+
+def apply_retention(db: Session, spec: PartitionedTable, mode: str = "detach",
+                    now: Optional[datetime] = None) -> List[str]:
+    """
+    保持月数(今月を含む)より前の月のパーティションを切り離し(mode="detach")、または削除(mode="drop")し、
+    処理したパーティション名を返す。切り離したパーティションは通常の表として残る(退避・集計用)。
+    既定パーティションの行は通常 ensure_partitions で月のパーティションに移してから対象になるが、
+    mode="drop" の場合は移せずに残った保持期間より前の行もパーティションキーで削除する。
+    """
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"未対応の保持方式です: {mode}")
+    if spec.retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(now or datetime.utcnow()), -(spec.retention_months - 1))
+    expired = []
+    for name in list_partitions(db, spec):
+        month = spec.month_of(name)
+        if month is None or month >= cutoff:
+            continue
+        try:
+            db.execute(text(f"ALTER TABLE {spec.qualified_name} DETACH PARTITION {spec.schema}.{name}"))
+            if mode == "drop":
+                db.execute(text(f"DROP TABLE {spec.schema}.{name}"))
+            db.commit()
+            expired.append(name)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"パーティション {spec.schema}.{name} の{mode}中にエラーが発生しました: {e}")
+    if mode == "drop":
+        try:
+            pruned = db.execute(text(
+                f"DELETE FROM {spec.schema}.{spec.default_name} WHERE {spec.column} < '{cutoff.isoformat()}'"
+            )).rowcount
+            db.commit()
+            if pruned:
+                logger.info(f"{spec.qualified_name}: 既定パーティションの保持期間を過ぎた行 {pruned} 件を削除しました。")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"既定パーティション {spec.schema}.{spec.default_name} の削除中にエラーが発生しました: {e}")
+    if expired:
+        action = "削除" if mode == "drop" else "切り離し"
+        logger.info(f"{spec.qualified_name}: 保持期間を過ぎたパーティションを{action}しました: {', '.join(expired)}")
+    return expired
+
+
+class PartitionMaintainer:
+    """
+    ログ表のパーティションの作成と保持期間の適用を、start() 時と interval_seconds ごとに
+    バックグラウンドのスレッドで行う。パーティション分割されていない表(移行前・SQLiteなど)は何もしない。
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], tables: List[PartitionedTable],
+                 months_ahead: int = 3, mode: str = "detach", interval_seconds: float = 86400.0):
+        if mode not in RETENTION_MODES:
+            raise ValueError(f"未対応の保持方式です: {mode}")
+        self.session_factory = session_factory
+        self.tables = tables
+        self.months_ahead = months_ahead
+        self.mode = mode
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_run: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def run_once(self, now: Optional[datetime] = None) -> dict:
+        """全ての表にパーティションの作成と保持期間を適用し、表ごとの作成・削除したパーティション名を返す。"""
+        result = {}
+        db = self.session_factory()
+        try:
+            if db.bind.dialect.name != "postgresql":
+                return result
+            for spec in self.tables:
+                if not is_partitioned(db, spec):
+                    logger.warning(f"{spec.qualified_name} はパーティション分割されていないため、保守を行いません。")
+                    continue
+                result[spec.qualified_name] = {
+                    "created": ensure_partitions(db, spec, self.months_ahead, now),
+                    "expired": apply_retention(db, spec, self.mode, now),
+                }
+            self.last_run = datetime.utcnow()
+            self.last_error = None
+            return result
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"ログ表のパーティション保守中にエラーが発生しました: {e}")
+            raise e
+        finally:
+            db.close()
+
+    def start(self) -> None:
+        """保守スレッドを起動する(起動直後に1回実行する)。起動済みの場合は何もしない。"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="log-partitions", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        thread = self._thread
+        self._thread = None
+        self._stop.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                # エラーは run_once で記録済み。次の周期で再試行する
+                pass
+            self._stop.wait(self.interval_seconds)
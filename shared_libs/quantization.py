@@ -0,0 +1,163 @@
+# .\shared-libs\quantization.py
+"""
+quantization.py
+Embeddingの圧縮表現(int8スカラー量子化・直積量子化)と、圧縮表現のままの近似スコア計算
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+# 近似スコアを計算する際の1回あたりの行数(float32 への一時変換を抑える)
+SCORE_BATCH_SIZE = 65536
+# int8 の最大値(値を [-127, 127] に収め、-128 は使わない)
+INT8_MAX = 127
+
+
+class ScalarQuantizer:
+    """
+    各行を行ごとの倍率で int8 に量子化する(1次元あたり1バイト + 行ごとの倍率4バイト、約4分の1)。
+    学習は不要で、追加した行をそのまま符号化できる。
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    @property
+    def is_trained(self) -> bool:
+        return True
+
+    def code_shape(self) -> Tuple[int, ...]:
+        return (self.dim,)
+
+    @property
+    def code_dtype(self):
+        return np.int8
+
+    def bytes_per_vector(self) -> int:
+        return self.dim + np.dtype(np.float32).itemsize
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(符号 (件数, dim) の int8, 行ごとの倍率 (件数,) の float32) を返す。"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / INT8_MAX
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def decode(self, codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * scales[:, None]
+
+    def score(self, codes: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """符号化済みの行とクエリの近似内積を返す。"""
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], SCORE_BATCH_SIZE):
+            end = start + SCORE_BATCH_SIZE
+            scores[start:end] = (codes[start:end].astype(np.float32) @ query) * scales[start:end]
+        return scores
+
+
+class ProductQuantizer:
+    """
+    ベクトルを n_subvectors 個の部分ベクトルに分け、部分空間ごとに学習した n_centroids 個の
+    代表点の番号(1バイト)で表す直積量子化。1行あたり n_subvectors バイトになる。
+    検索時はクエリと各代表点の内積表を先に作り、符号で表を引いて足し合わせる(ADC)。
+    """
+
+    def __init__(self, dim: int, n_subvectors: Optional[int] = None, n_centroids: int = 256):
+        n_subvectors = n_subvectors or max(dim // 4, 1)
+        if dim % n_subvectors != 0:
+            raise ValueError(f"次元数 {dim} は部分ベクトル数 {n_subvectors} で割り切れる必要があります。")
+        if not 1 <= n_centroids <= 256:
+            raise ValueError("n_centroids は 1〜256 を指定してください。")
+        self.dim = dim
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.sub_dim = dim // n_subvectors
+        # (n_subvectors, n_centroids, sub_dim)
+        self.codebooks: Optional[np.ndarray] = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def code_shape(self) -> Tuple[int, ...]:
+        return (self.n_subvectors,)
+
+    @property
+    def code_dtype(self):
+        return np.uint8
+
+    def bytes_per_vector(self) -> int:
+        return self.n_subvectors
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """(件数, dim) を (n_subvectors, 件数, sub_dim) に並べ替える。"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors.reshape(vectors.shape[0], self.n_subvectors, self.sub_dim).transpose(1, 0, 2)
+
+    @staticmethod
+    def _nearest(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """各点に最も近い(ユークリッド距離)代表点の番号を返す。"""
+        assign = np.empty(points.shape[0], dtype=np.int64)
+        half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+        for start in range(0, points.shape[0], SCORE_BATCH_SIZE):
+            batch = points[start:start + SCORE_BATCH_SIZE]
+            assign[start:start + SCORE_BATCH_SIZE] = np.argmax(batch @ centroids.T - half_norms, axis=1)
+        return assign
+
+    def train(self, sample: np.ndarray, iterations: int = 15, seed: int = 0) -> None:
+        """部分空間ごとに k-means で代表点を学習する。"""
+        rng = np.random.default_rng(seed)
+        subspaces = self._split(sample)
+        n = subspaces.shape[1]
+        k = min(self.n_centroids, n)
+        codebooks = np.zeros((self.n_subvectors, self.n_centroids, self.sub_dim), dtype=np.float32)
+        for j, points in enumerate(subspaces):
+            centroids = points[rng.choice(n, k, replace=False)].copy()
+            for _ in range(iterations):
+                assign = self._nearest(points, centroids)
+                counts = np.bincount(assign, minlength=k)
+                sums = np.stack([np.bincount(assign, weights=points[:, d], minlength=k)
+                                 for d in range(self.sub_dim)], axis=1)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+                if not filled.all():
+                    # 空の代表点はランダムな点で再初期化する
+                    centroids[~filled] = points[rng.choice(n, int((~filled).sum()))]
+            codebooks[j, :k] = centroids
+            if k < self.n_centroids:
+                # 学習データが少ない場合、残りは使われない代表点として最初の点を複製しておく
+                codebooks[j, k:] = centroids[0]
+        self.codebooks = codebooks
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, None]:
+        """(符号 (件数, n_subvectors) の uint8, None) を返す。"""
+        if self.codebooks is None:
+            raise RuntimeError("直積量子化の代表点が学習されていません。")
+        subspaces = self._split(vectors)
+        codes = np.empty((subspaces.shape[1], self.n_subvectors), dtype=np.uint8)
+        for j, points in enumerate(subspaces):
+            codes[:, j] = self._nearest(points, self.codebooks[j])
+        return codes, None
+
+    def decode(self, codes: np.ndarray, scales=None) -> np.ndarray:
+        parts = [self.codebooks[j][codes[:, j]] for j in range(self.n_subvectors)]
+        return np.concatenate(parts, axis=1)
+
+    def score(self, codes: np.ndarray, scales, query: np.ndarray) -> np.ndarray:
+        """符号化済みの行とクエリの近似内積を、部分空間ごとの内積表を引いて返す。"""
+        tables = np.einsum("jkd,jd->jk", self.codebooks, query.reshape(self.n_subvectors, self.sub_dim))
+        scores = np.zeros(codes.shape[0], dtype=np.float32)
+        for j in range(self.n_subvectors):
+            scores += np.take(tables[j], codes[:, j])
+        return scores
+
+
+def get_quantizer(mode: str, dim: int, n_subvectors: Optional[int] = None):
+    """圧縮方式(int8 / pq)に応じた量子化器を作る。"""
+    if mode == "int8":
+        return ScalarQuantizer(dim)
+    if mode == "pq":
+        return ProductQuantizer(dim, n_subvectors)
+    raise ValueError(f"未対応の圧縮方式です: {mode}")
@@ -0,0 +1,341 @@
+# .\shared-libs\quantized_index.py
+"""
+quantized_index.py
+圧縮表現(int8 / 直積量子化)で保持するベクトル索引と、float32ベクトルによる候補の再ランキング
+"""
+
+import copy
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_libs.quantization import get_quantizer
+from shared_libs.row_bitsets import RowBitsets
+from shared_libs.vector_index import (
+    COMPACT_RATIO, SUBSET_SCORING_RATIO, SearchHit, group_rows, normalize_rows, to_span_array, top_k_indices,
+)
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("int8", "pq")
+RERANK_FILE = "rerank_vectors.f32"
+# 再ランキングする候補数の下限
+RERANK_MIN_CANDIDATES = 32
+
+
+class QuantizedIndex:
+    """
+    ベクトルを int8 または直積量子化の符号としてメモリに保持し、符号のまま近似スコアで
+    候補を絞ってから、float32ベクトルで正確に計算し直して上位 top_k 件を返す索引。
+
+    float32ベクトルはメモリマップファイル(path 未指定時は一時ファイル)に置き、
+    再ランキングする候補の行だけを読むため、ワーカーのメモリに常駐するのは符号だけになる。
+    直積量子化は train_size 件たまった時点で代表点を学習し、それまでは float32 で総当たりする。
+    削除・絞り込み(where)・詰め直し(compact)の扱いは VectorIndex と同じ。
+    """
+
+    def __init__(self, dim: int, mode: str = "int8", n_subvectors: Optional[int] = None,
+                 rerank_factor: int = 4, path: Optional[str] = None,
+                 train_size: Optional[int] = None, initial_capacity: int = 1024):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"未対応の圧縮方式です: {mode}")
+        self.dim = dim
+        self.mode = mode
+        self.quantizer = get_quantizer(mode, dim, n_subvectors)
+        self.rerank_factor = rerank_factor
+        self.train_size = train_size or getattr(self.quantizer, "n_centroids", 0) * 40
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+            # 前回の内容は DB から読み直すため、ファイルは作り直す
+            self._float_file = open(os.path.join(path, RERANK_FILE), "w+b")
+        else:
+            self._float_file = tempfile.TemporaryFile()
+        self._doc_refs: List[str] = []
+        self._texts: List[str] = []
+        self._rows_by_ref: Dict[str, List[int]] = {}
+        self.filters = RowBitsets()
+        self._deleted = 0
+        self._size = 0
+        self._capacity = 0
+        self._lock = threading.Lock()
+        # 学習(代表点の学習と全行の符号化)と詰め直しを同時に1つだけ行うためのロック
+        self._train_lock = threading.Lock()
+        self._grow(max(initial_capacity, 1))
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def doc_refs(self) -> List[str]:
+        """登録されている(削除されていない)文書参照の一覧を返す。"""
+        with self._lock:
+            return list(self._rows_by_ref)
+
+    def set_doc_keys(self, doc_ref: str, keys: Iterable[str]) -> None:
+        """文書 doc_ref の全チャンクの絞り込み用キーを置き換える。"""
+        with self._lock:
+            self.filters.set_doc_keys(doc_ref, self._rows_by_ref.get(doc_ref, []), keys)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.quantizer.is_trained
+
+    def memory_bytes(self) -> int:
+        """メモリに常駐するベクトル表現(符号・倍率)のバイト数。"""
+        return self._size * self.quantizer.bytes_per_vector()
+
+    def _grow(self, capacity: int) -> None:
+        size = self._size
+        if isinstance(getattr(self, "_floats", None), np.memmap):
+            self._floats.flush()
+        self._floats = np.memmap(self._float_file, dtype=np.float32, mode="r+" if self._capacity else "w+",
+                                 shape=(capacity, self.dim))
+        codes = np.zeros((capacity,) + self.quantizer.code_shape(), dtype=self.quantizer.code_dtype)
+        scales = np.ones(capacity, dtype=np.float32)
+        chunk_ids = np.zeros(capacity, dtype=np.int64)
+        spans = np.full((capacity, 2), -1, dtype=np.int64)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._capacity:
+            codes[:size] = self._codes[:size]
+            scales[:size] = self._scales[:size]
+            chunk_ids[:size] = self._chunk_ids[:size]
+            spans[:size] = self._spans[:size]
+            alive[:size] = self._alive[:size]
+        self._codes = codes
+        self._scales = scales
+        self._chunk_ids = chunk_ids
+        self._spans = spans
+        self._alive = alive
+        self._capacity = capacity
+
+    def _reserve(self, required: int) -> None:
+        if required <= self._capacity:
+            return
+        capacity = self._capacity
+        while capacity < required:
+            capacity *= 2
+        self._grow(capacity)
+
+    def _encode_rows(self, start: int, end: int) -> None:
+        codes, scales = self.quantizer.encode(self._floats[start:end])
+        self._codes[start:end] = codes
+        if scales is not None:
+            self._scales[start:end] = scales
+
+    def train(self, sample_size: Optional[int] = None, iterations: int = 15) -> None:
+        """
+        直積量子化の代表点を登録済みのベクトルから学習し、全行を符号化し直す。
+        学習と符号化は別の量子化器・符号の配列に対してロックの外で行い、最後にロック内で差し替えるため、
+        検索は学習中も古い代表点と古い符号の組で行われる(新旧が混ざらない)。
+        """
+        with self._train_lock:
+            self._train(sample_size, iterations)
+
+    def _train(self, sample_size: Optional[int], iterations: int) -> None:
+        size = self._size
+        if size == 0 or self.mode != "pq":
+            return
+        sample_size = sample_size or self.train_size
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(size, min(sample_size, size), replace=False))
+        quantizer = copy.copy(self.quantizer)
+        quantizer.train(np.asarray(self._floats[rows]), iterations=iterations)
+        codes, _ = quantizer.encode(self._floats[:size])
+        with self._lock:
+            # 学習中に追加された行は新しい代表点で符号化する(配列が拡張されていれば容量を合わせる)
+            current = self._size
+            swapped = np.zeros((self._capacity,) + quantizer.code_shape(), dtype=quantizer.code_dtype)
+            swapped[:size] = codes
+            if current > size:
+                swapped[size:current], _ = quantizer.encode(self._floats[size:current])
+            self.quantizer = quantizer
+            self._codes = swapped
+        logger.info(f"直積量子化の代表点を学習しました: rows={current}, subvectors={quantizer.n_subvectors}")
+
+    def add(self, chunk_ids: Sequence[int], vectors: np.ndarray,
+            doc_refs: Sequence[str], texts: Sequence[str],
+            spans: Optional[Sequence[Tuple[int, int]]] = None,
+            row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """チャンクを追加する。float32ベクトルは再ランキング用のファイルへ、符号はメモリへ書き込む。"""
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"次元数が一致しません: expected={self.dim}, actual={vectors.shape[1]}")
+        if not (len(chunk_ids) == len(doc_refs) == len(texts) == count):
+            raise ValueError("chunk_ids / vectors / doc_refs / texts の件数が一致しません。")
+        span_array = to_span_array(spans, count)
+        with self._lock:
+            start = self._size
+            self._reserve(start + count)
+            self._floats[start:start + count] = vectors
+            if self.is_trained:
+                self._encode_rows(start, start + count)
+            self._chunk_ids[start:start + count] = np.asarray(chunk_ids, dtype=np.int64)
+            self._spans[start:start + count] = span_array
+            self._alive[start:start + count] = True
+            self._doc_refs.extend(doc_refs)
+            self._texts.extend(texts)
+            for offset, doc_ref in enumerate(doc_refs):
+                self._rows_by_ref.setdefault(doc_ref, []).append(start + offset)
+            self.filters.add_rows(start, doc_refs, row_keys)
+            self._size = start + count
+        # 自動の学習は1回だけ行う(他のスレッドが学習中であれば、その結果を使う)
+        if not self.is_trained and self._size >= self.train_size and self._train_lock.acquire(blocking=False):
+            try:
+                if not self.is_trained:
+                    self._train(None, 15)
+            finally:
+                self._train_lock.release()
+
+    def remove_doc(self, doc_ref: str) -> int:
+        """doc_ref に属するチャンクを検索対象から外し、外した件数を返す。"""
+        with self._lock:
+            rows = self._rows_by_ref.pop(doc_ref, [])
+            if rows:
+                self._alive[rows] = False
+                self._deleted += len(rows)
+        return len(rows)
+
+    def compact(self, min_ratio: float = COMPACT_RATIO) -> int:
+        """
+        削除済みの行が全行の min_ratio 以上あれば、生きている行だけを新しい再ランキング用ファイルと符号の配列に
+        書き写して差し替え、取り除いた行数を返す。符号は書き写すだけで学習し直さない。
+        差し替え前に始まった検索は古いファイルと配列のまま最後まで実行できる。
+        """
+        with self._train_lock, self._lock:
+            size, deleted = self._size, self._deleted
+            if deleted == 0 or deleted < size * min_ratio:
+                return 0
+            keep = np.flatnonzero(self._alive[:size])
+            count = keep.shape[0]
+            capacity = max(count, 1)
+            # 検索中のスレッドが古いファイルを読み終えられるよう、書き写し先は新しいファイルにする
+            float_file = tempfile.TemporaryFile(dir=self.path or None)
+            floats = np.memmap(float_file, dtype=np.float32, mode="w+", shape=(capacity, self.dim))
+            floats[:count] = self._floats[keep]
+            codes = np.zeros((capacity,) + self.quantizer.code_shape(), dtype=self.quantizer.code_dtype)
+            codes[:count] = self._codes[keep]
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:count] = self._scales[keep]
+            chunk_ids = np.zeros(capacity, dtype=np.int64)
+            chunk_ids[:count] = self._chunk_ids[keep]
+            spans = np.full((capacity, 2), -1, dtype=np.int64)
+            spans[:count] = self._spans[keep]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:count] = True
+            old_file, self._float_file = self._float_file, float_file
+            self._floats = floats
+            self._codes = codes
+            self._scales = scales
+            self._chunk_ids = chunk_ids
+            self._spans = spans
+            self._alive = alive
+            self._capacity = capacity
+            self._doc_refs = [self._doc_refs[row] for row in keep.tolist()]
+            self._texts = [self._texts[row] for row in keep.tolist()]
+            self._rows_by_ref = group_rows(self._doc_refs)
+            self.filters = self.filters.compact(keep, size)
+            self._deleted = 0
+            self._size = count
+        # 古いファイルを閉じても、メモリマップは検索中のスレッドが参照を手放すまで有効
+        old_file.close()
+        if self.path and os.path.exists(os.path.join(self.path, RERANK_FILE)):
+            try:
+                os.remove(os.path.join(self.path, RERANK_FILE))
+            except OSError as e:
+                logger.warning(f"再ランキング用の古いファイルを削除できませんでした: {e}")
+        return deleted
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5,
+               where: Optional[Sequence[str]] = None,
+               rerank_factor: Optional[int] = None) -> List[SearchHit]:
+        """
+        符号のままの近似スコアで top_k × rerank_factor 件(最低 RERANK_MIN_CANDIDATES 件)の候補を選び、
+        その候補だけ float32 ベクトルで内積を計算し直して上位 top_k 件を返す。
+        rerank_factor に 0 を指定すると再ランキングせず近似スコアの順で返す。
+        """
+        # 量子化器と符号は学習時に差し替わるため、同じ時点の組を取り出して使う
+        # (詰め直しでは他の配列とファイルも差し替わる)
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            quantizer, codes, scales = self.quantizer, self._codes, self._scales
+            floats, alive, filters = self._floats, self._alive, self.filters
+            row_data = (self._chunk_ids, self._spans, self._doc_refs, self._texts)
+        if size == 0:
+            return []
+        query = normalize_rows(query_vector)[0]
+        if query.shape[0] != self.dim:
+            raise ValueError(f"クエリの次元数が一致しません: expected={self.dim}, actual={query.shape[0]}")
+        mask = alive[:size]
+        if where:
+            mask = filters.mask(size, where) & mask
+        rows = np.flatnonzero(mask) if (where or deleted) else np.arange(size)
+        if not quantizer.is_trained:
+            scores = floats[rows] @ query
+            best = top_k_indices(scores, top_k)
+            return self._to_hits(rows[best], scores[best], row_data)
+        if rows.shape[0] < size * SUBSET_SCORING_RATIO:
+            approx = quantizer.score(codes[rows], scales[rows], query)
+        else:
+            approx = quantizer.score(codes[:size], scales[:size], query)[rows]
+        factor = self.rerank_factor if rerank_factor is None else rerank_factor
+        if factor <= 0:
+            best = top_k_indices(approx, top_k)
+            return self._to_hits(rows[best], approx[best], row_data)
+        shortlist = np.sort(rows[top_k_indices(approx, max(top_k * factor, RERANK_MIN_CANDIDATES))])
+        exact = floats[shortlist] @ query
+        best = top_k_indices(exact, top_k)
+        return self._to_hits(shortlist[best], exact[best], row_data)
+
+    @staticmethod
+    def _to_hits(rows: np.ndarray, scores: np.ndarray, row_data: tuple) -> List[SearchHit]:
+        """行番号と、それに対応するスコアの配列から、検索開始時点の行データ row_data で検索結果を作る。"""
+        chunk_ids, spans, doc_refs, texts = row_data
+        hits = []
+        for row, score in zip(rows, scores):
+            start, end = spans[row]
+            hits.append(SearchHit(
+                chunk_id=int(chunk_ids[row]),
+                doc_ref=doc_refs[row],
+                score=float(score),
+                text=texts[row],
+                start=int(start) if start >= 0 else None,
+                end=int(end) if end >= 0 else None,
+            ))
+        return hits
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, top_k: int = 10,
+                  modes: Sequence[str] = QUANTIZATION_MODES, n_subvectors: Optional[int] = None,
+                  rerank_factor: int = 4) -> List[dict]:
+    """
+    圧縮方式ごとに、float32の総当たりに対する recall@top_k(再ランキングなし・あり)と
+    1ベクトルあたりのバイト数・圧縮率を計算する。
+    """
+    vectors = normalize_rows(vectors)
+    queries = normalize_rows(queries)
+    count, dim = vectors.shape
+    exact = [set(top_k_indices(vectors @ query, top_k).tolist()) for query in queries]
+    refs = [""] * count
+    float_bytes = dim * np.dtype(np.float32).itemsize
+    report = [{"mode": "float32", "bytes_per_vector": float_bytes, "compression": 1.0,
+               "recall_approx": 1.0, "recall_rerank": 1.0}]
+    for mode in modes:
+        index = QuantizedIndex(dim, mode=mode, n_subvectors=n_subvectors, rerank_factor=rerank_factor,
+                               train_size=count, initial_capacity=count)
+        index.add(list(range(count)), vectors, refs, refs)
+        recalls = {}
+        for key, factor in (("recall_approx", 0), ("recall_rerank", rerank_factor)):
+            found = 0
+            for query, truth in zip(queries, exact):
+                hits = index.search(query, top_k=top_k, rerank_factor=factor)
+                found += len(truth.intersection(hit.chunk_id for hit in hits))
+            recalls[key] = found / max(len(queries) * top_k, 1)
+        per_vector = index.quantizer.bytes_per_vector()
+        report.append({"mode": mode, "bytes_per_vector": per_vector,
+                       "compression": round(float_bytes / per_vector, 2), **recalls})
+    return report
@@ -1,29 +1,801 @@
 # .\shared-libs\rag_utils.py
 """
 rag_utils.py
-RAG検索(Embedding)関連の共通処理サンプル
+RAG検索(Embedding)関連の共通処理
 """
 
-from typing import List
+import hashlib
+import itertools
+import logging
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+from sqlalchemy import bindparam, delete, insert, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import column, table
+
+from shared_libs.ann_index import IVFIndex
+from shared_libs.bm25_index import BM25Index
+from shared_libs.chunker import Chunk, iter_chunks
+from shared_libs.embedding import Embedder
+from shared_libs.quantized_index import QUANTIZATION_MODES, QuantizedIndex
+from shared_libs.row_bitsets import filter_key
+from shared_libs.sharded_index import ShardedIndex
+from shared_libs.vector_codec import VECTOR_DTYPE, pack_vector, text_to_blob, unpack_matrix
+from shared_libs.vector_index import COMPACT_RATIO, SearchHit, VectorIndex
+
+logger = logging.getLogger(__name__)
+
+# DBから索引を読み込む際の1回あたりの取得件数
+LOAD_BATCH_SIZE = 10000
+# チャンク分割の設定(文字数)
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+# 1回にEmbedding化・登録するチャンク数
+INDEX_BATCH_SIZE = 64
+# ベクトル検索とBM25検索の統合方法
+# vector: ベクトルのみ / bm25: BM25のみ / rrf: 順位の逆数和 / linear: 正規化スコアの重み付き和
+FUSION_MODES = ("vector", "bm25", "rrf", "linear")
+# RRFの順位に加える定数
+RRF_K = 60
+# 統合前にそれぞれの検索から取得する候補数(top_k の倍数)
+FUSION_CANDIDATES = 4
+
+# doc_ref の接頭辞(文書の元テーブル)と、絞り込み条件 app で指定するアプリ名の対応
+HUB_DOCS_SOURCE = "hub_docs.documents"
+LOCAL_DOCS_SOURCE = "doc_app.local_docs"
+APP_BY_SOURCE = {HUB_DOCS_SOURCE: "hub-app", LOCAL_DOCS_SOURCE: "user-app-docs"}
+
+# 絞り込み用のメタデータ(ローカル文書の所有者とタグ)を読み込むSQL(全文書 / 指定した文書のみ)
+_METADATA_SELECT = (
+    "SELECT d.id, d.owner_id, t.tag_name "
+    "FROM doc_app.local_docs d "
+    "LEFT JOIN doc_app.doc_tag_links l ON l.doc_id = d.id "
+    "LEFT JOIN doc_app.doc_tags t ON t.tag_id = l.tag_id "
+)
+METADATA_SQL = text(_METADATA_SELECT + "ORDER BY d.id")
+DOC_METADATA_SQL = text(_METADATA_SELECT + "WHERE d.id IN :doc_ids ORDER BY d.id").bindparams(
+    bindparam("doc_ids", expanding=True)
+)
+
+DOC_EMBEDDINGS = table(
+    "doc_embeddings",
+    column("embedding_id"),
+    column("doc_ref"),
+    column("embedding_blob"),
+    column("embedding_dim"),
+    column("embedding_model"),
+    column("chunk_start"),
+    column("chunk_end"),
+    column("content_hash"),
+    schema="ai_schema",
+)
+
+# 永続化済み索引に取り込み済みの範囲(:after_id 以下)で、DBに残っているチャンクIDを返すSQL
+CHUNK_IDS_SQL = "SELECT embedding_id FROM ai_schema.doc_embeddings WHERE embedding_id <= :after_id"
+
+# チャンク本文のハッシュ値ごとに1つだけ保存するベクトル(同じ本文のチャンクはこれを共有する)
+CHUNK_VECTORS = table(
+    "chunk_vectors",
+    column("content_hash"),
+    column("embedding_model"),
+    column("embedding_blob"),
+    column("embedding_dim"),
+    schema="ai_schema",
+)
+
+# どの doc_embeddings 行からも参照されなくなったベクトルを削除するSQL(対象のハッシュ値を限定する場合)
+_ORPHAN_CONDITION = (
+    "NOT EXISTS (SELECT 1 FROM ai_schema.doc_embeddings e "
+    "WHERE e.content_hash = ai_schema.chunk_vectors.content_hash "
+    "AND e.embedding_model = ai_schema.chunk_vectors.embedding_model)"
+)
+DELETE_ORPHAN_VECTORS_SQL = text(
+    f"DELETE FROM ai_schema.chunk_vectors WHERE content_hash IN :hashes AND {_ORPHAN_CONDITION}"
+).bindparams(bindparam("hashes", expanding=True))
+DELETE_ALL_ORPHAN_VECTORS_SQL = text(f"DELETE FROM ai_schema.chunk_vectors WHERE {_ORPHAN_CONDITION}")
+
+
+def build_load_sql(model: Optional[str] = None, with_text: bool = False):
+    """
+    索引読み込み用のSQLを返す。model を指定した場合はそのモデルのEmbeddingのみ対象にする。
+    :from_id より大きいIDの行を返し、ベクトルは :after_id より大きいIDの行についてのみ返す。
+    永続化済み索引への差分取り込みでは、取り込み済みの行のベクトルを転送しない。
+
+    チャンク本文はチャンクの範囲(chunk_start 〜 chunk_end)をDB側で切り出す。範囲が不明な旧形式の行は、
+    with_text が True の場合はBM25索引用に文書全体を、False の場合は先頭 :text_chars 文字だけを返す。
+    本文は doc_ref の接頭辞に応じて hub_docs.documents または doc_app.local_docs から取得する。
+    ベクトルは行に直接保存されたもの(旧形式)か、content_hash で共有している chunk_vectors のものを使う。
+    """
+    content_sql = "COALESCE(d.content, l.content)"
+    whole_sql = content_sql if with_text else f"substr({content_sql}, 1, :text_chars)"
+    text_sql = (
+        f"CASE WHEN e.chunk_start IS NULL THEN {whole_sql} "
+        f"ELSE substr({content_sql}, e.chunk_start + 1, e.chunk_end - e.chunk_start) END"
+    )
+    sql = (
+        "SELECT e.embedding_id, e.doc_ref, "
+        "CASE WHEN e.embedding_id > :after_id THEN COALESCE(e.embedding_blob, v.embedding_blob) END, "
+        "COALESCE(e.embedding_dim, v.embedding_dim), "
+        "CASE WHEN e.embedding_id > :after_id THEN e.embedding_vector END, "
+        f"{text_sql} AS chunk_text, e.chunk_start, e.chunk_end "
+        "FROM ai_schema.doc_embeddings e "
+        "LEFT JOIN hub_docs.documents d ON e.doc_ref = 'hub_docs.documents:' || d.id::text "
+        "LEFT JOIN doc_app.local_docs l ON e.doc_ref = 'doc_app.local_docs:' || l.id::text "
+        "LEFT JOIN ai_schema.chunk_vectors v "
+        "ON v.content_hash = e.content_hash AND v.embedding_model = e.embedding_model "
+        "WHERE (e.embedding_blob IS NOT NULL OR e.embedding_vector IS NOT NULL OR v.embedding_blob IS NOT NULL) "
+        "AND e.embedding_id > :from_id "
+    )
+    if model is not None:
+        sql += "AND e.embedding_model = :model "
+    sql += "ORDER BY e.embedding_id"
+    return text(sql)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    """イテラブルを size 件ずつのリストに分けて返す。"""
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def fuse_hits(vector_hits: List[SearchHit], lexical_hits: List[SearchHit], top_k: int,
+              mode: str = "rrf", alpha: float = 0.5) -> List[SearchHit]:
+    """
+    ベクトル検索とBM25検索の結果をチャンクID単位で統合し、統合スコアの降順で返す。
+    rrf は順位の逆数 1/(RRF_K + 順位) の和、linear は各結果を最大値・最小値で
+    0〜1に正規化した alpha * ベクトル + (1 - alpha) * BM25 を統合スコアにする。
+    """
+    if mode == "vector":
+        return vector_hits[:top_k]
+    if mode == "bm25":
+        return lexical_hits[:top_k]
+    if mode not in FUSION_MODES:
+        raise ValueError(f"未対応の統合方法です: {mode}")
+    scores: dict = {}
+    hits_by_id: dict = {}
+    for weight, hits in ((alpha, vector_hits), (1.0 - alpha, lexical_hits)):
+        if not hits:
+            continue
+        if mode == "rrf":
+            contributions = [1.0 / (RRF_K + rank) for rank in range(1, len(hits) + 1)]
+        else:
+            high, low = hits[0].score, hits[-1].score
+            spread = high - low
+            contributions = [weight * ((hit.score - low) / spread if spread > 0 else 1.0) for hit in hits]
+        for hit, contribution in zip(hits, contributions):
+            scores[hit.chunk_id] = scores.get(hit.chunk_id, 0.0) + contribution
+            hits_by_id.setdefault(hit.chunk_id, hit)
+    ranked = sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)[:top_k]
+    return [hits_by_id[chunk_id]._replace(score=scores[chunk_id]) for chunk_id in ranked]
+
+
+def content_hash(chunk_text: str) -> bytes:
+    """チャンク本文のハッシュ値(SHA-256)。同じ本文のチャンクはベクトルを共有する。"""
+    return hashlib.sha256(chunk_text.encode("utf-8")).digest()
+
+
+def embedding_rows(doc_ref: str, chunks: Sequence[Chunk], hashes: Sequence[bytes],
+                   dim: int, model_name: str) -> List[dict]:
+    """
+    チャンクを doc_embeddings に挿入する行(辞書)の一覧にする。
+    ベクトル本体は chunk_vectors に content_hash 単位で保存し、この行には持たせない。
+    """
+    return [
+        {
+            "doc_ref": doc_ref,
+            "content_hash": chunk_hash,
+            "embedding_dim": dim,
+            "embedding_model": model_name,
+            "chunk_start": chunk.start,
+            "chunk_end": chunk.end,
+        }
+        for chunk, chunk_hash in zip(chunks, hashes)
+    ]
+
+
+def fetch_chunk_vectors(db: Session, model_name: str, hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+    """保存済みのベクトルを content_hash で引き、見つかったものだけを返す。"""
+    found: Dict[bytes, np.ndarray] = {}
+    for batch in batched(hashes, LOAD_BATCH_SIZE):
+        result = db.execute(
+            select(CHUNK_VECTORS.c.content_hash, CHUNK_VECTORS.c.embedding_blob)
+            .where(CHUNK_VECTORS.c.embedding_model == model_name)
+            .where(CHUNK_VECTORS.c.content_hash.in_(batch))
+        )
+        for chunk_hash, blob in result:
+            found[bytes(chunk_hash)] = np.frombuffer(blob, dtype=VECTOR_DTYPE)
+    return found
+
+
+def save_chunk_vectors(db: Session, model_name: str, vectors: Dict[bytes, np.ndarray]) -> None:
+    """ベクトルを content_hash 単位で保存する。並行して同じ本文が保存された場合は先に保存された方を残す。"""
+    if not vectors:
+        return
+    rows = [
+        {
+            "content_hash": chunk_hash,
+            "embedding_model": model_name,
+            "embedding_blob": pack_vector(vector),
+            "embedding_dim": vector.shape[0],
+        }
+        for chunk_hash, vector in vectors.items()
+    ]
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(postgresql.insert(CHUNK_VECTORS).on_conflict_do_nothing(), rows)
+    else:
+        db.execute(insert(CHUNK_VECTORS), rows)
+
+
+def collect_orphan_vectors(db: Session, hashes: Optional[Iterable[bytes]] = None) -> int:
+    """
+    どの doc_embeddings 行からも参照されなくなった chunk_vectors を削除し、削除件数を返す。
+    hashes を指定した場合はそのハッシュ値だけを調べる(文書の更新時に外れたチャンク)。
+    """
+    if hashes is None:
+        return db.execute(DELETE_ALL_ORPHAN_VECTORS_SQL).rowcount
+    deleted = 0
+    for batch in batched(hashes, LOAD_BATCH_SIZE):
+        deleted += db.execute(DELETE_ORPHAN_VECTORS_SQL, {"hashes": batch}).rowcount
+    return deleted
+
 
 class RAGSearcher:
+    # プロセス内で共有する索引とEmbedder
+    _index: Optional[Union[VectorIndex, IVFIndex, QuantizedIndex, ShardedIndex]] = None
+    _lexical: Optional[BM25Index] = None
+    _fusion: str = "rrf"
+    _fusion_alpha: float = 0.5
+    # 総当たり索引のベクトルの持ち方(none: float32 / int8 / pq)と再ランキングする候補の倍率
+    _quantization: str = "none"
+    _pq_subvectors: Optional[int] = None
+    _rerank_factor: int = 4
+    # 1以上の場合、総当たり索引を共有メモリに置き、このプロセス数で分割して並列に検索する
+    _shards: int = 0
+    _embedder: Optional[Embedder] = None
+    # 文書ごとの絞り込み用キー(タグ・所有者)。アプリのキーは doc_ref から求める
+    _doc_keys: Dict[str, FrozenSet[str]] = {}
+    # DBに保存しない場合に使う仮のチャンクID(DBのIDと重ならないよう負数)
+    _local_ids = itertools.count(-1, -1)
+    # 索引がない状態で複数のスレッド(索引登録のワーカー)が同時に索引を作らないようにするロック
+    _index_lock = threading.Lock()
+    # 削除済みの行がこの割合以上になった索引を詰め直す
+    _compact_ratio: float = COMPACT_RATIO
+    # DBに保存しない場合に content_hash で共有するベクトル((モデル名, ハッシュ値) → ベクトル)と、
+    # 文書ごとに参照しているベクトルのキー・キーごとの参照している文書数(0になったベクトルは削除する)
+    _local_vectors: Dict[Tuple[str, bytes], np.ndarray] = {}
+    _local_doc_vectors: Dict[str, Set[Tuple[str, bytes]]] = {}
+    _local_refcounts: Dict[Tuple[str, bytes], int] = {}
+    _local_lock = threading.Lock()
+    # index_document で扱ったチャンク数のうち、Embedding化したもの・保存済みのベクトルを再利用したもの
+    embed_stats: Dict[str, int] = {"chunks": 0, "embedded": 0, "reused": 0}
+    # 文書の内容・絞り込み条件が変わったときに doc_ref を渡して呼ぶ関数(回答キャッシュの破棄など)
+    _change_listeners: List[Callable[[str], None]] = []
+
     @staticmethod
-    def search_docs(query: str) -> List[str]:
+    def configure(embedder: Optional[Embedder] = None,
+                  index: Optional[Union[VectorIndex, IVFIndex, QuantizedIndex, ShardedIndex]] = None,
+                  lexical: Optional[BM25Index] = None,
+                  fusion: Optional[str] = None,
+                  fusion_alpha: Optional[float] = None,
+                  quantization: Optional[str] = None,
+                  pq_subvectors: Optional[int] = None,
+                  rerank_factor: Optional[int] = None,
+                  shards: Optional[int] = None,
+                  compact_ratio: Optional[float] = None) -> None:
         """
-        ダミー実装: 本来はベクトルDBやpgvectorを用いて
-        queryのEmbeddingと既存Embeddingを比較し、類似文書を取得
+        クエリ・チャンクをベクトル化する Embedder と検索に使う索引を設定する。
+        Embedder の model_name は doc_embeddings.embedding_model に記録される。
+        lexical はBM25索引、fusion / fusion_alpha はベクトル検索との統合方法(FUSION_MODES)。
+        quantization(none / int8 / pq)は以降に作る総当たり索引のベクトルの圧縮方式で、
+        pq_subvectors は直積量子化の部分ベクトル数、rerank_factor は float32 で再計算する候補の倍率。
+        shards を1以上にすると総当たり索引をプロセスプールで分割検索する(圧縮方式より優先)。
+        compact_ratio は索引を詰め直す削除済みの行の割合。
         """
-        # 仮に2つの文書を返す例
-        doc_snippets = [
-            "Doc snippet 1 about the query",
-            "Doc snippet 2 about the query"
-        ]
-        return doc_snippets
+        if fusion is not None and fusion not in FUSION_MODES:
+            raise ValueError(f"未対応の統合方法です: {fusion}")
+        if quantization is not None and quantization != "none" and quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"未対応の圧縮方式です: {quantization}")
+        if embedder is not None:
+            RAGSearcher._embedder = embedder
+        if index is not None:
+            RAGSearcher._index = index
+        if lexical is not None:
+            RAGSearcher._lexical = lexical
+        if fusion is not None:
+            RAGSearcher._fusion = fusion
+        if fusion_alpha is not None:
+            RAGSearcher._fusion_alpha = fusion_alpha
+        if quantization is not None:
+            RAGSearcher._quantization = quantization
+        if pq_subvectors is not None:
+            RAGSearcher._pq_subvectors = pq_subvectors
+        if rerank_factor is not None:
+            RAGSearcher._rerank_factor = rerank_factor
+        if shards is not None:
+            RAGSearcher._shards = shards
+        if compact_ratio is not None:
+            RAGSearcher._compact_ratio = compact_ratio
+
+    @staticmethod
+    def new_flat_index(dim: int) -> Union[VectorIndex, QuantizedIndex, ShardedIndex]:
+        """configure で設定したシャード数・圧縮方式の総当たり索引を作る。"""
+        if RAGSearcher._shards > 0:
+            if RAGSearcher._quantization != "none":
+                logger.warning("シャード分割検索では圧縮方式の設定を使わず float32 で保持します。")
+            return ShardedIndex(dim, workers=RAGSearcher._shards)
+        if RAGSearcher._quantization == "none":
+            return VectorIndex(dim)
+        return QuantizedIndex(dim, mode=RAGSearcher._quantization, n_subvectors=RAGSearcher._pq_subvectors,
+                              rerank_factor=RAGSearcher._rerank_factor)
+
+    @staticmethod
+    def get_embedder() -> Optional[Embedder]:
+        return RAGSearcher._embedder
+
+    @staticmethod
+    def add_change_listener(listener: Callable[[str], None]) -> None:
+        """文書の索引登録・削除・メタデータ変更のたびに、その doc_ref で listener を呼ぶよう登録する。"""
+        RAGSearcher._change_listeners.append(listener)
+
+    @staticmethod
+    def _notify_change(doc_ref: str) -> None:
+        for listener in RAGSearcher._change_listeners:
+            try:
+                listener(doc_ref)
+            except Exception as e:
+                logger.error(f"文書 {doc_ref} の変更通知の処理中にエラーが発生しました: {e}")
+
+    @staticmethod
+    def embed_query(query: str) -> Optional[np.ndarray]:
+        """query のEmbeddingを返す。Embedderが設定されていない場合は None。"""
+        if RAGSearcher._embedder is None:
+            return None
+        return RAGSearcher._embedder.embed(query)
+
+    @staticmethod
+    def get_index() -> Optional[Union[VectorIndex, IVFIndex, QuantizedIndex, ShardedIndex]]:
+        return RAGSearcher._index
+
+    @staticmethod
+    def close() -> None:
+        """索引が持つワーカープロセスや共有メモリを解放する(アプリ終了時に呼ぶ)。"""
+        if isinstance(RAGSearcher._index, ShardedIndex):
+            RAGSearcher._index.close()
+
+    @staticmethod
+    def get_lexical_index() -> Optional[BM25Index]:
+        return RAGSearcher._lexical
+
+    @staticmethod
+    def doc_ref_for(doc_id, source: str = HUB_DOCS_SOURCE) -> str:
+        """文書の元テーブルと文書IDから doc_embeddings.doc_ref の値を作る。"""
+        return f"{source}:{doc_id}"
 
     @staticmethod
-    def index_document(doc_id, content: str) -> None:
+    def keys_for(doc_ref: str) -> FrozenSet[str]:
+        """文書の絞り込み用キー(アプリ + 設定済みのタグ・所有者)を返す。"""
+        source = doc_ref.rsplit(":", 1)[0]
+        app_key = filter_key("app", APP_BY_SOURCE.get(source, source))
+        return RAGSearcher._doc_keys.get(doc_ref, frozenset()) | {app_key}
+
+    @staticmethod
+    def filter_keys(tags: Optional[Sequence[str]] = None, owner_id: Optional[int] = None,
+                    app: Optional[str] = None) -> List[str]:
+        """絞り込み条件を索引のキーに変換する。条件はすべて満たす必要がある(タグも全指定が必要)。"""
+        keys = [filter_key("tag", tag) for tag in tags or []]
+        if owner_id is not None:
+            keys.append(filter_key("owner", owner_id))
+        if app:
+            keys.append(filter_key("app", app))
+        return keys
+
+    @staticmethod
+    def set_doc_metadata(doc_ref: str, tags: Iterable[str] = (), owner_id: Optional[int] = None) -> None:
+        """文書のタグ・所有者を設定し、読み込み済みの索引の行にも反映する。"""
+        keys = {filter_key("tag", tag) for tag in tags}
+        if owner_id is not None:
+            keys.add(filter_key("owner", owner_id))
+        RAGSearcher._doc_keys[doc_ref] = frozenset(keys)
+        row_keys = RAGSearcher.keys_for(doc_ref)
+        for index in (RAGSearcher._index, RAGSearcher._lexical):
+            if index is not None:
+                index.set_doc_keys(doc_ref, row_keys)
+        RAGSearcher._notify_change(doc_ref)
+
+    @staticmethod
+    def load_metadata(db: Session, doc_ids: Optional[Sequence[int]] = None) -> int:
+        """
+        doc_app.local_docs の所有者と doc_tag_links のタグを読み込み、絞り込み用キーに設定する。
+        doc_ids を指定した場合はその文書だけを読み直す(タグ・所有者の変更時)。DBにない文書は
+        タグ・所有者のキーを外す。戻り値は読み込んだ文書数。
+        """
+        if doc_ids is None:
+            rows = db.execute(METADATA_SQL)
+        else:
+            rows = db.execute(DOC_METADATA_SQL, {"doc_ids": list(doc_ids)}) if doc_ids else []
+        tags_by_doc: Dict[int, List[str]] = {}
+        owners: Dict[int, Optional[int]] = {}
+        for doc_id, owner_id, tag_name in rows:
+            owners[doc_id] = owner_id
+            tags = tags_by_doc.setdefault(doc_id, [])
+            if tag_name is not None:
+                tags.append(tag_name)
+        for doc_id, tags in tags_by_doc.items():
+            RAGSearcher.set_doc_metadata(RAGSearcher.doc_ref_for(doc_id, LOCAL_DOCS_SOURCE), tags, owners[doc_id])
+        for doc_id in doc_ids or ():
+            if doc_id not in tags_by_doc:
+                RAGSearcher.set_doc_metadata(RAGSearcher.doc_ref_for(doc_id, LOCAL_DOCS_SOURCE))
+        logger.info(f"絞り込み用メタデータを読み込みました: {len(tags_by_doc)} 文書")
+        return len(tags_by_doc)
+
+    @staticmethod
+    def remove_document(doc_ref: str) -> None:
+        """文書のチャンクをすべての索引から外す。"""
+        for index in (RAGSearcher._index, RAGSearcher._lexical):
+            if index is not None:
+                index.remove_doc(doc_ref)
+        RAGSearcher._notify_change(doc_ref)
+        RAGSearcher.compact_indexes()
+
+    @staticmethod
+    def delete_document(doc_ref: str, db: Optional[Session] = None) -> None:
+        """
+        削除された文書のチャンクを索引から外す。db を指定した場合は doc_embeddings の行と、
+        どの行からも参照されなくなったベクトルも削除してコミットする(再起動後に検索結果へ戻らないように)。
+        """
+        RAGSearcher.remove_document(doc_ref)
+        if db is None:
+            RAGSearcher._retain_local_vectors(doc_ref, set())
+            return
+        try:
+            result = db.execute(
+                select(DOC_EMBEDDINGS.c.content_hash).where(DOC_EMBEDDINGS.c.doc_ref == doc_ref)
+            )
+            hashes = {bytes(row[0]) for row in result if row[0] is not None}
+            db.execute(delete(DOC_EMBEDDINGS).where(DOC_EMBEDDINGS.c.doc_ref == doc_ref))
+            collect_orphan_vectors(db, hashes)
+            db.commit()
+        except Exception as e:
+            logger.error(f"文書 {doc_ref} のEmbeddingの削除中にエラーが発生しました: {e}")
+            db.rollback()
+            raise e
+
+    @staticmethod
+    def load_index(db: Session, model: Optional[str] = None, ann_path: Optional[str] = None,
+                   n_lists: int = 256, n_probe: int = 8, lexical: bool = True) -> int:
+        """
+        ai_schema.doc_embeddings のベクトルを読み込み、インメモリ索引を構築する。
+        バイナリ列(embedding_blob)はバッチ単位で np.frombuffer により行列化し、
+        未移行のテキスト列のみ個別に解析する。戻り値は索引に登録した件数。
+
+        ann_path を指定した場合は総当たり索引の代わりにIVF近似索引を使い、
+        同じパスに永続化済みの索引があればそれを開いて、未登録の行だけを差分で取り込み、
+        DBから削除された(置換された)行は索引から外す。
+        ann_path を指定しない場合は configure の shards / quantization に従って総当たり索引を作る
+        (IVF索引はベクトルをメモリマップに置くため、これらの設定は使わない)。
+        各行には keys_for の絞り込み用キーを付けるため、先に load_metadata を呼んでおく。
+        lexical が True の場合はチャンク本文からBM25索引も構築する(BM25索引は永続化しないため常に全件)。
+        """
+        index: Optional[Union[VectorIndex, IVFIndex, QuantizedIndex, ShardedIndex]] = None
+        after_id = 0
+        if ann_path and IVFIndex.exists(ann_path):
+            index = IVFIndex.load(ann_path, n_probe=n_probe)
+            after_id = index.max_chunk_id()
+            # 他のプロセス(再索引のCLIや別のワーカーでの更新)がDBで削除・置換したチャンクを索引から外す
+            stale = RAGSearcher._stale_chunk_ids(db, index, after_id, model)
+            if stale.size:
+                index.remove_chunks(stale.tolist())
+                logger.info(f"DBにないチャンク {stale.size} 件を永続化済みの索引から外しました。")
+            # 絞り込み用のビット集合は永続化しないため、読み込んだ行に付け直す
+            for doc_ref in index.doc_refs():
+                index.set_doc_keys(doc_ref, RAGSearcher.keys_for(doc_ref))
+
+        def new_index(dim: int):
+            if ann_path:
+                return IVFIndex(dim, n_lists=n_lists, n_probe=n_probe, path=ann_path)
+            return RAGSearcher.new_flat_index(dim)
+
+        lexical_index = BM25Index() if lexical else None
+        params = {
+            "after_id": after_id,
+            "from_id": 0 if lexical else after_id,
+            "text_chars": CHUNK_SIZE,
+        }
+        if model is not None:
+            params["model"] = model
+        sql = build_load_sql(model, with_text=lexical).execution_options(stream_results=True)
+        result = db.execute(sql, params)
+        skipped = 0
+        for rows in result.partitions(LOAD_BATCH_SIZE):
+            chunk_ids, blobs, doc_refs, texts, spans, row_keys = [], [], [], [], [], []
+            lexical_rows = []
+            for embedding_id, doc_ref, blob, dim, embedding_vector, chunk_text, start, end in rows:
+                chunk_text = chunk_text or ""
+                # 検索結果に返す本文(範囲が不明な旧形式の行は文書の先頭 CHUNK_SIZE 文字)
+                hit_text = chunk_text if start is not None else chunk_text[:CHUNK_SIZE]
+                span = (-1, -1) if start is None else (start, end)
+                keys = RAGSearcher.keys_for(doc_ref)
+                if lexical_index is not None:
+                    lexical_rows.append((embedding_id, chunk_text, doc_ref, hit_text, span, keys))
+                if embedding_id <= after_id:
+                    # 永続化済み索引に取り込み済みの行
+                    continue
+                if blob is None:
+                    # 未移行のテキスト形式の行
+                    blob = text_to_blob(embedding_vector)
+                    dim = None
+                if dim is None:
+                    dim = len(blob) // VECTOR_DTYPE.itemsize
+                if index is None:
+                    index = new_index(dim)
+                if dim != index.dim:
+                    skipped += 1
+                    continue
+                chunk_ids.append(embedding_id)
+                blobs.append(blob)
+                doc_refs.append(doc_ref)
+                texts.append(hit_text)
+                spans.append(span)
+                row_keys.append(keys)
+            if chunk_ids:
+                index.add(chunk_ids, unpack_matrix(blobs, index.dim), doc_refs, texts,
+                          spans=spans, row_keys=row_keys)
+            if lexical_rows:
+                ids, lexical_texts, refs, hit_texts, lexical_spans, lexical_keys = (
+                    list(values) for values in zip(*lexical_rows)
+                )
+                lexical_index.add(ids, lexical_texts, refs, hit_texts, spans=lexical_spans, row_keys=lexical_keys)
+        if skipped:
+            logger.warning(f"次元数の異なるEmbedding {skipped} 件を読み飛ばしました。")
+        if isinstance(index, IVFIndex):
+            if not index.is_trained and len(index) >= index.n_lists:
+                index.train()
+            index.flush()
+        elif isinstance(index, QuantizedIndex):
+            if not index.is_trained and len(index) >= index.quantizer.n_centroids:
+                index.train()
+            logger.info(
+                f"圧縮索引({index.mode}): {index.memory_bytes()} バイト"
+                f"(float32の場合 {len(index) * index.dim * 4} バイト)"
+            )
+        if RAGSearcher._index is not index:
+            RAGSearcher.close()
+        RAGSearcher._index = index
+        RAGSearcher._lexical = lexical_index
+        count = len(index) if index is not None else 0
+        logger.info(f"RAG索引を読み込みました: {count} 件")
+        if lexical_index is not None:
+            logger.info(
+                f"BM25索引を構築しました: {len(lexical_index)} 件, ポスティング数 {lexical_index.posting_count}"
+            )
+        return count
+
+    @staticmethod
+    def _stale_chunk_ids(db: Session, index: IVFIndex, after_id: int, model: Optional[str]) -> np.ndarray:
+        """永続化済みの索引にあり、DBの doc_embeddings にはもうないチャンクIDを返す。"""
+        sql = CHUNK_IDS_SQL
+        params = {"after_id": after_id}
+        if model is not None:
+            sql += " AND embedding_model = :model"
+            params["model"] = model
+        result = db.execute(text(sql).execution_options(stream_results=True), params)
+        parts = [np.array([row[0] for row in rows], dtype=np.int64) for rows in result.partitions(LOAD_BATCH_SIZE)]
+        db_ids = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return np.setdiff1d(index.live_chunk_ids(), db_ids)
+
+    @staticmethod
+    def search_docs(query: str, top_k: int = 5, fusion: Optional[str] = None,
+                    tags: Optional[Sequence[str]] = None, owner_id: Optional[int] = None,
+                    app: Optional[str] = None, query_vector: Optional[np.ndarray] = None) -> List[SearchHit]:
+        """
+        queryのEmbeddingと既存Embeddingのコサイン類似度、およびBM25スコアで検索し、
+        fusion(省略時は configure で設定した統合方法)で統合したチャンクを降順で返す。
+        BM25索引またはEmbedding関数がない場合は、利用できる方の結果だけを返す。
+        tags / owner_id / app を指定した場合は、条件に合う行だけをスコア計算の対象にする
+        (上位k件を取ってから絞り込むのではないため、条件に合う結果が取りこぼされない)。
+        query_vector は呼び出し元で計算済みの query のEmbedding(省略時はここでEmbedding化する)。
+        """
+        where = RAGSearcher.filter_keys(tags, owner_id, app) or None
+        mode = fusion or RAGSearcher._fusion
+        if mode not in FUSION_MODES:
+            raise ValueError(f"未対応の統合方法です: {mode}")
+        candidates = top_k if mode in ("vector", "bm25") else top_k * FUSION_CANDIDATES
+        index = RAGSearcher._index
+        lexical = RAGSearcher._lexical
+        vector_hits: List[SearchHit] = []
+        lexical_hits: List[SearchHit] = []
+        if mode != "bm25":
+            if index is None or len(index) == 0:
+                logger.warning("RAG索引が読み込まれていないため、ベクトル検索の結果は空です。")
+            elif RAGSearcher._embedder is None:
+                logger.warning("Embedderが設定されていないため、ベクトル検索できません。")
+            else:
+                if query_vector is None:
+                    query_vector = RAGSearcher._embedder.embed(query)
+                vector_hits = index.search(query_vector, top_k=candidates, where=where)
+        if mode != "vector" and lexical is not None:
+            lexical_hits = lexical.search(query, top_k=candidates, where=where)
+        if not vector_hits:
+            return lexical_hits[:top_k]
+        if not lexical_hits:
+            return vector_hits[:top_k]
+        return fuse_hits(vector_hits, lexical_hits, top_k, mode, RAGSearcher._fusion_alpha)
+
+    @staticmethod
+    def index_document(doc_id, content: str, db: Optional[Session] = None,
+                       source: str = HUB_DOCS_SOURCE) -> int:
         """
-        ダミー実装: 新しい文書をEmbedding化してベクトルDBに登録
+        文書を重なりのあるチャンクに分割してEmbedding化し、doc_ref と文字範囲付きで索引に登録する。
+        同じ文書の既存チャンクは置き換える。チャンクは INDEX_BATCH_SIZE 件ずつEmbedding化・保存し、
+        索引の行は最後にまとめて入れ替える(db を指定した場合はコミットの後。失敗した場合は古いチャンクが残る)。
+        db を指定した場合は ai_schema.doc_embeddings にも保存してコミットする。
+        source は文書の元テーブル(doc_ref の接頭辞)。戻り値は登録したチャンク数。
+
+        ベクトルはチャンク本文のハッシュ値(content_hash)ごとに ai_schema.chunk_vectors に1つだけ保存し、
+        保存済みの本文(編集で変わらなかったチャンクや、他の文書と同じチャンク)はEmbedding化しない。
+        更新で参照されなくなったベクトルは、他の文書からも参照されていなければ削除する。
+        """
+        embedder = RAGSearcher._embedder
+        if embedder is None:
+            logger.warning(f"Embedderが設定されていないため、文書 {doc_id} を索引に登録できません。")
+            return 0
+        doc_ref = RAGSearcher.doc_ref_for(doc_id, source)
+        keys = RAGSearcher.keys_for(doc_ref)
+        index = RAGSearcher._index
+        lexical = RAGSearcher._lexical
+        if lexical is None and RAGSearcher._fusion != "vector":
+            with RAGSearcher._index_lock:
+                if RAGSearcher._lexical is None:
+                    RAGSearcher._lexical = BM25Index()
+                lexical = RAGSearcher._lexical
+        try:
+            old_hashes = set()
+            if db is not None:
+                removed = db.execute(
+                    delete(DOC_EMBEDDINGS).where(DOC_EMBEDDINGS.c.doc_ref == doc_ref)
+                    .returning(DOC_EMBEDDINGS.c.content_hash)
+                )
+                old_hashes = {bytes(row[0]) for row in removed if row[0] is not None}
+            count = 0
+            embedded = 0
+            new_hashes = set()
+            # 索引に入れる行(チャンクID・ベクトル・チャンク)。DBへの保存が確定するまで索引には入れない
+            pending = []
+            chunks = (chunk for chunk in iter_chunks(content, CHUNK_SIZE, CHUNK_OVERLAP) if chunk.text.strip())
+            for batch in batched(chunks, INDEX_BATCH_SIZE):
+                hashes = [content_hash(chunk.text) for chunk in batch]
+                vectors, batch_embedded = RAGSearcher._vectors_for(db, embedder, batch, hashes)
+                embedded += batch_embedded
+                new_hashes.update(hashes)
+                chunk_ids = RAGSearcher._store_chunks(db, doc_ref, batch, hashes, vectors.shape[1],
+                                                      embedder.model_name)
+                pending.append((chunk_ids, vectors, batch))
+                count += len(batch)
+            if db is not None:
+                collect_orphan_vectors(db, old_hashes - new_hashes)
+                db.commit()
+            for target in (index, lexical):
+                if target is not None:
+                    target.remove_doc(doc_ref)
+            for chunk_ids, vectors, batch in pending:
+                if index is None:
+                    index = RAGSearcher._ensure_index(vectors.shape[1])
+                doc_refs = [doc_ref] * len(batch)
+                texts = [chunk.text for chunk in batch]
+                spans = [(chunk.start, chunk.end) for chunk in batch]
+                row_keys = [keys] * len(batch)
+                index.add(chunk_ids, vectors, doc_refs, texts, spans=spans, row_keys=row_keys)
+                if lexical is not None:
+                    lexical.add(chunk_ids, texts, doc_refs, spans=spans, row_keys=row_keys)
+            if db is None:
+                RAGSearcher._retain_local_vectors(
+                    doc_ref, {(embedder.model_name, chunk_hash) for chunk_hash in new_hashes}
+                )
+            RAGSearcher.compact_indexes()
+            stats = RAGSearcher.embed_stats
+            stats["chunks"] += count
+            stats["embedded"] += embedded
+            stats["reused"] += count - embedded
+            logger.info(
+                f"文書 {doc_ref} を {count} チャンクで索引に登録しました"
+                f"(Embedding化 {embedded} 件, 再利用 {count - embedded} 件)。"
+            )
+            return count
+        except Exception as e:
+            logger.error(f"文書 {doc_ref} の索引登録中にエラーが発生しました: {e}")
+            if db is not None:
+                db.rollback()
+            raise e
+        finally:
+            # 登録中に作られた回答も古い内容を含みうるため、登録の完了(または失敗)後に通知する
+            RAGSearcher._notify_change(doc_ref)
+
+    @staticmethod
+    def compact_indexes() -> int:
+        """
+        削除済みの行が compact_ratio 以上になった索引を詰め直し、取り除いた行数を返す
+        (文書の更新のたびに索引登録のワーカーから呼ぶ。割合に満たなければ何もしない)。
         """
-        # 何もしない
-        pass
+        removed = 0
+        for index in (RAGSearcher._index, RAGSearcher._lexical):
+            if index is not None:
+                count = index.compact(RAGSearcher._compact_ratio)
+                if count:
+                    logger.info(f"{type(index).__name__} の削除済みの行 {count} 件を詰め直しました。")
+                removed += count
+        return removed
+
+    @staticmethod
+    def _ensure_index(dim: int) -> Union[VectorIndex, IVFIndex, QuantizedIndex, ShardedIndex]:
+        """索引を返す。まだない場合は総当たり索引を作る(同時に呼ばれても1つだけ作る)。"""
+        with RAGSearcher._index_lock:
+            if RAGSearcher._index is None:
+                RAGSearcher._index = RAGSearcher.new_flat_index(dim)
+            return RAGSearcher._index
+
+    @staticmethod
+    def _vectors_for(db: Optional[Session], embedder: Embedder, batch: List[Chunk],
+                     hashes: List[bytes]) -> Tuple[np.ndarray, int]:
+        """
+        チャンクのベクトルを返す。保存済みのベクトルがない本文(同じ本文は1回)だけをEmbedding化して保存する。
+        戻り値は (ベクトルの行列, Embedding化した件数)。
+        """
+        model_name = embedder.model_name
+        unique = list(dict.fromkeys(hashes))
+        if db is not None:
+            found = fetch_chunk_vectors(db, model_name, unique)
+        else:
+            found = {h: RAGSearcher._local_vectors[(model_name, h)]
+                     for h in unique if (model_name, h) in RAGSearcher._local_vectors}
+        missing = [h for h in unique if h not in found]
+        if missing:
+            text_by_hash = {h: chunk.text for h, chunk in zip(hashes, batch)}
+            vectors = embedder.embed_batch([text_by_hash[h] for h in missing])
+            created = dict(zip(missing, vectors))
+            if db is not None:
+                save_chunk_vectors(db, model_name, created)
+            else:
+                RAGSearcher._local_vectors.update(((model_name, h), v) for h, v in created.items())
+            found.update(created)
+        return np.stack([found[h] for h in hashes]).astype(np.float32, copy=False), len(missing)
+
+    @staticmethod
+    def _retain_local_vectors(doc_ref: str, keys: Set[Tuple[str, bytes]]) -> None:
+        """
+        DBに保存しない場合に、文書 doc_ref が参照するベクトルを keys に置き換え、
+        どの文書からも参照されなくなったベクトルを削除する(DBでの collect_orphan_vectors に相当)。
+        """
+        with RAGSearcher._local_lock:
+            refcounts = RAGSearcher._local_refcounts
+            old = RAGSearcher._local_doc_vectors.pop(doc_ref, set())
+            if keys:
+                RAGSearcher._local_doc_vectors[doc_ref] = keys
+            for key in keys - old:
+                refcounts[key] = refcounts.get(key, 0) + 1
+            for key in old - keys:
+                refcounts[key] -= 1
+                if refcounts[key] == 0:
+                    del refcounts[key]
+                    RAGSearcher._local_vectors.pop(key, None)
+
+    @staticmethod
+    def _store_chunks(db: Optional[Session], doc_ref: str, batch: List[Chunk],
+                      hashes: List[bytes], dim: int, model_name: str) -> List[int]:
+        """チャンクを doc_embeddings に一括で挿入し、採番されたIDを返す。"""
+        if db is None:
+            return [next(RAGSearcher._local_ids) for _ in batch]
+        rows = embedding_rows(doc_ref, batch, hashes, dim, model_name)
+        result = db.execute(
+            insert(DOC_EMBEDDINGS).values(rows)
+            .returning(DOC_EMBEDDINGS.c.embedding_id, DOC_EMBEDDINGS.c.chunk_start)
+        )
+        # RETURNING の行が VALUES の順に返る保証はないため、文書内で一意なチャンクの開始位置で対応付ける
+        ids_by_start = {chunk_start: embedding_id for embedding_id, chunk_start in result}
+        return [ids_by_start[chunk.start] for chunk in batch]
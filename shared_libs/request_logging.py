@@ -0,0 +1,160 @@
+# .\shared-libs\request_logging.py
+"""
+request_logging.py
+リクエストのエンドポイント・メソッド・ステータス・応答時間・サイズを logs_schema.api_logs に記録するASGIミドルウェア
+"""
+
+import logging
+import random
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Sequence
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import column, table
+
+from shared_libs.batch_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+API_LOGS = table(
+    "api_logs",
+    column("endpoint"),
+    column("method"),
+    column("request_body"),
+    column("response_status"),
+    column("latency_ms"),
+    column("request_size"),
+    column("app_name"),
+    column("timestamp"),
+    schema="logs_schema",
+)
+
+# api_logs.endpoint / method の桁数
+ENDPOINT_CHARS = 100
+METHOD_CHARS = 10
+TRUNCATED_MARK = "...(truncated)"
+# 本文を記録しないパス(認証情報を含むもの)の接頭辞
+DEFAULT_BODY_EXCLUDE_PATHS = ("/auth", "/token", "/authorize", "/authenticate", "/login", "/callback")
+# 本文を記録する Content-Type(バイナリやフォームは記録しない)
+BODY_CONTENT_TYPES = ("application/json", "text/")
+
+
+def api_log_writer(session_factory: Callable[[], Session], batch_size: int = 500,
+                   flush_interval: float = 1.0, capacity: int = 10000) -> BatchWriter:
+    """api_logs に1回の複数行INSERTでまとめて保存する BatchWriter を作る(起動・停止は呼び出し元で行う)。"""
+
+    def write(rows: List[dict]) -> None:
+        db = session_factory()
+        try:
+            db.execute(insert(API_LOGS).values(rows))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise e
+        finally:
+            db.close()
+
+    return BatchWriter(write, batch_size=batch_size, flush_interval=flush_interval,
+                       capacity=capacity, name="api-log")
+
+
+def _header(scope: dict, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers") or ():
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+class RequestLoggingMiddleware:
+    """
+    HTTPリクエストごとに1行を writer(BatchWriter)に渡す純粋なASGIミドルウェア。
+    行はバッファに入れるだけで、DBへの書き込みはバックグラウンドで行うため応答を待たせない
+    (バッファが満杯の場合は待たずに破棄し、writer の dropped に数える)。
+
+    - endpoint はルーティングされたパスのテンプレート(例: /docs/{doc_id})で記録し、
+      一致するルートがない場合は実際のパスを記録する。
+    - 本文は body_sample_rate の割合のリクエストだけ、先頭 max_body_bytes バイトまで記録する
+      (JSON・テキストのみ。body_exclude_paths で始まるパスは記録しない)。
+    - request_size は受信した本文のバイト数(読まれなかった場合は Content-Length)。
+    - exclude_paths で始まるパス(静的ファイルなど)は記録しない。
+    """
+
+    def __init__(self, app, writer: BatchWriter, app_name: str, body_sample_rate: float = 0.0,
+                 max_body_bytes: int = 1024, exclude_paths: Sequence[str] = ("/static",),
+                 body_exclude_paths: Sequence[str] = DEFAULT_BODY_EXCLUDE_PATHS):
+        self.app = app
+        self.writer = writer
+        self.app_name = app_name
+        self.body_sample_rate = body_sample_rate
+        self.max_body_bytes = max_body_bytes
+        self.exclude_paths = tuple(exclude_paths)
+        self.body_exclude_paths = tuple(body_exclude_paths)
+
+    def _capture_body(self, scope: dict) -> bool:
+        if self.body_sample_rate <= 0 or scope["path"].startswith(self.body_exclude_paths):
+            return False
+        content_type = (_header(scope, b"content-type") or "").lower()
+        if not content_type.startswith(BODY_CONTENT_TYPES):
+            return False
+        return self.body_sample_rate >= 1 or random.random() < self.body_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        capture = self._capture_body(scope)
+        body = bytearray()
+        received = 0
+        status = 500
+
+        async def receive_wrapper():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                received += len(chunk)
+                if capture and len(body) <= self.max_body_bytes:
+                    # 切り詰めたかを判定するため、上限より1バイト多く保持する
+                    body.extend(chunk[:self.max_body_bytes + 1 - len(body)])
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            self._record(scope, status, time.perf_counter() - started, received, body if capture else None)
+
+    def _record(self, scope: dict, status: int, latency: float, received: int,
+                body: Optional[bytearray]) -> None:
+        try:
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or scope["path"]
+            if not received:
+                length = _header(scope, b"content-length")
+                received = int(length) if length and length.isdigit() else 0
+            request_body = None
+            if body:
+                request_body = bytes(body[:self.max_body_bytes]).decode("utf-8", errors="replace")
+                if len(body) > self.max_body_bytes:
+                    request_body += TRUNCATED_MARK
+            self.writer.submit({
+                "endpoint": endpoint[:ENDPOINT_CHARS],
+                "method": scope["method"][:METHOD_CHARS],
+                "request_body": request_body,
+                "response_status": status,
+                "latency_ms": round(latency * 1000, 3),
+                "request_size": received,
+                "app_name": self.app_name,
+                "timestamp": datetime.utcnow(),
+            }, timeout=0.0)
+        except Exception as e:
+            # 記録の失敗で応答を失敗させない
+            logger.error(f"リクエストログの記録中にエラーが発生しました: {e}")
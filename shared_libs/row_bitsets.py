@@ -0,0 +1,117 @@
+# .\shared-libs\row_bitsets.py
+"""
+row_bitsets.py
+索引の行番号に揃えた属性(タグ・所有者・アプリ)ごとのビット集合と、検索時の絞り込み
+"""
+
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+def filter_key(kind: str, value) -> str:
+    """属性の種類と値からビット集合のキーを作る(例: tag:契約書, owner:3, app:hub-app)。"""
+    return f"{kind}:{value}"
+
+
+class RowBitsets:
+    """
+    キーごとに、そのキーを持つ行のビットを立てたビット集合(1行1ビット)を保持する。
+    行番号は索引の行列と同じなので、検索時は指定キーのビット集合の論理積を
+    そのまま行マスクとしてスコア計算に適用できる。
+    文書単位で現在のキーを覚えておき、属性が変わった文書は差分のキーだけ更新する。
+    """
+
+    def __init__(self):
+        self._bits: Dict[str, np.ndarray] = {}
+        self._keys_by_ref: Dict[str, FrozenSet[str]] = {}
+
+    def _array(self, key: str, max_row: int) -> np.ndarray:
+        """key のビット集合を max_row 行目まで入る大きさで返す(容量は倍々で伸ばす)。"""
+        bits = self._bits.get(key)
+        required = max_row // 8 + 1
+        if bits is None or bits.shape[0] < required:
+            capacity = max(bits.shape[0] if bits is not None else 128, 128)
+            while capacity < required:
+                capacity *= 2
+            grown = np.zeros(capacity, dtype=np.uint8)
+            if bits is not None:
+                grown[:bits.shape[0]] = bits
+            self._bits[key] = bits = grown
+        return bits
+
+    def set_rows(self, key: str, rows: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.shape[0] == 0:
+            return
+        bits = self._array(key, int(rows.max()))
+        np.bitwise_or.at(bits, rows >> 3, np.left_shift(1, rows & 7).astype(np.uint8))
+
+    def clear_rows(self, key: str, rows: np.ndarray) -> None:
+        bits = self._bits.get(key)
+        rows = np.asarray(rows, dtype=np.int64)
+        if bits is None or rows.shape[0] == 0:
+            return
+        rows = rows[(rows >> 3) < bits.shape[0]]
+        np.bitwise_and.at(bits, rows >> 3, ~np.left_shift(1, rows & 7).astype(np.uint8))
+
+    def add_rows(self, start: int, doc_refs: Sequence[str],
+                 row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """
+        start 行目から追加された行にキーを付ける。row_keys を省略した場合は、
+        その文書に既に設定されているキー(set_doc_keys で設定したもの)を使う。
+        """
+        rows_by_key: Dict[str, List[int]] = {}
+        for offset, doc_ref in enumerate(doc_refs):
+            if row_keys is not None:
+                keys = frozenset(row_keys[offset])
+                self._keys_by_ref[doc_ref] = keys
+            else:
+                keys = self._keys_by_ref.get(doc_ref, frozenset())
+            for key in keys:
+                rows_by_key.setdefault(key, []).append(start + offset)
+        for key, rows in rows_by_key.items():
+            self.set_rows(key, np.asarray(rows, dtype=np.int64))
+
+    def set_doc_keys(self, doc_ref: str, rows: Sequence[int], keys: Iterable[str]) -> None:
+        """文書 doc_ref の行 rows のキーを keys に置き換える。変わったキーのビットだけ更新する。"""
+        keys = frozenset(keys)
+        old = self._keys_by_ref.get(doc_ref, frozenset())
+        self._keys_by_ref[doc_ref] = keys
+        rows = np.asarray(rows, dtype=np.int64)
+        for key in old - keys:
+            self.clear_rows(key, rows)
+        for key in keys - old:
+            self.set_rows(key, rows)
+
+    def compact(self, keep: np.ndarray, size: int) -> "RowBitsets":
+        """
+        先頭 size 行のうち keep の行だけを残し、行番号を詰め直したビット集合を新しく作って返す
+        (索引の compact と同じ行の対応で、元のビット集合は変更しない)。
+        """
+        compacted = RowBitsets()
+        compacted._keys_by_ref = dict(self._keys_by_ref)
+        n_bytes = (size + 7) // 8
+        for key, bits in self._bits.items():
+            part = bits[:n_bytes]
+            if part.shape[0] < n_bytes:
+                part = np.concatenate([part, np.zeros(n_bytes - part.shape[0], dtype=np.uint8)])
+            rows = np.unpackbits(part, count=size, bitorder="little").astype(bool)[keep]
+            compacted.set_rows(key, np.flatnonzero(rows))
+        return compacted
+
+    def mask(self, size: int, keys: Sequence[str]) -> np.ndarray:
+        """keys をすべて持つ行を True とした長さ size の行マスクを返す。"""
+        n_bytes = (size + 7) // 8
+        combined: Optional[np.ndarray] = None
+        for key in keys:
+            bits = self._bits.get(key)
+            if bits is None:
+                return np.zeros(size, dtype=bool)
+            part = bits[:n_bytes]
+            if part.shape[0] < n_bytes:
+                part = np.concatenate([part, np.zeros(n_bytes - part.shape[0], dtype=np.uint8)])
+            combined = part.copy() if combined is None else np.bitwise_and(combined, part, out=combined)
+        if combined is None:
+            return np.ones(size, dtype=bool)
+        return np.unpackbits(combined, count=size, bitorder="little").astype(bool)
@@ -0,0 +1,206 @@
+# .\shared-libs\semantic_cache.py
+"""
+semantic_cache.py
+言い回しの違う同じ質問に、過去のRAG回答を再利用するキャッシュ(質問のEmbeddingの類似度で引く)
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+from shared_libs.vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# 意味の近さを表すEmbeddingで、言い換えた同じ質問とみなすコサイン類似度の下限の既定値
+DEFAULT_THRESHOLD = 0.92
+
+
+class SemanticHit(NamedTuple):
+    """キャッシュから見つかった回答と、元の質問・類似度"""
+    answer: dict
+    query: str
+    similarity: float
+
+
+class SemanticCache:
+    """
+    過去の質問のEmbeddingを最大 max_entries 行の行列に保持し、新しい質問との
+    コサイン類似度が threshold 以上で、絞り込み条件(scope)が同じものがあればその回答を返す。
+
+    - 行は固定長の行列の空き枠を使い回すため、追加・削除で行列を作り直さない。
+      件数が少ない(数千件まで)前提で、検索は有効な行の総当たり(行列とベクトルの積1回)で行う。
+    - 容量を超えた場合は最も長く使われていない項目を、ttl_seconds を過ぎた項目は読み出し時に捨てる。
+    - 回答が引用した文書(doc_ref)ごとに項目を覚えておき、invalidate_docs で
+      その文書を引用した項目をまとめて捨てる(文書の更新・削除時に呼ぶ)。
+      回答の生成中に文書が変わった場合に古い回答を保存しないよう、生成前に generation() を取得して
+      store に渡すと、その後に破棄された文書を引用する回答は保存しない。
+    - dim を省略した場合、行列は最初の store で渡されたベクトルの次元で確保する。
+      max_entries が0以下の場合は何も保存しない。
+    - 絞り込み条件の番号は、その条件の項目がなくなった時点で解放して使い回す。
+    """
+
+    def __init__(self, dim: Optional[int] = None, max_entries: int = 1000, threshold: float = DEFAULT_THRESHOLD,
+                 ttl_seconds: float = 3600.0):
+        self.dim = dim
+        self.max_entries = max(max_entries, 0)
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        max_entries = self.max_entries
+        self._vectors: Optional[np.ndarray] = None
+        if dim is not None:
+            self._vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self._alive = np.zeros(max_entries, dtype=bool)
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        # 絞り込み条件は番号に置き換えて行ごとに持ち、検索時の比較を配列演算で行う
+        self._scope_rows = np.full(max_entries, -1, dtype=np.int64)
+        self._scope_ids: Dict[Hashable, int] = {}
+        self._scope_counts: Dict[Hashable, int] = {}
+        self._free_scope_ids: List[int] = []
+        self._scopes: List[Hashable] = [None] * max_entries
+        self._queries: List[str] = [""] * max_entries
+        self._answers: List[Optional[dict]] = [None] * max_entries
+        self._doc_refs: List[Set[str]] = [set() for _ in range(max_entries)]
+        self._slots_by_doc: Dict[str, Set[int]] = {}
+        # 文書ごとの最後に破棄した時点の世代番号
+        self._generation = 0
+        self._invalidated_at: Dict[str, int] = {}
+        # 使用中の枠(古い順)。先頭が次に追い出す枠
+        self._lru: "OrderedDict[int, None]" = OrderedDict()
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def generation(self) -> int:
+        """現在の世代番号(invalidate_docs のたびに増える)。"""
+        with self._lock:
+            return self._generation
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._lru)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _release(self, slot: int) -> None:
+        self._alive[slot] = False
+        self._answers[slot] = None
+        self._scope_rows[slot] = -1
+        scope = self._scopes[slot]
+        self._scopes[slot] = None
+        self._scope_counts[scope] -= 1
+        if not self._scope_counts[scope]:
+            del self._scope_counts[scope]
+            self._free_scope_ids.append(self._scope_ids.pop(scope))
+        for doc_ref in self._doc_refs[slot]:
+            slots = self._slots_by_doc.get(doc_ref)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del self._slots_by_doc[doc_ref]
+        self._doc_refs[slot] = set()
+        self._lru.pop(slot, None)
+        self._free.append(slot)
+
+    def lookup(self, query_vector: np.ndarray, scope: Hashable = None) -> Optional[SemanticHit]:
+        """scope が同じ項目のうち最も類似度の高いものを、threshold 以上であれば返す。"""
+        query = normalize_rows(query_vector)[0]
+        with self._lock:
+            if self._vectors is None or query.shape[0] != self._vectors.shape[1]:
+                self._stats["misses"] += 1
+                return None
+            now = time.monotonic()
+            expired = np.flatnonzero(self._alive & (self._expires_at <= now))
+            for slot in expired:
+                self._release(int(slot))
+            self._stats["expired"] += len(expired)
+            scope_id = self._scope_ids.get(scope, -2)
+            candidates = np.flatnonzero(self._alive & (self._scope_rows == scope_id))
+            if candidates.shape[0] == 0:
+                self._stats["misses"] += 1
+                return None
+            scores = self._vectors[candidates] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            slot = int(candidates[best])
+            self._lru.move_to_end(slot)
+            self._stats["hits"] += 1
+            return SemanticHit(self._answers[slot], self._queries[slot], float(scores[best]))
+
+    def store(self, query: str, query_vector: np.ndarray, answer: dict,
+              doc_refs: Iterable[str], scope: Hashable = None,
+              generation: Optional[int] = None) -> bool:
+        """
+        回答を保存する。doc_refs は回答が引用した文書(これらが変わると項目を捨てる)。
+        generation 以降に doc_refs のいずれかが破棄されていた場合は保存しない。保存したかを返す。
+        """
+        if not self.enabled:
+            return False
+        vector = normalize_rows(query_vector)[0]
+        doc_refs = set(doc_refs)
+        with self._lock:
+            if generation is not None and any(
+                self._invalidated_at.get(doc_ref, -1) > generation for doc_ref in doc_refs
+            ):
+                return False
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # 最初の保存か、Embeddingのモデルが変わった場合は行列を確保し直す
+                for slot in list(self._lru):
+                    self._release(slot)
+                self.dim = vector.shape[0]
+                self._vectors = np.zeros((self.max_entries, self.dim), dtype=np.float32)
+            if not self._free:
+                self._release(next(iter(self._lru)))
+                self._stats["evictions"] += 1
+            slot = self._free.pop()
+            self._vectors[slot] = vector
+            self._alive[slot] = True
+            self._expires_at[slot] = time.monotonic() + self.ttl_seconds
+            if scope not in self._scope_ids:
+                self._scope_ids[scope] = self._free_scope_ids.pop() if self._free_scope_ids else len(self._scope_ids)
+            self._scope_rows[slot] = self._scope_ids[scope]
+            self._scope_counts[scope] = self._scope_counts.get(scope, 0) + 1
+            self._scopes[slot] = scope
+            self._queries[slot] = query
+            self._answers[slot] = answer
+            self._doc_refs[slot] = doc_refs
+            for doc_ref in doc_refs:
+                self._slots_by_doc.setdefault(doc_ref, set()).add(slot)
+            self._lru[slot] = None
+            self._stats["stores"] += 1
+        return True
+
+    def invalidate_docs(self, doc_refs: Iterable[str]) -> int:
+        """doc_refs のいずれかを引用した項目を捨て、捨てた件数を返す。"""
+        with self._lock:
+            self._generation += 1
+            slots = set()
+            for doc_ref in doc_refs:
+                self._invalidated_at[doc_ref] = self._generation
+                slots.update(self._slots_by_doc.get(doc_ref, ()))
+            for slot in slots:
+                self._release(slot)
+            self._stats["invalidated"] += len(slots)
+        if slots:
+            logger.info(f"文書の更新により、意味的キャッシュの回答 {len(slots)} 件を破棄しました。")
+        return len(slots)
+
+    def clear(self) -> None:
+        with self._lock:
+            for slot in list(self._lru):
+                self._release(slot)
@@ -6,6 +6,9 @@ setup(
     packages=find_packages(),
     install_requires=[
         'requests',  # 必要な依存ライブラリをここに追加
+        'numpy',
+        'httpx[http2]',
+        'SQLAlchemy',
     ],
     author='Your Name',
     author_email='your.email@example.com',
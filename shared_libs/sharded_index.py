@@ -0,0 +1,337 @@
+# .\shared-libs\sharded_index.py
+"""
+sharded_index.py
+共有メモリ上の行列を行範囲(シャード)に分け、プロセスプールで並列に検索する索引
+"""
+
+import logging
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_libs.row_bitsets import RowBitsets
+from shared_libs.vector_index import (
+    COMPACT_RATIO, SearchHit, group_rows, normalize_rows, to_span_array, top_k_indices,
+)
+
+logger = logging.getLogger(__name__)
+
+# 1シャードあたりの最小行数(これより少ない行数ではプロセス間通信の方が高くつく)
+MIN_ROWS_PER_SHARD = 50000
+
+# ワーカープロセス側で開いている共有メモリ(名前ごとに1回だけ接続する)
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = _attached.get(name)
+    if shm is None:
+        # ワーカーは親プロセスと同じ resource_tracker を使うため、解放(unlink)は親プロセスだけが行う
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+
+def _release_attached(keep: str) -> None:
+    """親プロセスが作り直した古い共有メモリへの接続を閉じる。"""
+    for name in [name for name in _attached if name != keep]:
+        _attached.pop(name).close()
+
+
+def _score_shard(shm_name: str, capacity: int, dim: int, start: int, end: int,
+                 query: np.ndarray, top_k: int,
+                 packed_mask: Optional[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    ワーカープロセスで実行する。共有メモリ上の行列の start〜end 行だけを走査し、
+    上位 top_k 件の行番号とスコアを返す。packed_mask はこの範囲の行マスク(packbits済み)。
+    """
+    _release_attached(shm_name)
+    shm = _attach(shm_name)
+    return _top_k_in_range(shm, capacity, dim, start, end, query, top_k, packed_mask)
+
+
+def _top_k_in_range(shm: shared_memory.SharedMemory, capacity: int, dim: int, start: int, end: int,
+                    query: np.ndarray, top_k: int,
+                    packed_mask: Optional[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    # 共有メモリを参照する配列はこの関数内でだけ使い、解放(close)を妨げないようにする
+    matrix = np.ndarray((capacity, dim), dtype=np.float32, buffer=shm.buf)
+    scores = matrix[start:end] @ query
+    del matrix
+    if packed_mask is not None:
+        mask = np.unpackbits(np.frombuffer(packed_mask, dtype=np.uint8), count=end - start).astype(bool)
+        scores[~mask] = -np.inf
+    best = top_k_indices(scores, top_k)
+    best = best[np.isfinite(scores[best])]
+    return best + start, scores[best]
+
+
+class ShardedIndex:
+    """
+    正規化済みのEmbedding行列を共有メモリに置き、検索時は行を workers 個の連続した範囲に分けて
+    プロセスプールで並列にスコア計算し、各シャードの上位 top_k 件を統合して返す索引。
+    ワーカーは行列をコピーせず共有メモリを直接参照するため、メモリ使用量は1プロセス分で済む。
+
+    行数が少ない間(1シャードあたり MIN_ROWS_PER_SHARD 行未満)はシャード数を減らし、
+    1シャードになる場合はプロセス間通信をせず呼び出し元のプロセスで計算する。
+    並列化の効果はコア数に依存し、1コアの環境ではプロセス間通信の分だけ逐次検索より遅くなる。
+    メタデータ(チャンクID・文書参照・絞り込み用ビット集合)は親プロセスだけが持ち、
+    削除・絞り込みは親プロセスで作った行マスクをシャードごとに渡して適用する。
+    削除済みの行が増えたら compact で生きている行だけの共有メモリに作り直す。
+    close() の後は検索結果を返さず、行の追加・削除・キーの変更は RuntimeError にする。
+    """
+
+    def __init__(self, dim: int, workers: int = 2, initial_capacity: int = 1024,
+                 min_rows_per_shard: int = MIN_ROWS_PER_SHARD):
+        if workers <= 0:
+            raise ValueError("workers は 1 以上を指定してください。")
+        self.dim = dim
+        self.workers = workers
+        self.min_rows_per_shard = min_rows_per_shard
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._capacity = 0
+        self._chunk_ids = np.zeros(0, dtype=np.int64)
+        self._spans = np.full((0, 2), -1, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+        self._doc_refs: List[str] = []
+        self._texts: List[str] = []
+        self._rows_by_ref: Dict[str, List[int]] = {}
+        self.filters = RowBitsets()
+        self._deleted = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # 実行中の検索が0件になったことを close() に知らせる
+        self._idle = threading.Condition(self._lock)
+        # 作り直した後、実行中の検索が終わるまで解放を待つ共有メモリ
+        self._retired: List[shared_memory.SharedMemory] = []
+        self._active_searches = 0
+        self._closed = False
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._grow(max(initial_capacity, 1))
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def doc_refs(self) -> List[str]:
+        """登録されている(削除されていない)文書参照の一覧を返す。"""
+        with self._lock:
+            return list(self._rows_by_ref)
+
+    def set_doc_keys(self, doc_ref: str, keys: Iterable[str]) -> None:
+        """文書 doc_ref の全チャンクの絞り込み用キーを置き換える。"""
+        with self._lock:
+            self._check_open()
+            self.filters.set_doc_keys(doc_ref, self._rows_by_ref.get(doc_ref, []), keys)
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise RuntimeError("close() 済みのシャード分割索引は変更できません。")
+
+    def _matrix(self) -> np.ndarray:
+        return np.ndarray((self._capacity, self.dim), dtype=np.float32, buffer=self._shm.buf)
+
+    def _grow(self, capacity: int) -> None:
+        size = self._size
+        shm = shared_memory.SharedMemory(create=True, size=capacity * self.dim * 4)
+        matrix = np.ndarray((capacity, self.dim), dtype=np.float32, buffer=shm.buf)
+        chunk_ids = np.zeros(capacity, dtype=np.int64)
+        spans = np.full((capacity, 2), -1, dtype=np.int64)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._shm is not None:
+            matrix[:size] = self._matrix()[:size]
+            self._retired.append(self._shm)
+        chunk_ids[:size] = self._chunk_ids[:size]
+        spans[:size] = self._spans[:size]
+        alive[:size] = self._alive[:size]
+        self._shm = shm
+        self._capacity = capacity
+        self._chunk_ids = chunk_ids
+        self._spans = spans
+        self._alive = alive
+        self._release_retired()
+
+    def _release_retired(self) -> None:
+        if self._active_searches:
+            return
+        for shm in self._retired:
+            shm.close()
+            shm.unlink()
+        self._retired = []
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 親プロセスはスレッドを持つため fork ではなく spawn でワーカーを起動する
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def add(self, chunk_ids: Sequence[int], vectors: np.ndarray,
+            doc_refs: Sequence[str], texts: Sequence[str],
+            spans: Optional[Sequence[Tuple[int, int]]] = None,
+            row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """チャンクを共有メモリ上の行列に追加する。"""
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"次元数が一致しません: expected={self.dim}, actual={vectors.shape[1]}")
+        if not (len(chunk_ids) == len(doc_refs) == len(texts) == count):
+            raise ValueError("chunk_ids / vectors / doc_refs / texts の件数が一致しません。")
+        span_array = to_span_array(spans, count)
+        with self._lock:
+            self._check_open()
+            start = self._size
+            if start + count > self._capacity:
+                capacity = self._capacity
+                while capacity < start + count:
+                    capacity *= 2
+                self._grow(capacity)
+            self._matrix()[start:start + count] = vectors
+            self._chunk_ids[start:start + count] = np.asarray(chunk_ids, dtype=np.int64)
+            self._spans[start:start + count] = span_array
+            self._alive[start:start + count] = True
+            self._doc_refs.extend(doc_refs)
+            self._texts.extend(texts)
+            for offset, doc_ref in enumerate(doc_refs):
+                self._rows_by_ref.setdefault(doc_ref, []).append(start + offset)
+            self.filters.add_rows(start, doc_refs, row_keys)
+            self._size = start + count
+
+    def remove_doc(self, doc_ref: str) -> int:
+        """doc_ref に属するチャンクを検索対象から外し、外した件数を返す。"""
+        with self._lock:
+            self._check_open()
+            rows = self._rows_by_ref.pop(doc_ref, [])
+            if rows:
+                self._alive[rows] = False
+                self._deleted += len(rows)
+        return len(rows)
+
+    def compact(self, min_ratio: float = COMPACT_RATIO) -> int:
+        """
+        削除済みの行が全行の min_ratio 以上あれば、生きている行だけを新しい共有メモリに書き写して差し替え、
+        取り除いた行数を返す。古い共有メモリは実行中の検索が終わってから解放する。close() 後は何もしない。
+        """
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            if self._closed or deleted == 0 or deleted < size * min_ratio:
+                return 0
+            keep = np.flatnonzero(self._alive[:size])
+            count = keep.shape[0]
+            capacity = max(count, 1)
+            shm = shared_memory.SharedMemory(create=True, size=capacity * self.dim * 4)
+            matrix = np.ndarray((capacity, self.dim), dtype=np.float32, buffer=shm.buf)
+            matrix[:count] = self._matrix()[keep]
+            del matrix
+            chunk_ids = np.zeros(capacity, dtype=np.int64)
+            chunk_ids[:count] = self._chunk_ids[keep]
+            spans = np.full((capacity, 2), -1, dtype=np.int64)
+            spans[:count] = self._spans[keep]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:count] = True
+            self._retired.append(self._shm)
+            self._shm = shm
+            self._capacity = capacity
+            self._chunk_ids = chunk_ids
+            self._spans = spans
+            self._alive = alive
+            self._doc_refs = [self._doc_refs[row] for row in keep.tolist()]
+            self._texts = [self._texts[row] for row in keep.tolist()]
+            self._rows_by_ref = group_rows(self._doc_refs)
+            self.filters = self.filters.compact(keep, size)
+            self._deleted = 0
+            self._size = count
+            self._release_retired()
+        return deleted
+
+    def shard_ranges(self, size: int) -> List[Tuple[int, int]]:
+        """size 行を連続した行範囲に分割する。"""
+        shards = max(1, min(self.workers, size // self.min_rows_per_shard))
+        step = math.ceil(size / shards)
+        return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5,
+               where: Optional[Sequence[str]] = None) -> List[SearchHit]:
+        """全シャードに同じクエリを配り、各シャードの上位 top_k 件を統合して上位 top_k 件を返す。"""
+        query = normalize_rows(query_vector)[0]
+        if query.shape[0] != self.dim:
+            raise ValueError(f"クエリの次元数が一致しません: expected={self.dim}, actual={query.shape[0]}")
+        with self._lock:
+            size = self._size
+            # close() 済みの索引は共有メモリを手放しているため検索しない
+            if size == 0 or self._closed:
+                return []
+            shm = self._shm
+            capacity = self._capacity
+            row_data = (self._chunk_ids, self._spans, self._doc_refs, self._texts)
+            mask = None
+            if where:
+                mask = self.filters.mask(size, where) & self._alive[:size]
+            elif self._deleted:
+                mask = self._alive[:size].copy()
+            self._active_searches += 1
+        try:
+            ranges = self.shard_ranges(size)
+            packed = [None if mask is None else np.packbits(mask[start:end]).tobytes() for start, end in ranges]
+            if len(ranges) == 1:
+                rows, scores = _top_k_in_range(shm, capacity, self.dim, 0, size, query, top_k, packed[0])
+            else:
+                pool = self._get_pool()
+                futures = [
+                    pool.submit(_score_shard, shm.name, capacity, self.dim, start, end, query, top_k, part)
+                    for (start, end), part in zip(ranges, packed)
+                ]
+                results = [future.result() for future in futures]
+                rows = np.concatenate([result[0] for result in results])
+                scores = np.concatenate([result[1] for result in results])
+                best = top_k_indices(scores, top_k)
+                rows, scores = rows[best], scores[best]
+        finally:
+            with self._lock:
+                self._active_searches -= 1
+                self._release_retired()
+                if not self._active_searches:
+                    self._idle.notify_all()
+        return self._to_hits(rows, scores, row_data)
+
+    @staticmethod
+    def _to_hits(rows: np.ndarray, scores: np.ndarray, row_data: tuple) -> List[SearchHit]:
+        """行番号と、それに対応するスコアの配列から、検索開始時点の行データ row_data で検索結果を作る。"""
+        chunk_ids, spans, doc_refs, texts = row_data
+        hits = []
+        for row, score in zip(rows, scores):
+            start, end = spans[row]
+            hits.append(SearchHit(
+                chunk_id=int(chunk_ids[row]),
+                doc_ref=doc_refs[row],
+                score=float(score),
+                text=texts[row],
+                start=int(start) if start >= 0 else None,
+                end=int(end) if end >= 0 else None,
+            ))
+        return hits
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """
+        新しい検索の受け付けを止め、実行中の検索が終わるのを待ってから共有メモリを解放し、
+        ワーカープロセスを停止する。timeout 秒以内に終わらなかった場合は False を返し、
+        共有メモリの解放は最後の検索が終わった時点で行う。
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._retired.append(self._shm)
+                self._shm = None
+            drained = self._idle.wait_for(lambda: not self._active_searches, timeout)
+            self._release_retired()
+            pool, self._pool = self._pool, None
+        # 検索中のスレッドが結果を待っている間はロックを持たずにプールを止める
+        if pool is not None:
+            pool.shutdown(wait=drained)
+        if not drained:
+            logger.warning(f"close() の待機がタイムアウトしました: 実行中の検索={self._active_searches}")
+        return drained
@@ -0,0 +1,54 @@
+# .\shared-libs\single_flight.py
+"""
+single_flight.py
+同じキーの処理が実行中の場合に、後から来た呼び出しを実行中の処理の結果待ちにまとめる(single-flight)
+"""
+
+import asyncio
+import re
+import unicodedata
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """全角・半角、大文字・小文字、前後と連続する空白の違いを同一視した文字列にする。"""
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", query)).strip().casefold()
+
+
+class SingleFlight:
+    """
+    キーごとに実行中の処理を1つだけ持ち、同じキーで同時に呼び出された場合は
+    最初の呼び出し(leader)の結果を全員で共有する。結果・例外とも共有し、完了後のキャッシュはしない。
+
+    処理は呼び出し元とは別のタスクとして実行するため、最初の呼び出し元が切断(キャンセル)されても
+    待っている他の呼び出し元には影響しない。イベントループ1つ(1プロセス)の中でだけまとめる。
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._stats = {"leaders": 0, "followers": 0}
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "in_flight": len(self._calls)}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+            self._stats["leaders"] += 1
+        else:
+            self._stats["followers"] += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> Any:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 待っている呼び出し元が全員キャンセルされた場合も、例外が未回収のまま残らないようにする
+        if not task.cancelled():
+            task.exception()
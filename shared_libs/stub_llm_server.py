@@ -0,0 +1,238 @@
+# .\shared-libs\stub_llm_server.py
+"""
+stub_llm_server.py
+OpenAI の completions API と同じ形式で応答するローカルのスタブサーバー(遅延・生成速度・エラーを注入できる)
+
+起動例:
+    python -m shared_libs.stub_llm_server --port 8900 --latency lognormal:0.4,0.6 --token-rate 40 --error-rate 0.02
+hub-app 側は LLM_PROVIDER=stub(接続先を変える場合は LLM_BASE_URL=http://host:port/v1)で起動する。
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_KINDS = ("fixed", "uniform", "lognormal", "exponential")
+
+
+class LatencyModel:
+    """
+    最初のトークンまでの遅延(秒)の分布。spec は "種類:パラメータ" の形式で指定する。
+    - fixed:秒 / uniform:最小,最大 / lognormal:中央値,sigma / exponential:平均
+    """
+
+    def __init__(self, kind: str, params: Tuple[float, ...]):
+        if kind not in LATENCY_KINDS:
+            raise ValueError(f"未対応の遅延分布です: {kind}")
+        expected = 2 if kind in ("uniform", "lognormal") else 1
+        if len(params) != expected:
+            raise ValueError(f"{kind} のパラメータは {expected} 個指定してください。")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        kind, _, values = spec.partition(":")
+        return cls(kind.strip(), tuple(float(value) for value in values.split(",") if value.strip()))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        mean = self.params[0]
+        return rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+
+
+class StubLLMServer:
+    """
+    POST /v1/completions に OpenAI と同じ形式で応答するHTTPサーバー(接続ごとにスレッドで処理する)。
+
+    - 最初のトークンまで latency の分布に従って待ち、その後は毎秒 token_rate 個の速さで
+      min(max_tokens, tokens) 個のトークンを生成する(stream=true の場合は1トークンずつSSEで送る)。
+    - error_rate の割合で error_status を返し、hang_rate の割合で hang_seconds 応答しない
+      (クライアントのタイムアウトの確認用)。
+    - seed を指定すると遅延・エラーの発生が再現できる。GET /health で受付件数などを返す。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8900, latency: str = "fixed:0.05",
+                 token_rate: float = 50.0, tokens: int = 64, error_rate: float = 0.0,
+                 error_status: int = 503, hang_rate: float = 0.0, hang_seconds: float = 120.0,
+                 seed: Optional[int] = None):
+        self.latency = LatencyModel.parse(latency)
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "errors": 0, "hangs": 0, "streams": 0, "tokens": 0}
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += value
+
+    def plan(self) -> Tuple[str, float]:
+        """1件分の振る舞い("error" / "hang" / "ok")と最初のトークンまでの遅延を決める。"""
+        with self._lock:
+            self._stats["requests"] += 1
+            draw = self._rng.random()
+            delay = self.latency.sample(self._rng)
+        if draw < self.error_rate:
+            return "error", delay
+        if draw < self.error_rate + self.hang_rate:
+            return "hang", delay
+        return "ok", delay
+
+    def start(self) -> str:
+        """別スレッドで受付を始め、base_url を返す。"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="stub-llm", daemon=True)
+        self._thread.start()
+        logger.info(f"スタブLLMサーバーを起動しました: {self.base_url}")
+        return self.base_url
+
+    def serve_forever(self) -> None:
+        logger.info(f"スタブLLMサーバーを起動しました: {self.base_url}")
+        self._httpd.serve_forever()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # キープアライブを有効にし、ストリーミングはチャンク転送で送る
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _send_json(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_chunk(self, text: str) -> None:
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/health":
+                    self._send_json(200, {"status": "ok", **server.stats()})
+                else:
+                    self._send_json(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._send_json(400, {"error": {"message": "invalid json"}})
+                    return
+                if not self.path.rstrip("/").endswith("/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                behavior, delay = server.plan()
+                if behavior == "hang":
+                    server._count("hangs")
+                    time.sleep(server.hang_seconds)
+                    self.close_connection = True
+                    return
+                time.sleep(delay)
+                if behavior == "error":
+                    server._count("errors")
+                    headers = {"Retry-After": "1"} if server.error_status in (429, 503) else None
+                    self._send_json(server.error_status, {"error": {"message": "injected error"}}, headers)
+                    return
+                model = request.get("model", "stub")
+                count = max(min(int(request.get("max_tokens") or server.tokens), server.tokens), 0)
+                interval = 1.0 / server.token_rate if server.token_rate > 0 else 0.0
+                tokens = [f" token{i}" for i in range(count)]
+                server._count("tokens", count)
+                if request.get("stream"):
+                    server._count("streams")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for token in tokens:
+                        time.sleep(interval)
+                        event = {"object": "text_completion", "model": model,
+                                 "choices": [{"text": token, "index": 0, "finish_reason": None}]}
+                        self._write_chunk(f"data: {json.dumps(event)}\n\n")
+                    self._write_chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                time.sleep(interval * count)
+                self._send_json(200, {
+                    "object": "text_completion",
+                    "model": model,
+                    "choices": [{"text": "".join(tokens), "index": 0, "finish_reason": "length"}],
+                    "usage": {"completion_tokens": count},
+                })
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 互換のスタブLLMサーバーを起動します。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", default="fixed:0.05",
+                        help="最初のトークンまでの遅延(fixed:秒 / uniform:最小,最大 / lognormal:中央値,sigma / exponential:平均)")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="毎秒の生成トークン数(0は待たない)")
+    parser.add_argument("--tokens", type=int, default=64, help="1応答の最大トークン数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合")
+    parser.add_argument("--error-status", type=int, default=503, help="注入するエラーのHTTPステータス")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="応答しない割合")
+    parser.add_argument("--hang-seconds", type=float, default=120.0, help="応答しない場合に待つ秒数")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    server = StubLLMServer(args.host, args.port, latency=args.latency, token_rate=args.token_rate,
+                           tokens=args.tokens, error_rate=args.error_rate, error_status=args.error_status,
+                           hang_rate=args.hang_rate, hang_seconds=args.hang_seconds, seed=args.seed)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# .\shared-libs\vector_codec.py
+"""
+vector_codec.py
+Embeddingをリトルエンディアンfloat32のバイト列(bytea)として保存・復元する処理
+"""
+
+import json
+from typing import Optional, Sequence
+
+import numpy as np
+
+# DBに保存するベクトルのバイト表現(リトルエンディアン float32)
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def pack_vector(vector: Sequence[float]) -> bytes:
+    """ベクトルをリトルエンディアンfloat32のバイト列に変換する。"""
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def unpack_vector(blob: bytes, dim: Optional[int] = None) -> np.ndarray:
+    """
+    バイト列をコピーせずに読み取り専用のfloat32配列として参照する。
+    dim が指定された場合はバイト長と次元数の整合性を検証する。
+    """
+    vector = np.frombuffer(blob, dtype=VECTOR_DTYPE)
+    if dim is not None and vector.shape[0] != dim:
+        raise ValueError(f"ベクトル長が次元数と一致しません: dim={dim}, actual={vector.shape[0]}")
+    return vector
+
+
+def unpack_matrix(blobs: Sequence[bytes], dim: int) -> np.ndarray:
+    """
+    複数のバイト列を1回の連結で (件数, dim) の行列に変換する。
+    """
+    if not blobs:
+        return np.empty((0, dim), dtype=VECTOR_DTYPE)
+    buffer = b"".join(blobs)
+    if len(buffer) != len(blobs) * dim * VECTOR_DTYPE.itemsize:
+        raise ValueError("バイト列の長さが次元数と一致しません。")
+    return np.frombuffer(buffer, dtype=VECTOR_DTYPE).reshape(len(blobs), dim)
+
+
+def text_to_blob(value: str) -> bytes:
+    """旧形式の '[0.1, 0.2, ...]' テキストをバイト列に変換する(移行用)。"""
+    return pack_vector(json.loads(value))
@@ -0,0 +1,278 @@
+# .\shared-libs\vector_index.py
+"""
+vector_index.py
+インメモリのベクトル索引(float32行列 + NumPyによるTop-kコサイン類似度検索)
+"""
+
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_libs.row_bitsets import RowBitsets
+
+# 表示用のスニペットとして使う本文の先頭文字数
+SNIPPET_CHARS = 200
+# 削除済み(墓標)の行が全行に対してこの割合以上になったら、生きている行だけに詰め直す
+# (詰め直しは生きている行をすべて書き写すため、割合を下限にして1行の削除あたりの複写量を抑える)
+COMPACT_RATIO = 0.25
+
+
+class SearchHit(NamedTuple):
+    """検索結果1件分(チャンクID・文書参照・スコア・チャンク本文・元文書内の文字範囲)"""
+    chunk_id: int
+    doc_ref: str
+    score: float
+    text: str
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+    @property
+    def snippet(self) -> str:
+        """表示用に本文の先頭 SNIPPET_CHARS 文字だけを返す(プロンプトには text を使う)。"""
+        return self.text[:SNIPPET_CHARS]
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    各行をL2正規化したfloat32行列を返す。
+    正規化済みの行列同士なら内積がそのままコサイン類似度になる。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    スコア上位k件のインデックスを降順で返す。
+    全件ソートは行わず argpartition で候補を絞ってから k 件だけを並べ替える。
+    """
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+# 絞り込みで残る行がこの割合未満なら、残った行だけを取り出してスコアを計算する
+SUBSET_SCORING_RATIO = 0.5
+
+
+def to_span_array(spans: Optional[Sequence[Tuple[int, int]]], count: int) -> np.ndarray:
+    """チャンクの文字範囲を (件数, 2) の配列にする。範囲が不明な場合は -1 を入れる。"""
+    if spans is None:
+        return np.full((count, 2), -1, dtype=np.int64)
+    return np.asarray(spans, dtype=np.int64).reshape(count, 2)
+
+
+def group_rows(doc_refs: Sequence[str]) -> Dict[str, List[int]]:
+    """行番号順の文書参照の一覧から、文書参照ごとの行番号の一覧を作る(詰め直し後の対応表)。"""
+    rows_by_ref: Dict[str, List[int]] = {}
+    for row, doc_ref in enumerate(doc_refs):
+        rows_by_ref.setdefault(doc_ref, []).append(row)
+    return rows_by_ref
+
+
+class VectorIndex:
+    """
+    正規化済みのEmbeddingを1つのfloat32行列として保持し、総当たりで検索する索引。
+    行の追加は容量倍増で償却O(1)とし、検索は追加処理と並行して実行できる。
+    文書単位の削除は行を無効化(墓標)するだけで、墓標が増えたら compact で詰め直す。
+    行ごとの属性(タグ・所有者など)は filters に行番号を揃えたビット集合として持ち、
+    検索時の where で指定したキーを持つ行だけをスコア計算の対象にする。
+    """
+
+    def __init__(self, dim: int, initial_capacity: int = 1024):
+        self.dim = dim
+        capacity = max(initial_capacity, 1)
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self._chunk_ids = np.zeros(capacity, dtype=np.int64)
+        self._spans = np.full((capacity, 2), -1, dtype=np.int64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._doc_refs: List[str] = []
+        self._texts: List[str] = []
+        self._rows_by_ref: Dict[str, List[int]] = {}
+        self.filters = RowBitsets()
+        self._deleted = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def doc_refs(self) -> List[str]:
+        """登録されている(削除されていない)文書参照の一覧を返す。"""
+        with self._lock:
+            return list(self._rows_by_ref)
+
+    def set_doc_keys(self, doc_ref: str, keys: Iterable[str]) -> None:
+        """文書 doc_ref の全チャンクの絞り込み用キーを置き換える。"""
+        with self._lock:
+            self.filters.set_doc_keys(doc_ref, self._rows_by_ref.get(doc_ref, []), keys)
+
+    def _reserve(self, required: int) -> None:
+        capacity = self._matrix.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        size = self._size
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:size] = self._matrix[:size]
+        chunk_ids = np.zeros(capacity, dtype=np.int64)
+        chunk_ids[:size] = self._chunk_ids[:size]
+        spans = np.full((capacity, 2), -1, dtype=np.int64)
+        spans[:size] = self._spans[:size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:size] = self._alive[:size]
+        self._matrix = matrix
+        self._chunk_ids = chunk_ids
+        self._spans = spans
+        self._alive = alive
+
+    def add(self, chunk_ids: Sequence[int], vectors: np.ndarray,
+            doc_refs: Sequence[str], texts: Sequence[str],
+            spans: Optional[Sequence[Tuple[int, int]]] = None,
+            row_keys: Optional[Sequence[Iterable[str]]] = None) -> None:
+        """
+        チャンクを索引に追加する。vectors は (件数, dim) の行列、texts は検索結果に返すチャンク本文、
+        spans は各チャンクの元文書内での文字範囲 (start, end)、
+        row_keys は各チャンクの絞り込み用キー(省略時は文書に設定済みのキー)。
+        """
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"次元数が一致しません: expected={self.dim}, actual={vectors.shape[1]}")
+        if not (len(chunk_ids) == len(doc_refs) == len(texts) == count):
+            raise ValueError("chunk_ids / vectors / doc_refs / texts の件数が一致しません。")
+        span_array = to_span_array(spans, count)
+        with self._lock:
+            start = self._size
+            self._reserve(start + count)
+            self._matrix[start:start + count] = vectors
+            self._chunk_ids[start:start + count] = np.asarray(chunk_ids, dtype=np.int64)
+            self._spans[start:start + count] = span_array
+            self._alive[start:start + count] = True
+            self._doc_refs.extend(doc_refs)
+            self._texts.extend(texts)
+            for offset, doc_ref in enumerate(doc_refs):
+                self._rows_by_ref.setdefault(doc_ref, []).append(start + offset)
+            self.filters.add_rows(start, doc_refs, row_keys)
+            # 行データを書き込んでから件数を公開する(検索側は件数→行列の順に参照する)
+            self._size = start + count
+
+    def remove_doc(self, doc_ref: str) -> int:
+        """doc_ref に属するチャンクを検索対象から外し、外した件数を返す。"""
+        with self._lock:
+            rows = self._rows_by_ref.pop(doc_ref, [])
+            if rows:
+                self._alive[rows] = False
+                self._deleted += len(rows)
+        return len(rows)
+
+    def compact(self, min_ratio: float = COMPACT_RATIO) -> int:
+        """
+        削除済みの行が全行の min_ratio 以上あれば、生きている行だけの配列を作って差し替え、取り除いた行数を返す。
+        配列は書き換えずに新しく作るため、差し替え前に始まった検索は古い配列のまま最後まで実行できる。
+        """
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            if deleted == 0 or deleted < size * min_ratio:
+                return 0
+            keep = np.flatnonzero(self._alive[:size])
+            count = keep.shape[0]
+            capacity = max(count, 1)
+            matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+            matrix[:count] = self._matrix[keep]
+            chunk_ids = np.zeros(capacity, dtype=np.int64)
+            chunk_ids[:count] = self._chunk_ids[keep]
+            spans = np.full((capacity, 2), -1, dtype=np.int64)
+            spans[:count] = self._spans[keep]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:count] = True
+            self._doc_refs = [self._doc_refs[row] for row in keep.tolist()]
+            self._texts = [self._texts[row] for row in keep.tolist()]
+            self._rows_by_ref = group_rows(self._doc_refs)
+            self.filters = self.filters.compact(keep, size)
+            self._matrix = matrix
+            self._chunk_ids = chunk_ids
+            self._spans = spans
+            self._alive = alive
+            self._deleted = 0
+            self._size = count
+        return deleted
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5,
+               where: Optional[Sequence[str]] = None) -> List[SearchHit]:
+        """
+        クエリベクトルとのコサイン類似度が高い順に最大 top_k 件を返す。
+        where を指定した場合は、そのキーをすべて持つ行だけを対象にする。
+        残る行が少ない場合はその行だけを取り出して計算し、多い場合は対象外の行のスコアを -inf にする。
+        """
+        # 配列は追加時の拡張と compact で差し替わるため、同じ時点の組を取り出して使う
+        with self._lock:
+            size, deleted = self._size, self._deleted
+            matrix, alive, filters = self._matrix, self._alive, self.filters
+            row_data = (self._chunk_ids, self._spans, self._doc_refs, self._texts)
+        if size == 0:
+            return []
+        query = normalize_rows(query_vector)[0]
+        if query.shape[0] != self.dim:
+            raise ValueError(f"クエリの次元数が一致しません: expected={self.dim}, actual={query.shape[0]}")
+        if where:
+            mask = filters.mask(size, where) & alive[:size]
+            rows = np.flatnonzero(mask)
+            if rows.shape[0] < size * SUBSET_SCORING_RATIO:
+                scores = matrix[rows] @ query
+                best = top_k_indices(scores, top_k)
+                return self._to_hits(rows[best], scores[best], row_data)
+            scores = matrix[:size] @ query
+            scores[~mask] = -np.inf
+        else:
+            scores = matrix[:size] @ query
+            if deleted:
+                scores[~alive[:size]] = -np.inf
+        rows = top_k_indices(scores, top_k)
+        rows = rows[np.isfinite(scores[rows])]
+        return self._to_hits(rows, scores[rows], row_data)
+
+    @staticmethod
+    def _to_hits(rows: np.ndarray, scores: np.ndarray, row_data: tuple) -> List[SearchHit]:
+        """行番号と、それに対応するスコアの配列から、検索開始時点の行データ row_data で検索結果を作る。"""
+        chunk_ids, spans, doc_refs, texts = row_data
+        hits = []
+        for row, score in zip(rows, scores):
+            start, end = spans[row]
+            hits.append(SearchHit(
+                chunk_id=int(chunk_ids[row]),
+                doc_ref=doc_refs[row],
+                score=float(score),
+                text=texts[row],
+                start=int(start) if start >= 0 else None,
+                end=int(end) if end >= 0 else None,
+            ))
+        return hits
+
+    def vectors(self) -> np.ndarray:
+        """現在登録されている正規化済み行列(読み取り専用ビュー)を返す。"""
+        view = self._matrix[:self._size]
+        view.flags.writeable = False
+        return view
+
+    @staticmethod
+    def from_arrays(chunk_ids: Sequence[int], vectors: np.ndarray,
+                    doc_refs: Sequence[str], texts: Sequence[str],
+                    dim: Optional[int] = None,
+                    spans: Optional[Sequence[Tuple[int, int]]] = None) -> "VectorIndex":
+        """既存の配列から索引を構築する。"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        index = VectorIndex(dim or vectors.shape[1], initial_capacity=max(len(chunk_ids), 1))
+        if len(chunk_ids):
+            index.add(chunk_ids, vectors, doc_refs, texts, spans=spans)
+        return index
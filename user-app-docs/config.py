@@ -12,6 +12,14 @@ class DocsSettings(BaseSettings):
     ALGORITHM: str = Field("HS256", env="ALGORITHM")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = Field(30, env="ACCESS_TOKEN_EXPIRE_MINUTES")
     OAUTH2_AUTHORIZE_URL: str = Field("/authorize", env="OAUTH2_AUTHORIZE_URL")
+    # リクエストログ(logs_schema.api_logs)の設定(記録するか、本文を記録するリクエストの割合と最大バイト数、
+    # 1回に保存する件数、最初の行から保存するまでの秒数、バッファの件数)
+    REQUEST_LOG_ENABLED: bool = Field(True, env="REQUEST_LOG_ENABLED")
+    REQUEST_LOG_BODY_SAMPLE_RATE: float = Field(0.0, env="REQUEST_LOG_BODY_SAMPLE_RATE")
+    REQUEST_LOG_BODY_MAX_BYTES: int = Field(1024, env="REQUEST_LOG_BODY_MAX_BYTES")
+    REQUEST_LOG_BATCH_SIZE: int = Field(500, env="REQUEST_LOG_BATCH_SIZE")
+    REQUEST_LOG_FLUSH_INTERVAL: float = Field(1.0, env="REQUEST_LOG_FLUSH_INTERVAL")
+    REQUEST_LOG_BUFFER_SIZE: int = Field(10000, env="REQUEST_LOG_BUFFER_SIZE")
 
     class Config:
         env_file = ".env"
@@ -6,7 +6,7 @@ from .doc_tags_schema import DocTag, DocTagLink
 from .doc_links_schema import DocLink
 from .local_doc_versions_schema import LocalDocVersion
 from .docs_schema import Document
-from .ai_schema import AICallLogs, DocEmbedding
+from .ai_schema import AICallLogs, DocEmbedding, ChunkVector, LLMResponseCache
 
 __all__ = [
     "User",
@@ -18,4 +18,6 @@ __all__ = [
     "Document",
     "AICallLogs",
     "DocEmbedding",
+    "ChunkVector",
+    "LLMResponseCache",
 ]
\ No newline at end of file
@@ -14,6 +14,8 @@ from auth import get_current_user  # auth.pyからインポート
 from dbschemas.users_schema import User
 from dbschemas.local_doc_schema import LocalDoc
 from config import DocsSettings  # 設定のインポート
+from database import SessionLocal
+from shared_libs.request_logging import RequestLoggingMiddleware, api_log_writer
 from pydantic import BaseModel
 from authlib.integrations.starlette_client import OAuth
 from jose import JWTError, jwt
@@ -69,6 +71,31 @@ app.add_middleware(
     secret_key=session_secret_key
 )
 
+# リクエストログ(logs_schema.api_logs にバックグラウンドでまとめて保存する。応答は保存を待たない)
+api_logs = api_log_writer(
+    SessionLocal,
+    batch_size=settings.REQUEST_LOG_BATCH_SIZE,
+    flush_interval=settings.REQUEST_LOG_FLUSH_INTERVAL,
+    capacity=settings.REQUEST_LOG_BUFFER_SIZE,
+)
+if settings.REQUEST_LOG_ENABLED:
+    app.add_middleware(
+        RequestLoggingMiddleware,
+        writer=api_logs,
+        app_name="user-app-docs",
+        body_sample_rate=settings.REQUEST_LOG_BODY_SAMPLE_RATE,
+        max_body_bytes=settings.REQUEST_LOG_BODY_MAX_BYTES,
+    )
+
+@app.on_event("startup")
+def start_api_log_writer():
+    api_logs.start()
+
+# 停止時はバッファに残ったリクエストログを保存してから書き込みスレッドを止める
+@app.on_event("shutdown")
+def stop_api_log_writer():
+    api_logs.stop(timeout=30)
+
 # テンプレート設定
 templates = Jinja2Templates(directory="templates")
 
@@ -0,0 +1,63 @@
+# .\user-app-docs\scripts\quantization_recall_report.py
+"""
+quantization_recall_report.py
+ai_schema.doc_embeddings のベクトルで、圧縮方式(int8 / pq)ごとの recall とメモリ削減率を表示する
+"""
+import argparse
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from shared_libs.quantized_index import recall_report
+from shared_libs.vector_codec import unpack_matrix
+
+# 設定の読み込み
+from config import DocsSettings
+
+settings = DocsSettings()
+
+LOAD_SQL = text(
+    "SELECT embedding_blob FROM ai_schema.doc_embeddings "
+    "WHERE embedding_blob IS NOT NULL AND embedding_dim = :dim "
+    "ORDER BY embedding_id LIMIT :limit"
+)
+
+
+def load_vectors(dim: int, limit: int) -> np.ndarray:
+    engine = create_engine(settings.DOCAPP_DB_URL, echo=False)
+    with engine.connect() as conn:
+        blobs = [row[0] for row in conn.execute(LOAD_SQL, {"dim": dim, "limit": limit})]
+    return unpack_matrix(blobs, dim)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding圧縮方式ごとの recall を計測します。")
+    parser.add_argument("--dim", type=int, default=256, help="対象とするEmbeddingの次元数")
+    parser.add_argument("--limit", type=int, default=100000, help="読み込むベクトルの最大件数")
+    parser.add_argument("--queries", type=int, default=200, help="クエリとして取り分けるベクトル数")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--subvectors", type=int, default=None, help="直積量子化の部分ベクトル数")
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.dim, args.limit)
+    if vectors.shape[0] <= args.queries:
+        print(f"ベクトルが不足しています: {vectors.shape[0]} 件")
+        return
+    # クエリにしたベクトルは索引に含めない
+    rng = np.random.default_rng(0)
+    order = rng.permutation(vectors.shape[0])
+    queries = vectors[order[:args.queries]]
+    corpus = vectors[order[args.queries:]]
+
+    report = recall_report(corpus, queries, top_k=args.top_k,
+                           n_subvectors=args.subvectors, rerank_factor=args.rerank_factor)
+    print(f"corpus={corpus.shape[0]} queries={queries.shape[0]} dim={args.dim} top_k={args.top_k}")
+    print(f"{'mode':<8} {'bytes/vec':>10} {'compress':>9} {'recall':>8} {'recall(rerank)':>15}")
+    for row in report:
+        print(f"{row['mode']:<8} {row['bytes_per_vector']:>10} {row['compression']:>8}x "
+              f"{row['recall_approx']:>8.3f} {row['recall_rerank']:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# .\user-app-docs\scripts\reindex_embeddings.py
+"""
+reindex_embeddings.py
+hub_docs.documents と doc_app.local_docs の全文書をチャンク分割・Embedding化し、
+ai_schema.doc_embeddings を作り直す一括処理
+
+- 文書はサーバーサイドカーソルで --batch-docs 件ずつ読み込み、全件をメモリに載せない。
+- Embedding化はプロセスプールで並列に行い、書き込み(削除 + 一括挿入 + コミット)は文書IDの順に行う。
+- チャンク本文のハッシュ値(content_hash)で ai_schema.chunk_vectors に保存済みのものはEmbedding化しない。
+  終了時にどの行からも参照されなくなったベクトル(旧モデルのものなど)を削除する。
+- 文書の元テーブルは SOURCE_SQL の順に処理する。元テーブルを最後まで処理したら、
+  そのテーブルに存在しない(削除された・無効になった)文書の doc_embeddings 行を削除する。
+- バッチをコミットするたびにチェックポイントファイルへ元テーブルと最後の文書IDを書き出し、
+  中断後に再実行すると同じモデルであればその続きから再開する(--restart で最初から)。
+- 実行中と終了時に docs/s・chunks/s を表示する。
+
+Embeddingモデルを変更した後は、このスクリプトの実行後に hub-app を再起動して索引を読み直すこと。
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Set
+
+import numpy as np
+from sqlalchemy import create_engine, delete, insert, select, text
+from sqlalchemy.orm import sessionmaker
+
+from shared_libs.chunker import Chunk, iter_chunks
+from shared_libs.embedding import Embedder, get_embedder
+from shared_libs.rag_utils import (
+    CHUNK_OVERLAP, CHUNK_SIZE, CHUNK_VECTORS, DOC_EMBEDDINGS, HUB_DOCS_SOURCE, LOCAL_DOCS_SOURCE, RAGSearcher,
+    batched, collect_orphan_vectors, content_hash, embedding_rows, save_chunk_vectors,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+# 再索引する文書の元テーブル(doc_ref の接頭辞)と、その文書を読み込むSQL。この順に処理する
+SOURCE_SQL = {
+    HUB_DOCS_SOURCE: text(
+        "SELECT id, content FROM hub_docs.documents WHERE id > :after_id ORDER BY id"
+    ),
+    LOCAL_DOCS_SOURCE: text(
+        "SELECT id, content FROM doc_app.local_docs WHERE is_active = 1 AND id > :after_id ORDER BY id"
+    ),
+}
+
+# 元テーブルに存在しない文書の doc_embeddings 行を削除するSQL(元テーブルごと)
+_STALE_DOC_SQL = (
+    "DELETE FROM ai_schema.doc_embeddings "
+    "WHERE SUBSTR(doc_ref, 1, :prefix_len) = :prefix "
+    "AND NOT EXISTS (SELECT 1 FROM {table} d "
+    "WHERE :prefix || CAST(d.id AS TEXT) = ai_schema.doc_embeddings.doc_ref{condition})"
+)
+STALE_DOC_SQL = {
+    HUB_DOCS_SOURCE: text(_STALE_DOC_SQL.format(table="hub_docs.documents", condition="")),
+    LOCAL_DOCS_SOURCE: text(_STALE_DOC_SQL.format(table="doc_app.local_docs", condition=" AND d.is_active = 1")),
+}
+
+# ワーカープロセスごとに1回だけ作るEmbedder
+_embedder: Optional[Embedder] = None
+
+
+def _init_worker(backend: str, dim: Optional[int]) -> None:
+    global _embedder
+    _embedder = get_embedder(backend, dim)
+
+
+def _embed(texts: List[str]) -> np.ndarray:
+    return _embedder.embed_batch(texts)
+
+
+def load_checkpoint(path: str, model_name: str) -> dict:
+    """チェックポイントを読み込む。ファイルがないかモデルが異なる場合は最初から始める状態を返す。"""
+    state = {"model": model_name, "source": HUB_DOCS_SOURCE, "last_doc_id": 0, "docs": 0, "chunks": 0}
+    if not os.path.exists(path):
+        return state
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    if saved.get("model") != model_name:
+        logger.warning(f"チェックポイントのモデル({saved.get('model')})が異なるため最初から処理します。")
+        return state
+    # 元テーブルを記録していない(hub_docs.documents のみを処理していた)チェックポイント
+    saved.setdefault("source", HUB_DOCS_SOURCE)
+    return saved
+
+
+def save_checkpoint(path: str, state: dict) -> None:
+    """途中で停止しても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える。"""
+    state["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def split_documents(rows) -> tuple:
+    """文書の行を (文書IDの一覧, 文書ごとのチャンクの一覧) にする。"""
+    doc_ids: List[int] = []
+    chunks: List[List[Chunk]] = []
+    for doc_id, content in rows:
+        doc_ids.append(doc_id)
+        chunks.append([chunk for chunk in iter_chunks(content or "", CHUNK_SIZE, CHUNK_OVERLAP) if chunk.text.strip()])
+    return doc_ids, chunks
+
+
+def stored_hashes(session, model_name: str, hashes: List[bytes]) -> Set[bytes]:
+    """hashes のうち chunk_vectors に保存済みのものを返す(ベクトル本体は読まない)。"""
+    found: Set[bytes] = set()
+    for batch in batched(hashes, 10000):
+        result = session.execute(
+            select(CHUNK_VECTORS.c.content_hash)
+            .where(CHUNK_VECTORS.c.embedding_model == model_name)
+            .where(CHUNK_VECTORS.c.content_hash.in_(batch))
+        )
+        found.update(bytes(row[0]) for row in result)
+    return found
+
+
+def write_batch(session, source: str, doc_ids: List[int], chunks: List[List[Chunk]], hashes: List[bytes],
+                new_hashes: List[bytes], vectors: np.ndarray, dim: int, model_name: str) -> int:
+    """
+    新しくEmbedding化したベクトルを保存し、バッチ内の文書の既存行を削除して新しい行を一括挿入する。
+    戻り値は挿入件数。
+    """
+    save_chunk_vectors(session, model_name, dict(zip(new_hashes, vectors)))
+    doc_refs = [RAGSearcher.doc_ref_for(doc_id, source) for doc_id in doc_ids]
+    rows = []
+    offset = 0
+    for doc_ref, doc_chunks in zip(doc_refs, chunks):
+        rows.extend(embedding_rows(doc_ref, doc_chunks, hashes[offset:offset + len(doc_chunks)], dim, model_name))
+        offset += len(doc_chunks)
+    session.execute(delete(DOC_EMBEDDINGS).where(DOC_EMBEDDINGS.c.doc_ref.in_(doc_refs)))
+    if rows:
+        session.execute(insert(DOC_EMBEDDINGS), rows)
+    return len(rows)
+
+
+def delete_stale_docs(session, source: str) -> int:
+    """元テーブル source に存在しない文書の doc_embeddings 行を削除し、削除件数を返す。"""
+    prefix = RAGSearcher.doc_ref_for("", source)
+    return session.execute(STALE_DOC_SQL[source], {"prefix": prefix, "prefix_len": len(prefix)}).rowcount
+
+
+def reindex(db_url: str, backend: str, dim: Optional[int], workers: int, batch_docs: int,
+            checkpoint_path: str, restart: bool) -> dict:
+    embedder = get_embedder(backend, dim)
+    model_name = embedder.model_name
+    vector_dim = embedder.dim
+    state = {"model": model_name, "source": HUB_DOCS_SOURCE, "last_doc_id": 0, "docs": 0, "chunks": 0}
+    if not restart:
+        state = load_checkpoint(checkpoint_path, model_name)
+    if state["last_doc_id"]:
+        logger.info(
+            f"{state['source']} の文書ID {state['last_doc_id']} の続きから再開します(処理済み {state['docs']} 件)。"
+        )
+
+    engine = create_engine(db_url, echo=False)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = Session()
+    # 読み込み用の接続は書き込み側のコミットでカーソルが閉じないよう分ける
+    read_conn = engine.connect()
+    started = time.monotonic()
+    run_docs = 0
+    run_chunks = 0
+    run_embedded = 0
+    run_removed = 0
+    # 書き込み待ちのバッチ(元テーブル・文書ID・チャンク・ハッシュ値・Embedding化するハッシュ値・Future)。投入順に書き込む
+    in_flight: deque = deque()
+    # Embedding化を依頼済みで、まだ保存していないハッシュ値(バッチをまたいだ重複を防ぐ)
+    submitted: Set[bytes] = set()
+
+    def commit_oldest() -> None:
+        nonlocal run_docs, run_chunks, run_embedded
+        source, doc_ids, chunks, hashes, new_hashes, future = in_flight.popleft()
+        vectors = future.result() if future is not None else np.zeros((0, vector_dim), dtype=np.float32)
+        try:
+            inserted = write_batch(session, source, doc_ids, chunks, hashes, new_hashes, vectors, vector_dim,
+                                   model_name)
+            session.commit()
+        except Exception as e:
+            logger.error(f"{source} の文書ID {doc_ids[0]}〜{doc_ids[-1]} の書き込みに失敗しました: {e}")
+            session.rollback()
+            raise e
+        submitted.difference_update(new_hashes)
+        run_docs += len(doc_ids)
+        run_chunks += inserted
+        run_embedded += len(new_hashes)
+        state["source"] = source
+        state["last_doc_id"] = doc_ids[-1]
+        state["docs"] += len(doc_ids)
+        state["chunks"] += inserted
+        save_checkpoint(checkpoint_path, state)
+        elapsed = max(time.monotonic() - started, 1e-9)
+        logger.info(
+            f"{source} の文書ID {doc_ids[-1]} まで完了: 累計 {state['docs']} 文書 / {state['chunks']} チャンク, "
+            f"{run_docs / elapsed:.1f} docs/s, {run_chunks / elapsed:.1f} chunks/s, "
+            f"Embedding化 {run_embedded} 件"
+        )
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(backend, dim)) as pool:
+            sources = list(SOURCE_SQL)
+            for source in sources[sources.index(state["source"]):]:
+                after_id = state["last_doc_id"] if source == state["source"] else 0
+                result = read_conn.execution_options(stream_results=True).execute(
+                    SOURCE_SQL[source], {"after_id": after_id}
+                )
+                for rows in result.partitions(batch_docs):
+                    doc_ids, chunks = split_documents(rows)
+                    flat = [chunk for doc_chunks in chunks for chunk in doc_chunks]
+                    hashes = [content_hash(chunk.text) for chunk in flat]
+                    text_by_hash = dict(zip(hashes, (chunk.text for chunk in flat)))
+                    candidates = [h for h in text_by_hash if h not in submitted]
+                    stored = stored_hashes(session, model_name, candidates)
+                    new_hashes = [h for h in candidates if h not in stored]
+                    submitted.update(new_hashes)
+                    future = pool.submit(_embed, [text_by_hash[h] for h in new_hashes]) if new_hashes else None
+                    in_flight.append((source, doc_ids, chunks, hashes, new_hashes, future))
+                    # 先読みはワーカー数の2倍までにして、メモリ使用量を抑える
+                    while len(in_flight) > workers * 2:
+                        commit_oldest()
+                # 次の元テーブルに進む前に書き込み、チェックポイントの元テーブルと文書IDを揃える
+                while in_flight:
+                    commit_oldest()
+                try:
+                    removed = delete_stale_docs(session, source)
+                    session.commit()
+                except Exception as e:
+                    logger.error(f"{source} に存在しない文書の削除に失敗しました: {e}")
+                    session.rollback()
+                    raise e
+                run_removed += removed
+                logger.info(f"{source} に存在しない文書の行 {removed} 件を削除しました。")
+        orphans = collect_orphan_vectors(session)
+        session.commit()
+        logger.info(f"参照されなくなったベクトル {orphans} 件を削除しました。")
+    finally:
+        read_conn.close()
+        session.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary = {
+        "model": model_name,
+        "docs": run_docs,
+        "chunks": run_chunks,
+        "embedded": run_embedded,
+        "removed": run_removed,
+        "seconds": round(elapsed, 2),
+        "docs_per_second": round(run_docs / elapsed, 2),
+        "chunks_per_second": round(run_chunks / elapsed, 2),
+    }
+    logger.info(f"再索引が完了しました: {summary}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="hub_docs.documents と doc_app.local_docs のEmbeddingを一括で作り直します。"
+    )
+    parser.add_argument("--backend", default=os.getenv("EMBEDDING_BACKEND", "local"), help="local / openai")
+    parser.add_argument("--dim", type=int, default=None, help="Embeddingの次元数(未指定時は実装ごとの既定値)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Embedding化のプロセス数")
+    parser.add_argument("--batch-docs", type=int, default=64, help="1回に読み込み・書き込みする文書数")
+    parser.add_argument("--checkpoint", default="reindex_checkpoint.json", help="チェックポイントファイル")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から処理する")
+    parser.add_argument("--db-url", default=None, help="接続先(未指定時は設定の DOCAPP_DB_URL)")
+    args = parser.parse_args()
+
+    # 設定の読み込み(接続先を指定しなかった場合だけ必要)
+    from config import DocsSettings
+    db_url = args.db_url or DocsSettings().DOCAPP_DB_URL
+    reindex(db_url, args.backend, args.dim, args.workers, args.batch_docs, args.checkpoint, args.restart)
+
+
+if __name__ == "__main__":
+    main()
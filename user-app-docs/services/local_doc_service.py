@@ -79,12 +79,29 @@ class LocalDocService:
             db.add(link)
             db.commit()
             logger.info(f"タグ '{tag_name}' がドキュメントID {doc_id} に追加されました。")
+            LocalDocService.notify_hub_metadata(doc_id)
             return True
         except Exception as e:
             logger.error(f"ドキュメントにタグを追加中にエラーが発生しました: {e}")
             db.rollback()
             return False
 
+    @staticmethod
+    def notify_hub_metadata(doc_id: int) -> bool:
+        """
+        HubAppの /doc/local/{doc_id}/metadata エンドポイントを呼び出して、
+        ドキュメントのタグ・所有者の変更をRAG検索の絞り込み条件に反映させます。
+        """
+        try:
+            endpoint = f"{settings.HUBAPP_URL}/doc/local/{doc_id}/metadata"
+            resp = requests.post(endpoint, timeout=5)
+            resp.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            # タグの追加自体は成功しているため、通知の失敗はログに残すだけにする
+            logger.error(f"HubAppへのメタデータ変更の通知中にエラーが発生しました: {e}")
+            return False
+
     @staticmethod
     def save_doc_version(doc_id: int, content: str, db: Session) -> Optional[int]:
         """
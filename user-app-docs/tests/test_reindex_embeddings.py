@@ -0,0 +1,84 @@
+# .\user-app-docs\tests\test_reindex_embeddings.py
+
+import json
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from scripts import reindex_embeddings
+from scripts.reindex_embeddings import reindex
+from shared_libs.rag_utils import content_hash
+
+# 元テーブルとEmbeddingの表を置くSQLiteのスキーマ
+SCHEMAS = ("hub_docs", "doc_app", "ai_schema")
+
+@pytest.fixture
+def db_url(tmp_path):
+    """スキーマごとのSQLiteファイルを、reindex が作るエンジンの接続にも ATTACH する"""
+    def attach_schemas(conn, record):
+        for schema in SCHEMAS:
+            conn.execute(f"ATTACH DATABASE '{tmp_path / schema}.db' AS {schema}")
+
+    event.listen(Engine, "connect", attach_schemas)
+    url = f"sqlite:///{tmp_path / 'main.db'}"
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE hub_docs.documents (id INTEGER PRIMARY KEY, content TEXT)"))
+        conn.execute(text("CREATE TABLE doc_app.local_docs (id INTEGER PRIMARY KEY, content TEXT, is_active INTEGER)"))
+        conn.execute(text("CREATE TABLE ai_schema.doc_embeddings (embedding_id INTEGER PRIMARY KEY, "
+                          "doc_ref TEXT, embedding_blob BLOB, embedding_dim INTEGER, embedding_model TEXT, "
+                          "chunk_start INTEGER, chunk_end INTEGER, content_hash BLOB)"))
+        conn.execute(text("CREATE TABLE ai_schema.chunk_vectors (content_hash BLOB, embedding_model TEXT, "
+                          "embedding_blob BLOB, embedding_dim INTEGER, PRIMARY KEY (content_hash, embedding_model))"))
+        # 文書1と3は同じ本文(別のバッチで同じチャンクが出てくる)
+        conn.execute(text("INSERT INTO hub_docs.documents VALUES (1, '就業規則の改定について。'), "
+                          "(2, '経費精算の手順。'), (3, '就業規則の改定について。'), (4, '休暇の申請方法。'), "
+                          "(5, '出張旅費の規程。')"))
+        conn.execute(text("INSERT INTO doc_app.local_docs VALUES (1, '契約書の更新手続き。', 1), "
+                          "(2, '古い議事録。', 0)"))
+        # 削除済みの文書・無効になった文書の行と、どこからも参照されないベクトル
+        conn.execute(text("INSERT INTO ai_schema.doc_embeddings (doc_ref, embedding_model, content_hash) "
+                          "VALUES ('hub_docs.documents:99', 'local-hashing-ngram23-32', X'01'), "
+                          "('doc_app.local_docs:2', 'local-hashing-ngram23-32', X'02')"))
+        conn.execute(text("INSERT INTO ai_schema.chunk_vectors VALUES (X'03', 'local-hashing-ngram23-32', X'', 32)"))
+    engine.dispose()
+    yield url
+    event.remove(Engine, "connect", attach_schemas)
+
+def run(db_url, checkpoint, **kwargs):
+    return reindex(db_url, "local", 32, workers=1, batch_docs=2, checkpoint_path=str(checkpoint),
+                   restart=False, **kwargs)
+
+def test_reindex_resumes_from_checkpoint_and_removes_stale_rows(db_url, tmp_path, monkeypatch):
+    checkpoint = tmp_path / "checkpoint.json"
+    write_batch = reindex_embeddings.write_batch
+
+    def failing_write_batch(session, source, doc_ids, *args):
+        if doc_ids[0] == 3:
+            raise RuntimeError("中断")
+        return write_batch(session, source, doc_ids, *args)
+
+    # 2バッチ目の書き込みで中断すると、1バッチ目(文書1・2)までがチェックポイントに残る
+    monkeypatch.setattr(reindex_embeddings, "write_batch", failing_write_batch)
+    with pytest.raises(RuntimeError):
+        run(db_url, checkpoint)
+    state = json.loads(checkpoint.read_text(encoding="utf-8"))
+    assert (state["source"], state["last_doc_id"], state["docs"]) == ("hub_docs.documents", 2, 2)
+
+    monkeypatch.setattr(reindex_embeddings, "write_batch", write_batch)
+    summary = run(db_url, checkpoint)
+    # 再開後は文書3〜5とローカル文書1だけを処理し、文書3の本文は文書1のベクトルを再利用する
+    assert (summary["docs"], summary["embedded"], summary["removed"]) == (4, 3, 2)
+    engine = create_engine(db_url)
+    with engine.connect() as conn:
+        refs = [row[0] for row in conn.execute(text("SELECT doc_ref FROM ai_schema.doc_embeddings ORDER BY doc_ref"))]
+        assert refs == ["doc_app.local_docs:1"] + [f"hub_docs.documents:{i}" for i in range(1, 6)]
+        hashes = {bytes(row[0]) for row in conn.execute(text("SELECT content_hash FROM ai_schema.chunk_vectors"))}
+        # 参照されなくなったベクトル(X'03')は削除され、同じ本文のベクトルは1件だけ保存される
+        assert hashes == {content_hash(content) for content in (
+            "就業規則の改定について。", "経費精算の手順。", "休暇の申請方法。", "出張旅費の規程。", "契約書の更新手続き。")}
+    engine.dispose()
+
+def test_reindex_embeds_text_repeated_across_batches_once(db_url, tmp_path):
+    summary = run(db_url, tmp_path / "checkpoint.json")
+    # 文書1と3は別のバッチだが、同じ本文は1回だけEmbedding化する
+    assert (summary["docs"], summary["chunks"], summary["embedded"]) == (6, 6, 5)